@@ -30,6 +30,8 @@ NOTAS:
     - El sistema detecta automáticamente en qué estado está el CP
     - Solo muestra intersecciones significativas (>0.01%)
     - Requiere que el estado del CP esté cargado en la base de datos
+    - Si el estado ya fue mapeado (create_cp_ageb_mapping.py) la respuesta sale
+      de la tabla cp_to_ageb_mapping; el aviso NOTICE indica la fuente usada
     - Para verificar estados cargados, ejecuta:
       docker-compose exec postgis psql -U geouser -d cp2ageb -c "\dt sepomex.*"
 
@@ -8,6 +8,8 @@ echo "========================================"
 # Variable de entorno para controlar el comportamiento automático
 AUTO_DOWNLOAD=${AUTO_DOWNLOAD:-true}
 AUTO_LOAD=${AUTO_LOAD:-true}
+# true = pedir de nuevo los ZIPs existentes y reemplazar solo los que cambiaron
+REFRESH_DOWNLOADS=${REFRESH_DOWNLOADS:-false}
 
 # Funciones auxiliares
 wait_for_postgres() {
@@ -21,7 +23,17 @@ wait_for_postgres() {
 
 count_zip_files() {
     local dir=$1
-    if [ -d "$dir" ]; then
+    if [ -f "$dir/manifest.json" ]; then
+        # Solo cuentan los ZIPs del manifiesto presentes con el tamaño registrado
+        python3 - "$dir" <<'PYEOF' 2>/dev/null || echo "0"
+import json, sys
+from pathlib import Path
+d = Path(sys.argv[1])
+manifest = json.loads((d / 'manifest.json').read_text())
+print(sum(1 for name, entry in manifest.items()
+          if (d / name).is_file() and (d / name).stat().st_size == entry.get('size')))
+PYEOF
+    elif [ -d "$dir" ]; then
         find "$dir" -name "*.zip" 2>/dev/null | wc -l
     else
         echo "0"
@@ -37,7 +49,11 @@ download_shapefiles() {
     local cp_count=$(count_zip_files "/data/cp_shapefiles")
     local ageb_count=$(count_zip_files "/data/ageb_shapefiles")
 
-    if [ "$cp_count" -lt 32 ]; then
+    if [ "$REFRESH_DOWNLOADS" = "true" ]; then
+        echo ""
+        echo "→ Actualizando shapefiles de SEPOMEX ($cp_count/32 presentes)..."
+        python3 /app/download_shapefiles.py --refresh
+    elif [ "$cp_count" -lt 32 ]; then
         echo ""
         echo "→ Descargando shapefiles de SEPOMEX ($cp_count/32 presentes)..."
         python3 /app/download_shapefiles.py
@@ -45,7 +61,11 @@ download_shapefiles() {
         echo "✓ Shapefiles de SEPOMEX ya presentes ($cp_count/32)"
     fi
 
-    if [ "$ageb_count" -lt 32 ]; then
+    if [ "$REFRESH_DOWNLOADS" = "true" ]; then
+        echo ""
+        echo "→ Actualizando shapefiles de INEGI ($ageb_count/32 presentes)..."
+        python3 /app/download_ageb_shapefiles.py --refresh
+    elif [ "$ageb_count" -lt 32 ]; then
         echo ""
         echo "→ Descargando shapefiles de INEGI ($ageb_count/32 presentes)..."
         python3 /app/download_ageb_shapefiles.py
@@ -63,7 +83,9 @@ load_shapefiles() {
     local sepomex_tables=$(psql -U "$POSTGRES_USER" -d "$POSTGRES_DB" -tAc "SELECT COUNT(*) FROM information_schema.tables WHERE table_schema='sepomex';" 2>/dev/null || echo "0")
     local inegi_tables=$(psql -U "$POSTGRES_USER" -d "$POSTGRES_DB" -tAc "SELECT COUNT(*) FROM information_schema.tables WHERE table_schema='inegi';" 2>/dev/null || echo "0")
 
-    if [ "$sepomex_tables" -gt 0 ] || [ "$inegi_tables" -gt 0 ]; then
+    # Con REFRESH_DOWNLOADS el cargador sí corre: solo recarga los estados
+    # cuyo ZIP cambió según manifest.json y salta las tablas ya cargadas
+    if [ "$REFRESH_DOWNLOADS" != "true" ] && { [ "$sepomex_tables" -gt 0 ] || [ "$inegi_tables" -gt 0 ]; }; then
         echo ""
         echo "⚠ Shapefiles ya cargados en la base de datos:"
         echo "  - SEPOMEX: $sepomex_tables tablas"
@@ -92,21 +114,15 @@ create_functions() {
     echo "  Creando Funciones SQL"
     echo "========================================"
 
-    # Verificar si la función ya existe
-    local function_exists=$(psql -U "$POSTGRES_USER" -d "$POSTGRES_DB" -tAc "SELECT COUNT(*) FROM pg_proc WHERE proname='buscar_agebs_por_cp';" 2>/dev/null || echo "0")
-
-    if [ "$function_exists" -gt 0 ]; then
-        echo "✓ Función buscar_agebs_por_cp ya existe"
-        return 0
-    fi
-
+    # El archivo usa CREATE OR REPLACE: se aplica siempre para que una base
+    # existente reciba la versión actual de la función
     if [ -f /queries/cp_to_ageb_function.sql ]; then
         echo ""
-        echo "→ Creando función buscar_agebs_por_cp..."
-        psql -U "$POSTGRES_USER" -d "$POSTGRES_DB" -f /queries/cp_to_ageb_function.sql > /dev/null 2>&1
+        echo "→ Creando/actualizando función buscar_agebs_por_cp..."
+        psql -U "$POSTGRES_USER" -d "$POSTGRES_DB" -v ON_ERROR_STOP=1 -f /queries/cp_to_ageb_function.sql > /dev/null 2>&1
 
         if [ $? -eq 0 ]; then
-            echo "✓ Función buscar_agebs_por_cp creada exitosamente"
+            echo "✓ Función buscar_agebs_por_cp actualizada"
         else
             echo "✗ Error al crear función"
             return 1
@@ -21,9 +21,13 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-E
     -- Crear schema para datos de INEGI
     CREATE SCHEMA IF NOT EXISTS inegi;
 
+    -- Crear schema para geometrías subdivididas (SUBDIVIDE_GEOM=true)
+    CREATE SCHEMA IF NOT EXISTS subdiv;
+
     -- Comentarios en los schemas
     COMMENT ON SCHEMA sepomex IS 'Datos de códigos postales de SEPOMEX';
     COMMENT ON SCHEMA inegi IS 'Datos del Marco Geoestadístico de INEGI';
+    COMMENT ON SCHEMA subdiv IS 'Piezas ST_Subdivide de CPs y AGEBs para el cruce espacial';
 
     -- Crear tabla para metadatos de carga
     CREATE TABLE IF NOT EXISTS public.load_metadata (
@@ -38,6 +42,18 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-E
 
     COMMENT ON TABLE public.load_metadata IS 'Metadatos de las cargas de shapefiles';
 
+    -- Directorio CP → entidad (lo llena load_shapefiles.py al cargar SEPOMEX)
+    CREATE TABLE IF NOT EXISTS public.cp_directory (
+        d_cp VARCHAR(10) NOT NULL,
+        cve_ent VARCHAR(2) NOT NULL,
+        source_table VARCHAR(100) NOT NULL,
+        bbox geometry(Polygon, 6372),
+        area_m2 DOUBLE PRECISION,
+        PRIMARY KEY (d_cp, source_table)
+    );
+
+    COMMENT ON TABLE public.cp_directory IS 'Entidad y tabla SEPOMEX de cada código postal';
+
     -- Agregar SRIDs personalizados (ESRI Web Mercator)
     -- SRID 900914: ESRI:102100 - Web Mercator usado por SEPOMEX
     INSERT INTO spatial_ref_sys (srid, auth_name, auth_srid, proj4text, srtext)
@@ -56,7 +72,7 @@ EOSQL
 
 echo "✓ Base de datos inicializada correctamente"
 echo "✓ Extensión PostGIS habilitada"
-echo "✓ Schemas creados: sepomex, inegi"
+echo "✓ Schemas creados: sepomex, inegi, subdiv"
 echo "✓ SRIDs personalizados agregados: 900914, 900916"
 echo ""
 echo "Para cargar los shapefiles, ejecuta:"
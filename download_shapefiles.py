@@ -6,10 +6,11 @@ Descarga archivos .shp de SEPOMEX con delimitación geográfica de códigos post
 
 import os
 import sys
-import requests
 from pathlib import Path
 from typing import Dict
 
+import download_utils
+
 def show_help():
     """Muestra ayuda del script"""
     print("""
@@ -19,6 +20,8 @@ Descarga shapefiles de códigos postales de SEPOMEX para todos los estados de M
 
 OPCIONES:
     --help, -h      Muestra esta ayuda y sale
+    --refresh       Vuelve a pedir los archivos ya descargados y reemplaza solo
+                    los que cambiaron en el servidor (ETag / Last-Modified)
 
 DESCRIPCIÓN:
     Este script descarga los 32 archivos ZIP de shapefiles de códigos postales
@@ -36,15 +39,21 @@ ESTADOS DESCARGADOS:
     Todos los 32 estados de México (Aguascalientes, Baja California, etc.)
 
 EJEMPLOS:
-    python3 download_shapefiles.py          # Descargar todos los estados
-    python3 download_shapefiles.py --help   # Mostrar esta ayuda
+    python3 download_shapefiles.py           # Descargar todos los estados
+    python3 download_shapefiles.py --refresh # Actualizar solo los archivos que cambiaron
+    python3 download_shapefiles.py --help    # Mostrar esta ayuda
 
 FUENTE DE DATOS:
     https://www.datos.gob.mx/dataset/codigos_postales_entidad_federativa
     SEPOMEX (Servicio Postal Mexicano)
 
 NOTAS:
-    - Los archivos ya descargados NO se vuelven a descargar
+    - Los archivos ya descargados NO se vuelven a descargar (salvo --refresh)
+    - manifest.json registra URL, ETag, Last-Modified, tamaño, SHA-256 y fecha
+      de descarga de cada archivo
+    - DOWNLOAD_WORKERS=N descarga hasta N archivos a la vez (default: 4)
+    - Una descarga interrumpida deja solo un archivo .part, nunca un ZIP a medias,
+      y se reanuda desde ahí (HTTP Range) en el reintento o la siguiente ejecución
     - Tamaño total aproximado: ~200 MB
     - Tiempo estimado: 5-10 minutos (depende de la conexión)
 """)
@@ -89,74 +98,19 @@ ESTADOS: Dict[str, str] = {
 BASE_URL = "https://repodatos.atdt.gob.mx/api_update/sepomex/codigos_postales_entidad_federativa"
 
 
-def download_file(url: str, output_path: Path) -> bool:
-    """
-    Descarga un archivo desde una URL y verifica su integridad
-
-    Args:
-        url: URL del archivo a descargar
-        output_path: Ruta donde guardar el archivo
-
-    Returns:
-        True si la descarga fue exitosa y el archivo es válido, False en caso contrario
-    """
-    try:
-        print(f"Descargando: {output_path.name}... ", end="", flush=True)
-
-        response = requests.get(url, stream=True, timeout=30)
-        response.raise_for_status()
-
-        # Crear directorio si no existe
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-
-        # Descargar archivo
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-
-        file_size = output_path.stat().st_size / (1024 * 1024)  # MB
-
-        # Verificar que el archivo ZIP es válido
-        import zipfile
-        try:
-            with zipfile.ZipFile(output_path, 'r') as zip_ref:
-                bad_file = zip_ref.testzip()
-                if bad_file:
-                    print(f"✗ ZIP corrupto (archivo dañado: {bad_file})")
-                    output_path.unlink()  # Eliminar archivo corrupto
-                    return False
-        except zipfile.BadZipFile:
-            print(f"✗ ZIP inválido")
-            output_path.unlink()  # Eliminar archivo corrupto
-            return False
-
-        print(f"✓ ({file_size:.2f} MB)")
-        return True
-
-    except requests.exceptions.RequestException as e:
-        print(f"✗ Error: {e}")
-        # Eliminar archivo parcial si existe
-        if output_path.exists():
-            output_path.unlink()
-        return False
-    except Exception as e:
-        print(f"✗ Error inesperado: {e}")
-        # Eliminar archivo parcial si existe
-        if output_path.exists():
-            output_path.unlink()
-        return False
-
-
 def main():
     """
     Descarga todos los shapefiles de códigos postales por entidad federativa
     """
     # Procesar argumentos
-    if len(sys.argv) > 1:
-        if sys.argv[1] in ['--help', '-h']:
+    refresh = False
+    for arg in sys.argv[1:]:
+        if arg in ['--help', '-h']:
             show_help()
+        elif arg == '--refresh':
+            refresh = True
         else:
-            print(f"Error: Opción desconocida '{sys.argv[1]}'")
+            print(f"Error: Opción desconocida '{arg}'")
             print("")
             print("Para ver opciones disponibles: python3 download_shapefiles.py --help")
             sys.exit(1)
@@ -164,6 +118,8 @@ def main():
     # Directorio de salida
     output_dir = Path("data/cp_shapefiles")
     output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_file = download_utils.manifest_path(output_dir)
+    manifest = download_utils.load_manifest(manifest_file)
 
     print(f"=== Descargador de Shapefiles de Códigos Postales SEPOMEX ===")
     print(f"Directorio de salida: {output_dir.absolute()}")
@@ -173,37 +129,48 @@ def main():
     exitosos = 0
     fallidos = 0
 
-    # Descargar cada archivo
+    # Archivos por descargar: (etiqueta, url, ruta)
+    pendientes = []
+
     for estado, abrev in ESTADOS.items():
         filename = f"CP_{abrev}.zip"
         url = f"{BASE_URL}/{filename}"
         output_path = output_dir / filename
 
-        # Verificar si el archivo ya existe y es válido
-        if output_path.exists():
-            import zipfile
+        # Verificar si el archivo ya existe y es válido: si coincide con el
+        # manifiesto (tamaño y fecha) ya se verificó al descargarlo
+        if output_path.exists() and not download_utils.matches_manifest(output_path, manifest.get(filename)):
             try:
-                with zipfile.ZipFile(output_path, 'r') as zip_ref:
-                    bad_file = zip_ref.testzip()
-                    if bad_file is None:
-                        # Archivo existe y es válido - saltar
-                        print(f"[✓] {estado:30s} (ya descargado)")
-                        exitosos += 1
-                        continue
-                    else:
-                        # Archivo existe pero está corrupto - eliminar y re-descargar
-                        print(f"[!] {estado:30s} (corrupto, re-descargando)")
-                        output_path.unlink()
-            except zipfile.BadZipFile:
-                # Archivo existe pero no es ZIP válido - eliminar y re-descargar
-                print(f"[!] {estado:30s} (inválido, re-descargando)")
+                zip_entries = download_utils.validate_zip(output_path)
+                # Archivo sin entrada vigente en el manifiesto: registrarlo tal como está
+                manifest[filename] = download_utils.manifest_entry(url, output_path, zip_entries=zip_entries)
+            except download_utils.InvalidZipError as e:
+                # Archivo existe pero está dañado - eliminar y re-descargar
+                print(f"[!] {estado:30s} ({e}, re-descargando)")
                 output_path.unlink()
 
-        # Descargar archivo (solo si no existe o estaba corrupto)
-        if download_file(url, output_path):
+        if output_path.exists():
+            if refresh:
+                # Archivo válido - pedirlo solo si cambió en el servidor
+                pendientes.append((estado, url, output_path))
+                continue
+            # Archivo existe y es válido - saltar
+            print(f"[✓] {estado:30s} (ya descargado)")
             exitosos += 1
-        else:
-            fallidos += 1
+            continue
+
+        # Descargar archivo (solo si no existe o estaba corrupto)
+        pendientes.append((estado, url, output_path))
+
+    download_utils.save_manifest(manifest_file, manifest)
+
+    if pendientes:
+        print(f"\nDescargando {len(pendientes)} archivos "
+              f"({download_utils.DOWNLOAD_WORKERS} simultáneos)...")
+        descargados, errores = download_utils.download_all(pendientes, timeout=30,
+                                                           manifest_file=manifest_file)
+        exitosos += descargados
+        fallidos += errores
 
     # Resumen
     print(f"\n=== Resumen ===")
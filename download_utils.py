@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+"""
+Utilidades compartidas por download_shapefiles.py y download_ageb_shapefiles.py
+Descargas concurrentes con una sesión HTTP keep-alive, límite de conexiones
+por host, progreso agregado, escritura atómica (archivo .part + rename) y
+reanudación con peticiones Range validadas con ETag/Last-Modified, un
+manifiesto (manifest.json) para volver a descargar solo archivos que cambiaron
+y verificación durante la descarga (SHA-256 incremental + directorio central
+del ZIP) en lugar de descomprimir el archivo completo con testzip()
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import zipfile
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from email.utils import formatdate
+from pathlib import Path
+from typing import List, Tuple
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+# Descargas simultáneas (hilos que comparten una sesión HTTP)
+# 1 = descargar un archivo a la vez
+DOWNLOAD_WORKERS = max(1, int(os.getenv('DOWNLOAD_WORKERS', '4') or '4'))
+
+# Conexiones simultáneas máximas contra un mismo host
+DOWNLOAD_PER_HOST = max(1, int(os.getenv('DOWNLOAD_PER_HOST', '4') or '4'))
+
+# Tamaño de los bloques leídos de la respuesta; un corte pierde a lo más el
+# bloque en curso, lo demás ya está en el .part
+CHUNK_SIZE = 64 * 1024
+
+# Sufijo del archivo temporal; solo se renombra al nombre final si el ZIP es válido
+PART_SUFFIX = '.part'
+
+# Validadores (URL, ETag, Last-Modified) del .part, para reanudarlo con Range
+PART_META_SUFFIX = '.part.json'
+
+# Reintentos tras un corte de conexión; cada uno reanuda desde lo ya recibido
+DOWNLOAD_RETRIES = max(0, int(os.getenv('DOWNLOAD_RETRIES', '3') or '3'))
+
+# Espera antes del primer reintento en segundos (se duplica en cada uno)
+RETRY_BACKOFF = 2
+
+# Manifiesto de cada directorio de descarga: {archivo: {url, etag,
+# last_modified, size, mtime_ns, sha256, zip_entries, downloaded_at}}
+# Un archivo con el mismo tamaño y mtime_ns que su entrada ya fue verificado
+MANIFEST_NAME = 'manifest.json'
+
+# Firma de la cabecera local de cada archivo dentro de un ZIP
+ZIP_LOCAL_HEADER = b'PK\x03\x04'
+
+# Errores de transferencia que justifican reanudar la descarga
+RETRYABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+
+class InvalidZipError(Exception):
+    """El archivo descargado no es un ZIP válido"""
+
+
+def create_session(pool_size: int = DOWNLOAD_WORKERS) -> requests.Session:
+    """Sesión HTTP keep-alive con un pool de conexiones para pool_size hilos"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def part_path(output_path: Path) -> Path:
+    """Ruta del archivo temporal de una descarga en curso"""
+    return output_path.with_name(output_path.name + PART_SUFFIX)
+
+
+def manifest_path(output_dir: Path) -> Path:
+    """Ruta del manifiesto de un directorio de descarga"""
+    return Path(output_dir) / MANIFEST_NAME
+
+
+def load_manifest(path: Path) -> dict:
+    """Lee un manifiesto; uno inexistente o ilegible equivale a vacío"""
+    try:
+        return json.loads(Path(path).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path: Path, manifest: dict):
+    """Escribe el manifiesto de forma atómica (archivo temporal + rename)"""
+    path = Path(path)
+    tmp_path = path.with_name(path.name + PART_SUFFIX)
+    tmp_path.write_text(json.dumps(manifest, indent=2, sort_keys=True, ensure_ascii=False))
+    os.replace(tmp_path, path)
+
+
+def _sha256_of(path: Path):
+    """Objeto hashlib SHA-256 con el contenido de un archivo leído por bloques"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest
+
+
+def file_sha256(path: Path) -> str:
+    """SHA-256 de un archivo leído por bloques"""
+    return _sha256_of(path).hexdigest()
+
+
+def manifest_entry(url: str, path: Path, etag: str = None, last_modified: str = None,
+                   sha256: str = None, zip_entries: int = None) -> dict:
+    """Entrada del manifiesto para un archivo ya descargado en path
+
+    sha256 es el calculado durante la descarga; sin él se lee el archivo.
+    downloaded_at es la fecha de modificación del archivo, de modo que los
+    archivos que ya estaban en disco conservan su fecha original.
+    """
+    stat = path.stat()
+    return {
+        'url': url,
+        'etag': etag,
+        'last_modified': last_modified,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': sha256 or file_sha256(path),
+        'zip_entries': zip_entries,
+        'downloaded_at': datetime.fromtimestamp(stat.st_mtime, timezone.utc).isoformat(timespec='seconds'),
+    }
+
+
+def matches_manifest(path: Path, entry: dict = None) -> bool:
+    """True si path tiene el tamaño y la fecha de su entrada (ya verificado)"""
+    if not entry or not path.exists():
+        return False
+    stat = path.stat()
+    return entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns
+
+
+def conditional_headers(output_path: Path, entry: dict = None) -> dict:
+    """Cabeceras para pedir output_path solo si cambió en el servidor
+
+    Usa el ETag y el Last-Modified del manifiesto; para archivos sin ellos
+    (descargados antes del manifiesto) usa la fecha de modificación local.
+    """
+    if not output_path.exists():
+        return {}
+    entry = entry or {}
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    headers['If-Modified-Since'] = (entry.get('last_modified')
+                                    or formatdate(output_path.stat().st_mtime, usegmt=True))
+    return headers
+
+
+def validate_zip(path: Path) -> int:
+    """Verifica el directorio central de un ZIP sin descomprimirlo
+
+    El directorio central debe leerse, no estar vacío y cada entrada debe
+    apuntar a una cabecera local dentro del archivo. No verifica el CRC de
+    los datos comprimidos: para eso está VALIDATE_ZIPS=full en la carga. El
+    SHA-256 del manifiesto identifica el archivo descargado, no lo valida.
+
+    Returns:
+        Número de entradas del ZIP (lanza InvalidZipError si está dañado)
+    """
+    try:
+        with zipfile.ZipFile(path, 'r') as zip_ref, open(path, 'rb') as f:
+            infos = zip_ref.infolist()
+            if not infos:
+                raise InvalidZipError("ZIP vacío")
+            size = os.fstat(f.fileno()).st_size
+            for info in infos:
+                f.seek(info.header_offset)
+                if (info.header_offset + info.compress_size > size
+                        or f.read(4) != ZIP_LOCAL_HEADER):
+                    raise InvalidZipError(f"ZIP corrupto (archivo dañado: {info.filename})")
+    except zipfile.BadZipFile:
+        raise InvalidZipError("ZIP inválido")
+    return len(infos)
+
+
+def part_meta_path(output_path: Path) -> Path:
+    """Ruta de los validadores del archivo temporal"""
+    return output_path.with_name(output_path.name + PART_META_SUFFIX)
+
+
+def discard_part(output_path: Path):
+    """Elimina el archivo temporal y sus validadores"""
+    part_path(output_path).unlink(missing_ok=True)
+    part_meta_path(output_path).unlink(missing_ok=True)
+
+
+def resume_validator(output_path: Path, url: str):
+    """
+    Validador para If-Range del .part de output_path, o None si no se puede reanudar
+
+    Se usa el ETag si es fuerte (If-Range no admite ETags débiles) y si no el
+    Last-Modified. Sin validador, o si el .part es de otra URL, no se reanuda:
+    el servidor podría tener ya otra versión del archivo.
+    """
+    tmp_path = part_path(output_path)
+    if not tmp_path.exists() or tmp_path.stat().st_size == 0:
+        return None
+    try:
+        meta = json.loads(part_meta_path(output_path).read_text())
+    except (OSError, ValueError):
+        return None
+    if meta.get('url') != url:
+        return None
+    etag = meta.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return meta.get('last_modified')
+
+
+def _range_start(response):
+    """Primer byte de una respuesta 206 según Content-Range (None si no es parcial)"""
+    if response.status_code != 206:
+        return None
+    content_range = response.headers.get('content-range') or ''
+    try:
+        return int(content_range.split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def _fetch_once(http, url: str, output_path: Path, timeout: int, on_chunk,
+                conditional: dict, digest: dict):
+    """Un intento de descarga a output_path.part, reanudando si es posible
+
+    digest ({'sha256', 'size'}) acumula el SHA-256 del .part entre intentos.
+    Retorna el tamaño del .part, o None si el servidor respondió 304 a las
+    cabeceras condicionales (el archivo actual sigue vigente).
+    """
+    tmp_path = part_path(output_path)
+    headers = dict(conditional or {})
+    offset = 0
+
+    validator = resume_validator(output_path, url)
+    if validator:
+        # Un .part pendiente ya es de una versión nueva: reanudarlo
+        offset = tmp_path.stat().st_size
+        headers = {'Range': f'bytes={offset}-', 'If-Range': validator}
+
+    response = http.get(url, stream=True, timeout=timeout, headers=headers)
+    try:
+        if offset and response.status_code == 416:
+            # El .part no corresponde al archivo del servidor: empezar de cero
+            discard_part(output_path)
+            return _fetch_once(http, url, output_path, timeout, on_chunk, conditional, digest)
+
+        if not offset and conditional and response.status_code == 304:
+            return None
+
+        response.raise_for_status()
+
+        # Crear directorio si no existe
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+
+        if offset and _range_start(response) == offset:
+            mode = 'ab'
+        else:
+            # 200: el servidor ignoró el Range o el archivo cambió (If-Range)
+            offset = 0
+            mode = 'wb'
+            part_meta_path(output_path).write_text(json.dumps({
+                'url': url,
+                'etag': response.headers.get('etag'),
+                'last_modified': response.headers.get('last-modified'),
+            }))
+
+        if mode == 'wb':
+            digest.update(sha256=hashlib.sha256(), size=0)
+        elif digest['size'] != offset:
+            # .part de una ejecución anterior: incorporar lo ya descargado
+            digest.update(sha256=_sha256_of(tmp_path), size=offset)
+
+        content_length = response.headers.get('content-length')
+        expected = offset + int(content_length) if content_length else None
+
+        with open(tmp_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                digest['sha256'].update(chunk)
+                digest['size'] += len(chunk)
+                if on_chunk:
+                    on_chunk(len(chunk))
+    finally:
+        response.close()
+
+    size = tmp_path.stat().st_size
+    if expected is not None and size != expected:
+        raise requests.exceptions.ConnectionError(
+            f"descarga incompleta ({size} de {expected} bytes)")
+    return size
+
+
+def fetch_to_file(url: str, output_path: Path, session=None, timeout: int = 30,
+                  on_chunk=None, previous: dict = None):
+    """
+    Descarga url a output_path de forma atómica y reanudable
+
+    El contenido se escribe siempre en output_path.part, por bloques (memoria
+    constante sin importar el tamaño del archivo), calculando su SHA-256 al
+    vuelo, y solo se renombra a output_path cuando el directorio central del
+    ZIP es válido (sin descomprimirlo: ver validate_zip). Si la conexión se corta, se reintenta
+    hasta DOWNLOAD_RETRIES veces pidiendo solo los bytes faltantes (Range +
+    If-Range); si aun así falla, el .part se conserva para reanudarlo en la
+    siguiente ejecución.
+
+    Si output_path ya existe la petición es condicional (If-None-Match /
+    If-Modified-Since con los datos de previous) y el archivo solo se
+    reemplaza si cambió en el servidor.
+
+    Args:
+        url: URL del archivo a descargar
+        output_path: Ruta final del archivo
+        session: Sesión HTTP compartida (None = requests.get sin sesión)
+        timeout: Timeout de conexión/lectura en segundos
+        on_chunk: Callback opcional con el número de bytes de cada bloque
+        previous: Entrada del manifiesto del archivo actual, si la hay
+
+    Returns:
+        Entrada del manifiesto del archivo descargado (ver manifest_entry),
+        o None si el archivo existente no cambió (304)
+    """
+    http = session or requests
+    conditional = conditional_headers(output_path, previous)
+    digest = {'sha256': None, 'size': None}
+
+    attempt = 0
+    while True:
+        try:
+            if _fetch_once(http, url, output_path, timeout, on_chunk, conditional, digest) is None:
+                return None
+            break
+        except RETRYABLE_ERRORS:
+            if attempt >= DOWNLOAD_RETRIES:
+                raise
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+            attempt += 1
+
+    tmp_path = part_path(output_path)
+    try:
+        zip_entries = validate_zip(tmp_path)
+    except InvalidZipError:
+        discard_part(output_path)
+        raise
+
+    try:
+        meta = json.loads(part_meta_path(output_path).read_text())
+    except (OSError, ValueError):
+        meta = {}
+    os.replace(tmp_path, output_path)
+    part_meta_path(output_path).unlink(missing_ok=True)
+
+    return manifest_entry(url, output_path, meta.get('etag'), meta.get('last_modified'),
+                          sha256=digest['sha256'].hexdigest(), zip_entries=zip_entries)
+
+
+class DownloadProgress:
+    """Progreso agregado de varias descargas simultáneas (seguro entre hilos)"""
+
+    def __init__(self, total_files: int, stream=None, interval: float = 0.5):
+        self.total_files = total_files
+        self.done_files = 0
+        self.bytes = 0
+        self.stream = stream or sys.stdout
+        self.interval = interval
+        self.live = self.stream.isatty()
+        self._started = time.monotonic()
+        self._last_render = 0.0
+        self._lock = threading.Lock()
+
+    def _line(self) -> str:
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        mb = self.bytes / (1024 * 1024)
+        return (f"Progreso: {self.done_files}/{self.total_files} archivos, "
+                f"{mb:.1f} MB ({mb / elapsed:.1f} MB/s)")
+
+    def add_bytes(self, count: int):
+        """Suma bytes recibidos; en terminal refresca la línea de progreso"""
+        with self._lock:
+            self.bytes += count
+            now = time.monotonic()
+            if self.live and now - self._last_render >= self.interval:
+                self._last_render = now
+                self.stream.write(f"\r{self._line()}")
+                self.stream.flush()
+
+    def finish_file(self, message: str):
+        """Imprime el resultado de un archivo seguido del progreso agregado"""
+        with self._lock:
+            self.done_files += 1
+            if self.live:
+                self.stream.write(f"\r\033[K{message}\n{self._line()}")
+            else:
+                self.stream.write(f"{message}  [{self._line()}]\n")
+            self.stream.flush()
+
+    def close(self):
+        if self.live:
+            with self._lock:
+                self.stream.write("\n")
+                self.stream.flush()
+
+
+def download_all(jobs: List[Tuple[str, str, Path]], timeout: int = 30,
+                 workers: int = DOWNLOAD_WORKERS, per_host: int = DOWNLOAD_PER_HOST,
+                 stream=None, manifest_file: Path = None) -> Tuple[int, int]:
+    """
+    Descarga varios archivos con un pool de hilos y una sesión HTTP compartida
+
+    Como máximo `workers` descargas en curso y `per_host` contra un mismo
+    host. Cada archivo se escribe de forma atómica con fetch_to_file().
+
+    Con manifest_file, los archivos que ya existen se piden de forma
+    condicional con los datos del manifiesto (un 304 cuenta como exitoso) y el
+    manifiesto se actualiza tras cada descarga.
+
+    Args:
+        jobs: Lista de (etiqueta, url, output_path)
+        timeout: Timeout de conexión/lectura en segundos
+        workers: Descargas simultáneas máximas
+        per_host: Descargas simultáneas máximas por host
+        stream: Salida para el progreso (default: sys.stdout)
+        manifest_file: Ruta de manifest.json (None = sin manifiesto)
+
+    Returns:
+        Tupla (exitosos, fallidos)
+    """
+    if not jobs:
+        return 0, 0
+
+    workers = max(1, min(workers, len(jobs)))
+    progress = DownloadProgress(len(jobs), stream=stream)
+    host_limits = {}
+    host_limits_lock = threading.Lock()
+    manifest = load_manifest(manifest_file) if manifest_file else {}
+    manifest_lock = threading.Lock()
+
+    def host_slot(url):
+        host = urlsplit(url).netloc
+        with host_limits_lock:
+            if host not in host_limits:
+                host_limits[host] = threading.BoundedSemaphore(per_host)
+            return host_limits[host]
+
+    def job(session, etiqueta, url, output_path):
+        with manifest_lock:
+            previous = manifest.get(output_path.name)
+        with host_slot(url):
+            try:
+                entry = fetch_to_file(url, output_path, session=session, timeout=timeout,
+                                      on_chunk=progress.add_bytes, previous=previous)
+            except InvalidZipError as e:
+                progress.finish_file(f"[✗] {etiqueta:30s} {e}")
+                return False
+            except requests.exceptions.RequestException as e:
+                progress.finish_file(f"[✗] {etiqueta:30s} Error: {e}")
+                return False
+            except Exception as e:
+                progress.finish_file(f"[✗] {etiqueta:30s} Error inesperado: {e}")
+                return False
+        if entry is None:
+            progress.finish_file(f"[=] {etiqueta:30s} (sin cambios)")
+            return True
+        if manifest_file:
+            with manifest_lock:
+                manifest[output_path.name] = entry
+                save_manifest(manifest_file, manifest)
+        progress.finish_file(f"[✓] {etiqueta:30s} ({entry['size'] / (1024 * 1024):.1f} MB)")
+        return True
+
+    exitosos = 0
+    fallidos = 0
+    with create_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(job, session, etiqueta, url, output_path)
+                   for etiqueta, url, output_path in jobs]
+        for future in as_completed(futures):
+            if future.result():
+                exitosos += 1
+            else:
+                fallidos += 1
+    progress.close()
+
+    return exitosos, fallidos
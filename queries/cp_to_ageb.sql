@@ -35,7 +35,8 @@ SELECT * FROM inegi.ageb_urbana_01 LIMIT 1;
 -- Ejemplo para Jalisco (Guadalajara, CP 44100), ajusta los nombres de tabla según tu estado
 -- ⚠️ IMPORTANTE: Los shapefiles usan diferentes SRIDs
 --    SEPOMEX: 900917, INEGI urbana: 900919, INEGI rural: 6372
---    Usar ST_Transform(..., 6372) para unificar a EPSG:6372
+--    Usar la columna geom_6372 (EPSG:6372, con índice GiST) creada por el
+--    cargador (CANONICAL_GEOM=true) en lugar de ST_Transform(geom, 6372)
 
 -- ⚙️ DEFINIR CÓDIGO POSTAL A BUSCAR:
 WITH search_params AS (
@@ -44,15 +45,15 @@ WITH search_params AS (
 SELECT
     cp.d_cp as codigo_postal,
     ageb.cvegeo as clave_ageb,
-    ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))) /
-    ST_Area(ST_Transform(cp.geom, 6372)) * 100 as porcentaje_interseccion
+    ST_Area(ST_Intersection(cp.geom_6372, ageb.geom_6372)) /
+    ST_Area(cp.geom_6372) * 100 as porcentaje_interseccion
 FROM
     sepomex.cp_14_cp_jal cp
 CROSS JOIN
     inegi.ageb_urbana_14 ageb,
     search_params
 WHERE
-    ST_Intersects(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))
+    ST_Intersects(cp.geom_6372, ageb.geom_6372)
     AND cp.d_cp = search_params.codigo_postal_busqueda
 ORDER BY
     porcentaje_interseccion DESC;
@@ -63,7 +64,7 @@ ORDER BY
 -- ----------------------------------------------------------------------------
 
 -- Buscar en AGEBs urbanas Y rurales para un código postal
--- ⚠️ IMPORTANTE: Usar ST_Transform(..., 6372) para unificar SRIDs mixtos
+-- ⚠️ IMPORTANTE: Usar geom_6372 para unificar SRIDs mixtos
 
 -- ⚙️ DEFINIR CÓDIGO POSTAL A BUSCAR:
 WITH search_params AS (
@@ -72,7 +73,7 @@ WITH search_params AS (
 cp_geom AS (
     SELECT
         d_cp as codigo_postal,
-        ST_Transform(geom, 6372) as geom
+        geom_6372 as geom
     FROM sepomex.cp_14_cp_jal
     WHERE d_cp = (SELECT codigo_postal_busqueda FROM search_params)
 ),
@@ -80,21 +81,21 @@ agebs_urbanas AS (
     SELECT
         'urbana' as tipo,
         ageb.cvegeo as clave_ageb,
-        ST_Transform(ageb.geom, 6372) as geom,
+        ageb.geom_6372 as geom,
         cp.codigo_postal
     FROM cp_geom cp
     CROSS JOIN inegi.ageb_urbana_14 ageb
-    WHERE ST_Intersects(cp.geom, ST_Transform(ageb.geom, 6372))
+    WHERE ST_Intersects(cp.geom, ageb.geom_6372)
 ),
 agebs_rurales AS (
     SELECT
         'rural' as tipo,
         ageb.cvegeo as clave_ageb,
-        ageb.geom,  -- Ya usa SRID 6372
+        ageb.geom_6372 as geom,
         cp.codigo_postal
     FROM cp_geom cp
     CROSS JOIN inegi.ageb_rural_14 ageb
-    WHERE ST_Intersects(cp.geom, ageb.geom)
+    WHERE ST_Intersects(cp.geom, ageb.geom_6372)
 )
 SELECT
     codigo_postal,
@@ -119,16 +120,16 @@ ORDER BY area_interseccion_m2 DESC;
 
 -- Mapear TODOS los códigos postales a sus AGEBs correspondientes
 -- Ejemplo para Jalisco - ajustar tablas según el estado deseado
--- ⚠️ IMPORTANTE: Usar ST_Transform(..., 6372) para unificar SRIDs mixtos
+-- ⚠️ IMPORTANTE: Usar geom_6372 para unificar SRIDs mixtos
 SELECT
     cp.d_cp as codigo_postal,
     ageb.cvegeo as clave_ageb,
     'urbana' as tipo_ageb,
-    ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))) /
-    ST_Area(ST_Transform(cp.geom, 6372)) * 100 as porcentaje_interseccion,
+    ST_Area(ST_Intersection(cp.geom_6372, ageb.geom_6372)) /
+    ST_Area(cp.geom_6372) * 100 as porcentaje_interseccion,
     CASE
-        WHEN ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))) /
-             ST_Area(ST_Transform(cp.geom, 6372)) > 0.5
+        WHEN ST_Area(ST_Intersection(cp.geom_6372, ageb.geom_6372)) /
+             ST_Area(cp.geom_6372) > 0.5
         THEN 'principal'
         ELSE 'parcial'
     END as tipo_relacion
@@ -137,9 +138,9 @@ FROM
 CROSS JOIN
     inegi.ageb_urbana_14 ageb
 WHERE
-    ST_Intersects(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))
-    AND ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))) /
-        ST_Area(ST_Transform(cp.geom, 6372)) > 0.01  -- Al menos 1% de intersección
+    ST_Intersects(cp.geom_6372, ageb.geom_6372)
+    AND ST_Area(ST_Intersection(cp.geom_6372, ageb.geom_6372)) /
+        ST_Area(cp.geom_6372) > 0.01  -- Al menos 1% de intersección
 
 UNION ALL
 
@@ -147,11 +148,11 @@ SELECT
     cp.d_cp as codigo_postal,
     ageb.cvegeo as clave_ageb,
     'rural' as tipo_ageb,
-    ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ageb.geom)) /
-    ST_Area(ST_Transform(cp.geom, 6372)) * 100 as porcentaje_interseccion,
+    ST_Area(ST_Intersection(cp.geom_6372, ageb.geom_6372)) /
+    ST_Area(cp.geom_6372) * 100 as porcentaje_interseccion,
     CASE
-        WHEN ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ageb.geom)) /
-             ST_Area(ST_Transform(cp.geom, 6372)) > 0.5
+        WHEN ST_Area(ST_Intersection(cp.geom_6372, ageb.geom_6372)) /
+             ST_Area(cp.geom_6372) > 0.5
         THEN 'principal'
         ELSE 'parcial'
     END as tipo_relacion
@@ -160,9 +161,9 @@ FROM
 CROSS JOIN
     inegi.ageb_rural_14 ageb
 WHERE
-    ST_Intersects(ST_Transform(cp.geom, 6372), ageb.geom)
-    AND ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ageb.geom)) /
-        ST_Area(ST_Transform(cp.geom, 6372)) > 0.01
+    ST_Intersects(cp.geom_6372, ageb.geom_6372)
+    AND ST_Area(ST_Intersection(cp.geom_6372, ageb.geom_6372)) /
+        ST_Area(cp.geom_6372) > 0.01
 
 ORDER BY codigo_postal, porcentaje_interseccion DESC;
 
@@ -188,7 +189,7 @@ CREATE INDEX IF NOT EXISTS idx_cp_to_ageb_ageb ON public.cp_to_ageb_mapping(clav
 CREATE INDEX IF NOT EXISTS idx_cp_to_ageb_estado ON public.cp_to_ageb_mapping(estado_cve);
 
 -- Insertar datos de Jalisco (replicar para cada estado)
--- ⚠️ IMPORTANTE: Usar ST_Transform(..., 6372) para unificar SRIDs mixtos
+-- ⚠️ IMPORTANTE: Usar geom_6372 para unificar SRIDs mixtos
 INSERT INTO public.cp_to_ageb_mapping (
     estado_cve, codigo_postal,
     clave_ageb, tipo_ageb, porcentaje_interseccion, tipo_relacion
@@ -198,11 +199,11 @@ SELECT
     cp.d_cp,
     ageb.cvegeo,
     'urbana',
-    ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))) /
-    ST_Area(ST_Transform(cp.geom, 6372)) * 100,
+    ST_Area(ST_Intersection(cp.geom_6372, ageb.geom_6372)) /
+    ST_Area(cp.geom_6372) * 100,
     CASE
-        WHEN ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))) /
-             ST_Area(ST_Transform(cp.geom, 6372)) > 0.5
+        WHEN ST_Area(ST_Intersection(cp.geom_6372, ageb.geom_6372)) /
+             ST_Area(cp.geom_6372) > 0.5
         THEN 'principal'
         ELSE 'parcial'
     END
@@ -211,9 +212,9 @@ FROM
 CROSS JOIN
     inegi.ageb_urbana_14 ageb
 WHERE
-    ST_Intersects(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))
-    AND ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))) /
-        ST_Area(ST_Transform(cp.geom, 6372)) > 0.01;
+    ST_Intersects(cp.geom_6372, ageb.geom_6372)
+    AND ST_Area(ST_Intersection(cp.geom_6372, ageb.geom_6372)) /
+        ST_Area(cp.geom_6372) > 0.01;
 
 -- Repetir para AGEBs rurales y para cada estado
 
@@ -7,39 +7,26 @@ DO $$
 DECLARE
     codigo_postal_busqueda TEXT := '44100';  -- Cambiar aquí el CP a buscar
     estado_cve TEXT;
-    tabla_cp TEXT;
     tabla_cp_final TEXT;
     tabla_ageb_urbana TEXT;
     tabla_ageb_rural TEXT;
+    geom_cp TEXT;
+    geom_urbana TEXT;
+    geom_rural TEXT;
     query_dinamico TEXT;
-    tabla_record RECORD;
-    cp_count INTEGER;
 BEGIN
     -- Paso 1: Buscar en qué entidad está el código postal
     RAISE NOTICE 'Buscando código postal: %', codigo_postal_busqueda;
 
-    -- Buscar en todas las tablas de SEPOMEX
-    FOR tabla_record IN
-        SELECT table_name
-        FROM information_schema.tables
-        WHERE table_schema = 'sepomex'
-          AND table_name LIKE 'cp_%'
-        ORDER BY table_name
-    LOOP
-        tabla_cp := tabla_record.table_name;
-
-        -- Verificar si el CP existe en esta tabla usando un contador
-        EXECUTE format('SELECT COUNT(*) FROM sepomex.%I WHERE d_cp = %L',
-                      tabla_cp, codigo_postal_busqueda)
-        INTO cp_count;
-
-        IF cp_count > 0 THEN
-            -- Extraer el código de estado (2 dígitos después de cp_)
-            estado_cve := substring(tabla_cp from 'cp_(\d{2})_');
-            tabla_cp_final := tabla_cp;
-            EXIT;
-        END IF;
-    END LOOP;
+    -- Resolver la entidad con el directorio de CPs (public.cp_directory)
+    -- Si el CP existe en varias entidades se usa la primera; la función
+    -- buscar_agebs_por_cp() devuelve los AGEBs de todas
+    SELECT d.cve_ent, d.source_table
+    INTO estado_cve, tabla_cp_final
+    FROM public.cp_directory d
+    WHERE d.d_cp = codigo_postal_busqueda
+    ORDER BY d.cve_ent, d.source_table
+    LIMIT 1;
 
     IF estado_cve IS NULL THEN
         RAISE EXCEPTION 'Código postal % no encontrado en ninguna entidad', codigo_postal_busqueda;
@@ -56,6 +43,20 @@ BEGIN
     RAISE NOTICE '  AGEB Urbana: inegi.%', tabla_ageb_urbana;
     RAISE NOTICE '  AGEB Rural: inegi.%', tabla_ageb_rural;
 
+    -- Geometría en EPSG:6372 de cada tabla: geom_6372 si el cargador la creó
+    -- (CANONICAL_GEOM=true); si no, se transforma geom al vuelo
+    SELECT
+        CASE WHEN bool_or(table_schema = 'sepomex' AND table_name = tabla_cp_final)
+             THEN 'geom_6372' ELSE 'ST_Transform(geom, 6372)' END,
+        CASE WHEN bool_or(table_schema = 'inegi' AND table_name = tabla_ageb_urbana)
+             THEN 'geom_6372' ELSE 'ST_Transform(geom, 6372)' END,
+        CASE WHEN bool_or(table_schema = 'inegi' AND table_name = tabla_ageb_rural)
+             THEN 'geom_6372' ELSE 'ST_Transform(geom, 6372)' END
+    INTO geom_cp, geom_urbana, geom_rural
+    FROM information_schema.columns
+    WHERE column_name = 'geom_6372'
+      AND table_schema IN ('sepomex', 'inegi');
+
     -- Paso 3: Ejecutar query dinámico
     query_dinamico := format($q$
         WITH cp_ageb_intersections AS (
@@ -63,12 +64,11 @@ BEGIN
               cp.d_cp as codigo_postal,
               ageb.cvegeo as clave_ageb,
               'urbana' as tipo_ageb,
-              ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))) /
-              ST_Area(ST_Transform(cp.geom, 6372)) * 100 as porcentaje
-          FROM sepomex.%I cp
-          JOIN inegi.%I ageb
-            ON ST_Intersects(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))
-          WHERE cp.d_cp = %L
+              ST_Area(ST_Intersection(cp.geom_6372, ageb.geom_6372)) /
+              ST_Area(cp.geom_6372) * 100 as porcentaje
+          FROM (SELECT d_cp, %s AS geom_6372 FROM sepomex.%I WHERE d_cp = %L) cp
+          JOIN (SELECT cvegeo, %s AS geom_6372 FROM inegi.%I) ageb
+            ON ST_Intersects(cp.geom_6372, ageb.geom_6372)
 
           UNION ALL
 
@@ -76,12 +76,11 @@ BEGIN
               cp.d_cp,
               ageb.cvegeo,
               'rural' as tipo_ageb,
-              ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ageb.geom)) /
-              ST_Area(ST_Transform(cp.geom, 6372)) * 100 as porcentaje
-          FROM sepomex.%I cp
-          JOIN inegi.%I ageb
-            ON ST_Intersects(ST_Transform(cp.geom, 6372), ageb.geom)
-          WHERE cp.d_cp = %L
+              ST_Area(ST_Intersection(cp.geom_6372, ageb.geom_6372)) /
+              ST_Area(cp.geom_6372) * 100 as porcentaje
+          FROM (SELECT d_cp, %s AS geom_6372 FROM sepomex.%I WHERE d_cp = %L) cp
+          JOIN (SELECT cvegeo, %s AS geom_6372 FROM inegi.%I) ageb
+            ON ST_Intersects(cp.geom_6372, ageb.geom_6372)
         )
         SELECT
             codigo_postal,
@@ -92,8 +91,8 @@ BEGIN
         WHERE porcentaje > 0.01
         ORDER BY porcentaje DESC;
     $q$,
-    tabla_cp_final, tabla_ageb_urbana, codigo_postal_busqueda,
-    tabla_cp_final, tabla_ageb_rural, codigo_postal_busqueda);
+    geom_cp, tabla_cp_final, codigo_postal_busqueda, geom_urbana, tabla_ageb_urbana,
+    geom_cp, tabla_cp_final, codigo_postal_busqueda, geom_rural, tabla_ageb_rural);
 
     -- Ejecutar y mostrar resultados
     RAISE NOTICE 'Ejecutando query...';
@@ -1,103 +1,335 @@
 -- ============================================================================
--- Función: buscar_agebs_por_cp
--- Busca automáticamente los AGEBs de un código postal en cualquier entidad
+-- Funciones: buscar_agebs_por_cp / buscar_agebs_por_cps
+-- Busca automáticamente los AGEBs de uno o muchos códigos postales en
+-- cualquier entidad
 -- ============================================================================
 
-CREATE OR REPLACE FUNCTION buscar_agebs_por_cp(codigo_postal_busqueda TEXT)
+-- ----------------------------------------------------------------------------
+-- consulta_agebs_en_vivo (uso interno)
+-- Construye el query de intersección CP × AGEB de una entidad para los CPs
+-- del parámetro $1 (TEXT[]). Solo se reproyectan los CPs al SRID de la
+-- columna indexada del AGEB, de modo que ST_Intersects usa el índice GiST, y
+-- la intersección se calcula una sola vez por par (CTE materializado).
+-- Con SET cp2ageb.usar_subdivision = on y las piezas de subdiv cargadas
+-- (SUBDIVIDE_GEOM=true) el cruce se hace pieza contra pieza y el área se
+-- suma por CP/AGEB original. Si la entidad tiene partición en inegi.ageb
+-- se usa esa capa en lugar de las tablas ageb_urbana_XX / ageb_rural_XX, y
+-- si la tiene en sepomex.cp los CPs se leen de ahí.
+-- Retorna NULL si la entidad no tiene tablas de AGEBs.
+-- ----------------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION consulta_agebs_en_vivo(estado_cve TEXT, tabla_cp TEXT)
+RETURNS TEXT AS $$
+DECLARE
+    cp_geom_expr TEXT;
+    cp_cte TEXT;
+    usar_piezas BOOLEAN;
+    usar_unificada BOOLEAN;
+    tabla_ageb TEXT;
+    tipo TEXT;
+    ageb_tabla TEXT;
+    ageb_col TEXT;
+    ageb_fid TEXT;
+    ageb_srid INTEGER;
+    cp_probe TEXT;
+    area_cp_expr TEXT;
+    area_ageb_expr TEXT;
+    area_clip_expr TEXT;
+    area_expr TEXT;
+    ramas TEXT[] := '{}';
+BEGIN
+    -- Geometría del CP en EPSG:6372 (geom_6372 si el cargador la creó)
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_schema = 'sepomex' AND table_name = tabla_cp
+                 AND column_name = 'geom_6372') THEN
+        cp_geom_expr := 'geom_6372';
+    ELSE
+        cp_geom_expr := 'ST_Transform(geom, 6372)';
+    END IF;
+
+    usar_piezas := coalesce(current_setting('cp2ageb.usar_subdivision', true), '') IN ('on', 'true', '1')
+                   AND to_regclass(format('subdiv.%I', tabla_cp)) IS NOT NULL;
+
+    IF usar_piezas THEN
+        -- Una fila por pieza del CP; area es la del CP completo
+        cp_cte := format($q$
+            SELECT c.ogc_fid, c.d_cp, p.geom, c.area
+            FROM (SELECT ogc_fid, d_cp, ST_Area(%1$s) AS area
+                  FROM sepomex.%2$I WHERE d_cp = ANY ($1)) c
+            JOIN subdiv.%2$I p ON p.parent_fid = c.ogc_fid
+        $q$, cp_geom_expr, tabla_cp);
+        area_cp_expr := 'ST_Area(cp.geom)';
+    ELSIF to_regclass(format('sepomex.%I', 'cp_estado_' || estado_cve)) IS NOT NULL THEN
+        -- Capa unificada sepomex.cp: geom ya está en EPSG:6372 y cve_ent = $2
+        -- deja solo la partición del estado
+        cp_cte := format($q$
+            SELECT d_cp, geom, ST_Area(geom) AS area
+            FROM sepomex.cp
+            WHERE cve_ent = $2 AND source_table = %L AND d_cp = ANY ($1)
+        $q$, tabla_cp);
+        area_cp_expr := 'cp.area';
+    ELSE
+        cp_cte := format($q$
+            SELECT d_cp, geom, ST_Area(geom) AS area
+            FROM (SELECT d_cp, %s AS geom FROM sepomex.%I WHERE d_cp = ANY ($1)) c
+        $q$, cp_geom_expr, tabla_cp);
+        area_cp_expr := 'cp.area';
+    END IF;
+
+    -- Capa unificada inegi.ageb (UNIFIED_LAYERS): una sola rama estática;
+    -- cve_ent = $2 deja solo la partición del estado
+    usar_unificada := NOT usar_piezas
+                      AND to_regclass(format('inegi.%I', 'ageb_estado_' || estado_cve)) IS NOT NULL;
+
+    IF usar_unificada THEN
+        ramas := ARRAY[$q$
+            SELECT cp.d_cp, ageb.cvegeo, ageb.tipo AS tipo_ageb, cp.area,
+                   CASE
+                       WHEN ST_Covers(cp.geom, ageb.geom) THEN ST_Area(ageb.geom)
+                       WHEN ST_CoveredBy(cp.geom, ageb.geom) THEN cp.area
+                       ELSE ST_Area(ST_Intersection(cp.geom, ageb.geom))
+                   END AS area_interseccion
+            FROM cp
+            JOIN inegi.ageb ageb ON ageb.cve_ent = $2 AND ST_Intersects(cp.geom, ageb.geom)
+        $q$];
+    ELSE
+        -- Una rama por tabla de AGEBs existente; la tabla de AGEBs nunca se transforma
+        FOREACH tipo IN ARRAY ARRAY['urbana', 'rural'] LOOP
+            tabla_ageb := 'ageb_' || tipo || '_' || estado_cve;
+            CONTINUE WHEN to_regclass(format('inegi.%I', tabla_ageb)) IS NULL;
+
+            IF usar_piezas AND to_regclass(format('subdiv.%I', tabla_ageb)) IS NOT NULL THEN
+                ageb_tabla := format('subdiv.%I', tabla_ageb);
+                ageb_col := 'geom';
+                ageb_fid := 'parent_fid';
+                cp_probe := 'cp.geom';
+                area_ageb_expr := 'ST_Area(ageb.geom)';
+                area_clip_expr := 'ST_Area(ST_Intersection(cp.geom, ageb.geom))';
+            ELSIF EXISTS (SELECT 1 FROM information_schema.columns
+                          WHERE table_schema = 'inegi' AND table_name = tabla_ageb
+                            AND column_name = 'geom_6372') THEN
+                ageb_tabla := format('inegi.%I', tabla_ageb);
+                ageb_col := 'geom_6372';
+                ageb_fid := 'ogc_fid';
+                cp_probe := 'cp.geom';
+                area_ageb_expr := 'ST_Area(ageb.geom_6372)';
+                area_clip_expr := 'ST_Area(ST_Intersection(cp.geom, ageb.geom_6372))';
+            ELSE
+                ageb_tabla := format('inegi.%I', tabla_ageb);
+                ageb_srid := Find_SRID('inegi', tabla_ageb, 'geom');
+                ageb_col := 'geom';
+                ageb_fid := 'ogc_fid';
+                cp_probe := format('ST_Transform(cp.geom, %s)', ageb_srid);
+                area_ageb_expr := 'ST_Area(ST_Transform(ageb.geom, 6372))';
+                area_clip_expr := format('ST_Area(ST_Transform(ST_Intersection(%s, ageb.geom), 6372))', cp_probe);
+            END IF;
+
+            -- Ruta rápida por contención: si el CP cubre al AGEB (o al revés) el
+            -- área de intersección ya se conoce; ST_Intersection solo se ejecuta
+            -- para los pares que cruzan el borde
+            area_expr := format($e$
+                CASE
+                    WHEN ST_Covers(%1$s, ageb.%2$I) THEN %3$s
+                    WHEN ST_CoveredBy(%1$s, ageb.%2$I) THEN %4$s
+                    ELSE %5$s
+                END$e$, cp_probe, ageb_col, area_ageb_expr, area_cp_expr, area_clip_expr);
+
+            IF usar_piezas THEN
+                -- Piezas disjuntas: la suma por par original es el área exacta
+                ramas := ramas || format($q$
+                    SELECT cp.d_cp, ageb.cvegeo, %L AS tipo_ageb, cp.area, SUM(%s) AS area_interseccion
+                    FROM cp
+                    JOIN %s ageb ON ST_Intersects(%s, ageb.%I)
+                    GROUP BY cp.ogc_fid, cp.d_cp, cp.area, ageb.%I, ageb.cvegeo
+                $q$, tipo, area_expr, ageb_tabla, cp_probe, ageb_col, ageb_fid);
+            ELSE
+                ramas := ramas || format($q$
+                    SELECT cp.d_cp, ageb.cvegeo, %L AS tipo_ageb, cp.area, %s AS area_interseccion
+                    FROM cp
+                    JOIN %s ageb ON ST_Intersects(%s, ageb.%I)
+                $q$, tipo, area_expr, ageb_tabla, cp_probe, ageb_col);
+            END IF;
+        END LOOP;
+    END IF;
+
+    IF array_length(ramas, 1) IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    RETURN format($q$
+        WITH cp AS MATERIALIZED (
+            %s
+        ),
+        pares AS MATERIALIZED (
+            %s
+        )
+        SELECT
+            d_cp::TEXT,
+            cvegeo::TEXT,
+            tipo_ageb::TEXT,
+            ROUND((area_interseccion / area * 100)::numeric, 2),
+            'en_vivo'::TEXT
+        FROM pares
+        WHERE area_interseccion / NULLIF(area, 0) * 100 > 0.01
+        ORDER BY 1, 4 DESC
+    $q$, cp_cte, array_to_string(ramas, ' UNION ALL '));
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- ----------------------------------------------------------------------------
+-- buscar_agebs_por_cps: búsqueda por lotes
+-- Agrupa los CPs por entidad (public.cp_directory) y ejecuta una sola
+-- consulta por entidad: lectura de public.cp_to_ageb_mapping si la entidad ya
+-- fue mapeada (create_cp_ageb_mapping.py; la tabla compacta si la entidad está
+-- en ella con el mismo mapped_at) o intersección en vivo, una por cada tabla
+-- de CPs de la entidad, si no.
+-- Cada fila trae el CP de entrada y la fuente ('mapeo' o 'en_vivo'); los CPs
+-- que no existen en ninguna entidad no aparecen en el resultado.
+-- ----------------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION buscar_agebs_por_cps(codigos_postales TEXT[])
 RETURNS TABLE (
     codigo_postal TEXT,
     clave_ageb TEXT,
     tipo_ageb TEXT,
-    porcentaje_interseccion NUMERIC
+    porcentaje_interseccion NUMERIC,
+    fuente TEXT
 ) AS $$
 DECLARE
-    estado_cve TEXT;
-    tabla_cp TEXT;
-    tabla_ageb_urbana TEXT;
-    tabla_ageb_rural TEXT;
+    -- Tablas de estado anteriores a umbral_porcentaje: todo se calcula en vivo
+    hay_mapeo BOOLEAN := EXISTS (SELECT 1 FROM information_schema.columns
+                                 WHERE table_schema = 'public'
+                                   AND table_name = 'cp_to_ageb_mapping_status'
+                                   AND column_name = 'umbral_porcentaje');
+    -- Tablas compactas anteriores a estado_cve: se lee cp_to_ageb_mapping
+    hay_compacto BOOLEAN := to_regclass('public.cp_to_ageb_mapping_compact_status') IS NOT NULL
+                            AND EXISTS (SELECT 1 FROM information_schema.columns
+                                        WHERE table_schema = 'public'
+                                          AND table_name = 'cp_to_ageb_mapping_compact'
+                                          AND column_name = 'estado_cve');
+    mapeado BOOLEAN;
+    compactado BOOLEAN;
     query_dinamico TEXT;
-    tabla_record RECORD;
-    cp_count INTEGER;
+    grupo RECORD;
+    tabla_cp TEXT;
 BEGIN
-    -- Paso 1: Buscar en qué entidad está el código postal
-    FOR tabla_record IN
-        SELECT table_name
-        FROM information_schema.tables
-        WHERE table_schema = 'sepomex'
-          AND table_name LIKE 'cp_%'
-        ORDER BY table_name
+    -- Un grupo por entidad: el mapeo guarda una fila por CP/AGEB del estado,
+    -- sin importar de qué tabla de CPs salió
+    FOR grupo IN
+        SELECT d.cve_ent,
+               array_agg(DISTINCT d.d_cp::TEXT) AS cps,
+               array_agg(DISTINCT d.source_table::TEXT) AS tablas
+        FROM public.cp_directory d
+        WHERE d.d_cp = ANY (codigos_postales)
+        GROUP BY d.cve_ent
+        ORDER BY d.cve_ent
     LOOP
-        tabla_cp := tabla_record.table_name;
+        -- Estados ya mapeados se sirven desde la tabla de mapeo (lectura por
+        -- índice, sin cálculo espacial), solo si se guardaron con el mismo
+        -- umbral que el cálculo en vivo (> 0.01%); si no, dan otros AGEBs
+        mapeado := FALSE;
+        IF hay_mapeo THEN
+            mapeado := EXISTS (SELECT 1 FROM public.cp_to_ageb_mapping_status s
+                               WHERE s.estado_cve = grupo.cve_ent
+                                 AND s.umbral_porcentaje = 0.01);
+        END IF;
+
+        -- La tabla compacta se reconstruye al final de cada corrida: solo se
+        -- usa para entidades que contiene con el mapeo vigente
+        compactado := mapeado AND hay_compacto AND EXISTS (
+            SELECT 1
+            FROM public.cp_to_ageb_mapping_compact_status c
+            JOIN public.cp_to_ageb_mapping_status s USING (estado_cve)
+            WHERE c.estado_cve = grupo.cve_ent
+              AND c.mapped_at IS NOT DISTINCT FROM s.mapped_at);
 
-        -- Verificar si el CP existe en esta tabla usando un contador
-        EXECUTE format('SELECT COUNT(*) FROM sepomex.%I WHERE d_cp = %L',
-                      tabla_cp, codigo_postal_busqueda)
-        INTO cp_count;
+        RAISE NOTICE 'Entidad % (% CPs): fuente = %', grupo.cve_ent, array_length(grupo.cps, 1),
+            CASE WHEN mapeado THEN 'mapeo (cp_to_ageb_mapping)' ELSE 'cálculo en vivo' END;
 
-        IF cp_count > 0 THEN
-            -- Extraer el código de estado (2 dígitos después de cp_)
-            estado_cve := substring(tabla_cp from 'cp_(\d{2})_');
-            EXIT;
+        IF compactado THEN
+            -- Formato compacto (create_cp_ageb_mapping.py --compact): CP y
+            -- estado enteros (índice codigo_postal, estado_cve), CVEGEO codificado
+            RETURN QUERY EXECUTE $q$
+                SELECT e.cp, public.entero_a_cvegeo(m.clave_ageb),
+                       CASE m.tipo_ageb WHEN 1 THEN 'urbana' ELSE 'rural' END,
+                       (m.porcentaje_centesimas / 100.0)::NUMERIC(5,2), 'mapeo'::TEXT
+                FROM unnest($1) AS e(cp)
+                JOIN public.cp_to_ageb_mapping_compact m ON m.codigo_postal = e.cp::INTEGER
+                WHERE m.estado_cve = $2::SMALLINT
+                ORDER BY 1, 4 DESC
+            $q$ USING grupo.cps, grupo.cve_ent;
+        ELSIF mapeado THEN
+            RETURN QUERY EXECUTE $q$
+                SELECT m.codigo_postal::TEXT, m.clave_ageb::TEXT, m.tipo_ageb::TEXT,
+                       m.porcentaje_interseccion::NUMERIC, 'mapeo'::TEXT
+                FROM public.cp_to_ageb_mapping m
+                WHERE m.codigo_postal = ANY ($1)
+                  AND m.estado_cve = $2
+                ORDER BY 1, 4 DESC
+            $q$ USING grupo.cps, grupo.cve_ent;
+        ELSE
+            -- En vivo se cruza cada tabla de CPs de la entidad
+            FOREACH tabla_cp IN ARRAY grupo.tablas LOOP
+                query_dinamico := consulta_agebs_en_vivo(grupo.cve_ent, tabla_cp);
+                CONTINUE WHEN query_dinamico IS NULL;
+
+                RETURN QUERY EXECUTE query_dinamico USING grupo.cps, grupo.cve_ent;
+            END LOOP;
         END IF;
     END LOOP;
+END;
+$$ LANGUAGE plpgsql STABLE;
 
-    IF estado_cve IS NULL THEN
+-- ----------------------------------------------------------------------------
+-- buscar_agebs_por_cp: un solo código postal
+-- Un CP presente en varias entidades devuelve los AGEBs de todas ellas
+-- ----------------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION buscar_agebs_por_cp(codigo_postal_busqueda TEXT)
+RETURNS TABLE (
+    codigo_postal TEXT,
+    clave_ageb TEXT,
+    tipo_ageb TEXT,
+    porcentaje_interseccion NUMERIC
+) AS $$
+BEGIN
+    -- Entidad(es) del código postal con una lectura del directorio
+    -- (public.cp_directory, llenado por load_shapefiles.py)
+    IF NOT EXISTS (SELECT 1 FROM public.cp_directory d WHERE d.d_cp = codigo_postal_busqueda) THEN
         RAISE EXCEPTION 'Código postal % no encontrado en ninguna entidad', codigo_postal_busqueda;
     END IF;
 
-    -- Paso 2: Construir nombres de tablas
-    tabla_ageb_urbana := 'ageb_urbana_' || estado_cve;
-    tabla_ageb_rural := 'ageb_rural_' || estado_cve;
-
-    -- Paso 3: Construir y ejecutar query dinámico
-    query_dinamico := format($q$
-        SELECT
-            cp.d_cp::TEXT as codigo_postal,
-            ageb.cvegeo::TEXT as clave_ageb,
-            'urbana'::TEXT as tipo_ageb,
-            ROUND((ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))) /
-            ST_Area(ST_Transform(cp.geom, 6372)) * 100)::numeric, 2) as porcentaje_interseccion
-        FROM sepomex.%I cp
-        JOIN inegi.%I ageb
-          ON ST_Intersects(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))
-        WHERE cp.d_cp = %L
-          AND ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))) /
-              ST_Area(ST_Transform(cp.geom, 6372)) * 100 > 0.01
-
-        UNION ALL
-
-        SELECT
-            cp.d_cp::TEXT,
-            ageb.cvegeo::TEXT,
-            'rural'::TEXT,
-            ROUND((ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ageb.geom)) /
-            ST_Area(ST_Transform(cp.geom, 6372)) * 100)::numeric, 2)
-        FROM sepomex.%I cp
-        JOIN inegi.%I ageb
-          ON ST_Intersects(ST_Transform(cp.geom, 6372), ageb.geom)
-        WHERE cp.d_cp = %L
-          AND ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ageb.geom)) /
-              ST_Area(ST_Transform(cp.geom, 6372)) * 100 > 0.01
-
-        ORDER BY porcentaje_interseccion DESC
-    $q$,
-    tabla_cp, tabla_ageb_urbana, codigo_postal_busqueda,
-    tabla_cp, tabla_ageb_rural, codigo_postal_busqueda);
-
-    -- Retornar resultados
-    RETURN QUERY EXECUTE query_dinamico;
+    RETURN QUERY
+        SELECT r.codigo_postal, r.clave_ageb, r.tipo_ageb, r.porcentaje_interseccion
+        FROM buscar_agebs_por_cps(ARRAY[codigo_postal_busqueda]) r
+        ORDER BY r.porcentaje_interseccion DESC;
 END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE plpgsql STABLE;
 
 -- ============================================================================
 -- Ejemplos de uso:
 -- ============================================================================
 
 -- Buscar AGEBs para un código postal en Guadalajara, Jalisco
-SELECT * FROM buscar_agebs_por_cp('44100');
+-- SELECT * FROM buscar_agebs_por_cp('44100');
+
+-- Verificar que ambas ramas (urbana y rural) usan el índice GiST del AGEB
+-- (Index Scan / Bitmap Index Scan sobre *_geom_6372_idx):
+-- LOAD 'auto_explain';
+-- SET auto_explain.log_min_duration = 0;
+-- SET auto_explain.log_nested_statements = on;
+-- SET client_min_messages = log;
+-- SELECT * FROM buscar_agebs_por_cp('44100');
 
 -- Buscar AGEBs para un código postal en CDMX
 -- SELECT * FROM buscar_agebs_por_cp('06600');
 
 -- Buscar AGEBs para cualquier código postal
 -- SELECT * FROM buscar_agebs_por_cp('TU_CODIGO_POSTAL_AQUI');
+
+-- Cálculo en vivo sobre las piezas subdivididas (schema subdiv)
+-- SET cp2ageb.usar_subdivision = on;
+-- SELECT * FROM buscar_agebs_por_cp('44100');
+
+-- Búsqueda por lotes: una consulta por entidad, no una por CP
+-- SELECT * FROM buscar_agebs_por_cps(ARRAY['44100', '06600', '64000']);
+
+-- Enriquecer una tabla de CPs
+-- SELECT * FROM buscar_agebs_por_cps((SELECT array_agg(DISTINCT cp) FROM mis_clientes));
@@ -4,8 +4,15 @@ Script para crear el mapeo completo de Códigos Postales a AGEBs
 Procesa todos los estados y crea una tabla consolidada
 """
 
+import argparse
+import hashlib
+import io
+import json
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from pathlib import Path
 import psycopg2
 from datetime import datetime
 
@@ -18,6 +25,58 @@ DB_CONFIG = {
     'password': os.getenv('POSTGRES_PASSWORD', 'geopassword')
 }
 
+# Geometría canónica EPSG:6372 creada por load_shapefiles.py (CANONICAL_GEOM);
+# las tablas cargadas sin ella transforman geom al vuelo
+CANONICAL_COLUMN = 'geom_6372'
+CANONICAL_SRID = 6372
+
+# Piezas ST_Subdivide creadas por load_shapefiles.py (SUBDIVIDE_GEOM), usadas
+# con --subdivided
+SUBDIVIDE_SCHEMA = 'subdiv'
+
+# Capa unificada de CPs creada por load_shapefiles.py (UNIFIED_LAYERS):
+# sepomex.cp con una partición cp_estado_XX por estado y geom en EPSG:6372
+CP_PARTITION_PREFIX = 'cp_estado_'
+
+# Tablas de mapeo y de estados mapeados. En modo --bulk se llena una versión
+# nueva (cp_to_ageb_mapping_v<N>, cp_to_ageb_mapping_status_v<N>) y al final
+# los nombres de arriba pasan a ser vistas sobre esa versión
+MAPPING_TABLE = 'cp_to_ageb_mapping'
+STATUS_TABLE = 'cp_to_ageb_mapping_status'
+VERSIONS_TABLE = 'cp_to_ageb_mapping_versions'
+
+# Versiones anteriores que se conservan para --rollback
+PREVIOUS_VERSIONS_KEPT = 1
+
+# Formato compacto (--compact): CP entero, CVEGEO codificado en BIGINT y
+# códigos SMALLINT, ordenado por CP; la vista conserva los nombres y tipos
+# de columna de cp_to_ageb_mapping. COMPACT_STATUS_TABLE registra qué estados
+# (y qué mapped_at de cada uno) contiene la tabla compacta
+COMPACT_TABLE = 'cp_to_ageb_mapping_compact'
+COMPACT_VIEW = 'cp_to_ageb_mapping_compact_view'
+COMPACT_STATUS_TABLE = 'cp_to_ageb_mapping_compact_status'
+
+# Porcentaje mínimo del área del CP para guardar una intersección: el mismo
+# umbral del cálculo en vivo de buscar_agebs_por_cp() (> 0.01%). La función
+# solo sirve desde el mapeo los estados guardados con este umbral
+MIN_INTERSECTION_PERCENT = 0.01
+
+# Índices b-tree de la tabla de mapeo (nombre, columna)
+MAPPING_INDEXES = [
+    ('idx_cp_to_ageb_cp', 'codigo_postal'),
+    ('idx_cp_to_ageb_ageb', 'clave_ageb'),
+    ('idx_cp_to_ageb_estado', 'estado_cve'),
+    ('idx_cp_to_ageb_tipo', 'tipo_relacion'),
+]
+
+# Directorios de ZIPs de cada fuente de load_metadata: el SHA-256 que
+# registra su manifiesto de descarga (manifest.json) entra en la huella del estado
+DOWNLOAD_DIRS = {
+    'SEPOMEX': Path('/data/cp_shapefiles'),
+    'INEGI': Path('/data/ageb_shapefiles'),
+}
+DOWNLOAD_MANIFEST = 'manifest.json'
+
 # Mapeo de estados
 ESTADOS = {
     "01": "Aguascalientes",
@@ -54,49 +113,361 @@ ESTADOS = {
     "32": "Zacatecas",
 }
 
+# Estados con más CPs/AGEBs: en modo paralelo se programan primero para que
+# el estado más lento no quede al final de la cola
+ESTADOS_GRANDES = ["15", "14", "30", "21"]
+
 
 def get_connection():
     """Obtener conexión a la base de datos"""
     return psycopg2.connect(**DB_CONFIG)
 
 
+def mapping_columns_ddl():
+    """Columnas de la tabla de mapeo (compartidas por la tabla sin versionar y las versiones)"""
+    return """
+        id SERIAL,
+        estado_cve VARCHAR(2) NOT NULL,
+        codigo_postal VARCHAR(10) NOT NULL,
+        clave_ageb VARCHAR(20) NOT NULL,
+        tipo_ageb VARCHAR(10) NOT NULL,
+        area_interseccion_m2 NUMERIC(15,2),
+        porcentaje_interseccion NUMERIC(5,2),
+        tipo_relacion VARCHAR(20),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    """
+
+
+def status_columns_ddl():
+    """Columnas de la tabla de estados mapeados"""
+    return """
+        estado_cve VARCHAR(2) PRIMARY KEY,
+        registros INTEGER NOT NULL,
+        mapped_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        fingerprint VARCHAR(32),
+        umbral_porcentaje NUMERIC(5,2)
+    """
+
+
+def mapping_is_versioned(conn):
+    """Verificar si cp_to_ageb_mapping es la vista sobre una versión publicada"""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_class c
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = 'public' AND c.relname = %s AND c.relkind = 'v'
+            )
+        """, (MAPPING_TABLE,))
+        return cur.fetchone()[0]
+
+
 def create_mapping_table(conn):
-    """Crear tabla de mapeo si no existe"""
+    """Crear tabla de mapeo si no existe
+
+    Si el mapeo ya está versionado (vistas sobre cp_to_ageb_mapping_v<N>)
+    solo se asegura el registro de versiones.
+    """
     print("Creando tabla de mapeo...")
 
     with conn.cursor() as cur:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS public.cp_to_ageb_mapping (
-                id SERIAL PRIMARY KEY,
-                estado_cve VARCHAR(2) NOT NULL,
-                codigo_postal VARCHAR(10) NOT NULL,
-                clave_ageb VARCHAR(20) NOT NULL,
-                tipo_ageb VARCHAR(10) NOT NULL,
-                area_interseccion_m2 NUMERIC(15,2),
-                porcentaje_interseccion NUMERIC(5,2),
-                tipo_relacion VARCHAR(20),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS public.{VERSIONS_TABLE} (
+                version INTEGER PRIMARY KEY,
+                estado VARCHAR(20) NOT NULL DEFAULT 'construyendo',
+                registros BIGINT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                published_at TIMESTAMP
             );
 
-            -- Índices para mejorar el rendimiento
-            CREATE INDEX IF NOT EXISTS idx_cp_to_ageb_cp ON public.cp_to_ageb_mapping(codigo_postal);
-            CREATE INDEX IF NOT EXISTS idx_cp_to_ageb_ageb ON public.cp_to_ageb_mapping(clave_ageb);
-            CREATE INDEX IF NOT EXISTS idx_cp_to_ageb_estado ON public.cp_to_ageb_mapping(estado_cve);
-            CREATE INDEX IF NOT EXISTS idx_cp_to_ageb_tipo ON public.cp_to_ageb_mapping(tipo_relacion);
+            COMMENT ON TABLE public.{VERSIONS_TABLE} IS
+                'Versiones de cp_to_ageb_mapping (construyendo, publicada, anterior, eliminada)';
+        """)
+
+    if mapping_is_versioned(conn):
+        with conn.cursor() as cur:
+            upgrade_status_tables(cur)
+            # La vista (SELECT *) expone las columnas nuevas al recrearla
+            _, status_table = published_tables(conn)
+            cur.execute(f"CREATE OR REPLACE VIEW public.{STATUS_TABLE} AS SELECT * FROM public.{status_table}")
+        conn.commit()
+        print("✓ Tabla creada (versionada)")
+        return
+
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS public.{MAPPING_TABLE} (
+                {mapping_columns_ddl()},
+                PRIMARY KEY (id)
+            );
+        """)
+
+        # Índices para mejorar el rendimiento
+        for index_name, column in MAPPING_INDEXES:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON public.{MAPPING_TABLE}({column})")
 
+        cur.execute(f"""
             -- Comentarios
-            COMMENT ON TABLE public.cp_to_ageb_mapping IS
+            COMMENT ON TABLE public.{MAPPING_TABLE} IS
                 'Mapeo de Códigos Postales (SEPOMEX) a AGEBs (INEGI)';
-            COMMENT ON COLUMN public.cp_to_ageb_mapping.porcentaje_interseccion IS
+            COMMENT ON COLUMN public.{MAPPING_TABLE}.porcentaje_interseccion IS
                 'Porcentaje del área del CP que intersecta con el AGEB';
-            COMMENT ON COLUMN public.cp_to_ageb_mapping.tipo_relacion IS
+            COMMENT ON COLUMN public.{MAPPING_TABLE}.tipo_relacion IS
                 'principal: >50% intersección, parcial: <50% intersección';
+
+            -- Estados ya mapeados: buscar_agebs_por_cp() los sirve desde la
+            -- tabla de mapeo en lugar de calcular la intersección en vivo
+            CREATE TABLE IF NOT EXISTS public.{STATUS_TABLE} (
+                {status_columns_ddl()}
+            );
+        """)
+
+        upgrade_status_tables(cur)
+        cur.execute(f"""
+            COMMENT ON TABLE public.{STATUS_TABLE} IS
+                'Estados con mapeo CP → AGEB completo en cp_to_ageb_mapping';
+            COMMENT ON COLUMN public.{STATUS_TABLE}.fingerprint IS
+                'Huella de las tablas fuente (load_metadata, registros, geometrías) usada para omitir estados sin cambios';
+            COMMENT ON COLUMN public.{STATUS_TABLE}.umbral_porcentaje IS
+                'Porcentaje mínimo de intersección guardado; buscar_agebs_por_cp() calcula en vivo si no es 0.01';
         """)
 
         conn.commit()
         print("✓ Tabla creada")
 
 
+def upgrade_status_tables(cur):
+    """Agregar las columnas nuevas a las tablas de estados existentes
+
+    Incluye las tablas de cada versión (cp_to_ageb_mapping_status_v<N>) para
+    que --rollback pueda volver a apuntar la vista a cualquiera de ellas.
+    Los estados mapeados antes de umbral_porcentaje quedan con NULL y se
+    recalculan en la siguiente ejecución.
+    """
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'public' AND c.relkind = 'r'
+          AND (c.relname = %s OR c.relname ~ %s)
+    """, (STATUS_TABLE, f"^{STATUS_TABLE}_v[0-9]+$"))
+    for (table_name,) in cur.fetchall():
+        cur.execute(f"""
+            ALTER TABLE public.{table_name}
+                ADD COLUMN IF NOT EXISTS fingerprint VARCHAR(32),
+                ADD COLUMN IF NOT EXISTS umbral_porcentaje NUMERIC(5,2)
+        """)
+
+
+def version_tables(version):
+    """Nombres de las tablas de mapeo y de estados de una versión"""
+    return f"{MAPPING_TABLE}_v{version}", f"{STATUS_TABLE}_v{version}"
+
+
+def create_version_tables(conn):
+    """Registrar una versión nueva del mapeo y crear sus tablas vacías
+
+    La tabla de mapeo de la versión es UNLOGGED y no tiene llave primaria ni
+    índices: los INSERT de cada estado no mantienen índices ni escriben WAL.
+    Todo eso se hace una sola vez en publish_version(). Versiones que
+    quedaron a medias en ejecuciones anteriores se eliminan.
+
+    Returns:
+        Número de la versión nueva
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT version FROM public.{VERSIONS_TABLE} WHERE estado = 'construyendo'")
+        for (abandonada,) in cur.fetchall():
+            for table_name in version_tables(abandonada):
+                cur.execute(f"DROP TABLE IF EXISTS public.{table_name}")
+            cur.execute(f"UPDATE public.{VERSIONS_TABLE} SET estado = 'eliminada' WHERE version = %s",
+                        (abandonada,))
+
+        cur.execute(f"""
+            INSERT INTO public.{VERSIONS_TABLE} (version)
+            SELECT COALESCE(MAX(version), 0) + 1 FROM public.{VERSIONS_TABLE}
+            RETURNING version
+        """)
+        version = cur.fetchone()[0]
+        mapping_table, status_table = version_tables(version)
+
+        cur.execute(f"""
+            CREATE UNLOGGED TABLE public.{mapping_table} (
+                {mapping_columns_ddl()}
+            );
+
+            CREATE TABLE public.{status_table} (
+                {status_columns_ddl()}
+            );
+        """)
+
+    conn.commit()
+    print(f"✓ Versión {version} creada ({mapping_table})")
+    return version
+
+
+def point_views_to_version(cur, version):
+    """Apuntar las vistas cp_to_ageb_mapping / _status a una versión (sin commit)"""
+    mapping_table, status_table = version_tables(version)
+    cur.execute(f"CREATE OR REPLACE VIEW public.{MAPPING_TABLE} AS SELECT * FROM public.{mapping_table}")
+    cur.execute(f"CREATE OR REPLACE VIEW public.{STATUS_TABLE} AS SELECT * FROM public.{status_table}")
+
+
+def publish_version(conn, version, carry_over=True):
+    """Indexar una versión y publicarla en lugar de la actual
+
+    La tabla de la versión pasa a LOGGED y recibe la llave primaria y los
+    índices en un solo recorrido cada uno. Luego, en una transacción corta,
+    las vistas cp_to_ageb_mapping y cp_to_ageb_mapping_status se apuntan a
+    la versión nueva; los lectores ven la versión anterior completa hasta el
+    COMMIT y la nueva completa después. La primera vez, las tablas sin
+    versionar se conservan como versión 0.
+
+    Con carry_over=True los estados que no quedaron en la versión nueva por
+    un error conservan sus registros de la versión actual. Los que ya no
+    tienen tablas de CPs o de AGEBs no se copian: como en process_state(),
+    dejan de estar mapeados y vuelven a la consulta en vivo.
+    """
+    mapping_table, status_table = version_tables(version)
+
+    if carry_over:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                INSERT INTO public.{status_table} (estado_cve, registros, mapped_at, fingerprint, umbral_porcentaje)
+                SELECT s.estado_cve, s.registros, s.mapped_at, s.fingerprint, s.umbral_porcentaje
+                FROM public.{STATUS_TABLE} s
+                WHERE s.estado_cve NOT IN (SELECT estado_cve FROM public.{status_table})
+                  AND (to_regclass('inegi.ageb_urbana_' || s.estado_cve) IS NOT NULL
+                       OR to_regclass('inegi.ageb_rural_' || s.estado_cve) IS NOT NULL)
+                  AND EXISTS (SELECT 1 FROM information_schema.tables t
+                              WHERE t.table_schema = 'sepomex'
+                                AND t.table_name LIKE 'cp\\_' || s.estado_cve || '\\_%')
+                RETURNING estado_cve
+            """)
+            conservados = [row[0] for row in cur.fetchall()]
+            if conservados:
+                cur.execute(f"""
+                    INSERT INTO public.{mapping_table} (
+                        estado_cve, codigo_postal, clave_ageb, tipo_ageb,
+                        area_interseccion_m2, porcentaje_interseccion, tipo_relacion, created_at
+                    )
+                    SELECT estado_cve, codigo_postal, clave_ageb, tipo_ageb,
+                           area_interseccion_m2, porcentaje_interseccion, tipo_relacion, created_at
+                    FROM public.{MAPPING_TABLE}
+                    WHERE estado_cve = ANY (%s)
+                """, (conservados,))
+                print(f"\n⚠ Estados sin recalcular, se conservan sus registros: {', '.join(sorted(conservados))}")
+        conn.commit()
+
+    print(f"\nIndexando versión {version}... ", end="", flush=True)
+    with conn.cursor() as cur:
+        cur.execute(f"ALTER TABLE public.{mapping_table} SET LOGGED")
+        cur.execute(f"ALTER TABLE public.{mapping_table} ADD PRIMARY KEY (id)")
+        for index_name, column in MAPPING_INDEXES:
+            cur.execute(f"CREATE INDEX {index_name}_v{version} ON public.{mapping_table}({column})")
+        cur.execute(f"ANALYZE public.{mapping_table}")
+        cur.execute(f"SELECT COUNT(*) FROM public.{mapping_table}")
+        registros = cur.fetchone()[0]
+    conn.commit()
+    print("✓")
+
+    print(f"Publicando versión {version}... ", end="", flush=True)
+    versioned = mapping_is_versioned(conn)
+    with conn.cursor() as cur:
+        if not versioned:
+            # Tablas anteriores al versionado: se conservan como versión 0
+            legacy_mapping, legacy_status = version_tables(0)
+            cur.execute(f"ALTER TABLE public.{MAPPING_TABLE} RENAME TO {legacy_mapping}")
+            cur.execute(f"ALTER TABLE public.{STATUS_TABLE} RENAME TO {legacy_status}")
+            cur.execute(f"""
+                INSERT INTO public.{VERSIONS_TABLE} (version, estado, registros, published_at)
+                SELECT 0, 'publicada', COUNT(*), NULL FROM public.{legacy_mapping}
+                ON CONFLICT (version) DO NOTHING
+            """)
+
+        point_views_to_version(cur, version)
+        cur.execute(f"UPDATE public.{VERSIONS_TABLE} SET estado = 'anterior' WHERE estado = 'publicada'")
+        cur.execute(f"""
+            UPDATE public.{VERSIONS_TABLE}
+            SET estado = 'publicada', registros = %s, published_at = CURRENT_TIMESTAMP
+            WHERE version = %s
+        """, (registros, version))
+    conn.commit()
+    print(f"✓ {registros:,} registros")
+
+    drop_old_versions(conn)
+
+
+def drop_old_versions(conn):
+    """Eliminar las versiones anteriores que exceden PREVIOUS_VERSIONS_KEPT"""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT version FROM public.{VERSIONS_TABLE}
+            WHERE estado = 'anterior'
+            ORDER BY version DESC
+            OFFSET %s
+        """, (PREVIOUS_VERSIONS_KEPT,))
+        for (version,) in cur.fetchall():
+            for table_name in version_tables(version):
+                cur.execute(f"DROP TABLE IF EXISTS public.{table_name}")
+            cur.execute(f"UPDATE public.{VERSIONS_TABLE} SET estado = 'eliminada' WHERE version = %s",
+                        (version,))
+            print(f"  Versión {version} eliminada")
+    conn.commit()
+
+
+def rollback_version(conn):
+    """Volver a publicar la versión anterior más reciente
+
+    La versión publicada queda como 'eliminada' en el registro (sus tablas
+    se borran) para que un segundo --rollback no regrese a ella.
+
+    Returns:
+        Número de la versión publicada, o None si no hay versión anterior
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT version FROM public.{VERSIONS_TABLE}
+            WHERE estado = 'anterior'
+            ORDER BY version DESC
+            LIMIT 1
+        """)
+        row = cur.fetchone()
+        if row is None or not mapping_is_versioned(conn):
+            conn.rollback()
+            return None
+
+        anterior = row[0]
+        cur.execute(f"SELECT version FROM public.{VERSIONS_TABLE} WHERE estado = 'publicada'")
+        descartadas = [version for (version,) in cur.fetchall()]
+
+        point_views_to_version(cur, anterior)
+        cur.execute(f"""
+            UPDATE public.{VERSIONS_TABLE}
+            SET estado = 'eliminada'
+            WHERE estado = 'publicada'
+        """)
+        cur.execute(f"""
+            UPDATE public.{VERSIONS_TABLE}
+            SET estado = 'publicada', published_at = CURRENT_TIMESTAMP
+            WHERE version = %s
+        """, (anterior,))
+        for version in descartadas:
+            for table_name in version_tables(version):
+                cur.execute(f"DROP TABLE IF EXISTS public.{table_name}")
+    conn.commit()
+    return anterior
+
+
+def published_tables(conn):
+    """Tablas reales detrás de cp_to_ageb_mapping / _status (versionadas o no)"""
+    if not mapping_is_versioned(conn):
+        return MAPPING_TABLE, STATUS_TABLE
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT version FROM public.{VERSIONS_TABLE} WHERE estado = 'publicada'")
+        return version_tables(cur.fetchone()[0])
+
+
 def get_available_tables(conn, schema, pattern):
     """Obtener tablas disponibles en un schema"""
     with conn.cursor() as cur:
@@ -110,120 +481,593 @@ def get_available_tables(conn, schema, pattern):
         return [row[0] for row in cur.fetchall()]
 
 
-def process_state(conn, cve_ent):
-    """Procesar un estado completo (CPs + AGEBs urbanas y rurales)"""
+def has_canonical_geometry(conn, schema, table_name):
+    """Verificar si una tabla tiene la columna de geometría canónica"""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = %s
+                  AND table_name = %s
+                  AND column_name = %s
+            )
+        """, (schema, table_name, CANONICAL_COLUMN))
+        return cur.fetchone()[0]
+
+
+def geometry_6372(conn, schema, table_name):
+    """Expresión de la geometría EPSG:6372 de una tabla, o None si no existe
+
+    Usa la columna canónica si existe; si no (CANONICAL_GEOM=false),
+    ST_Transform(geom), que no aprovecha el índice espacial.
+    """
+    if has_canonical_geometry(conn, schema, table_name):
+        return CANONICAL_COLUMN
+    if relation_exists(conn, f"{schema}.{table_name}"):
+        return f"ST_Transform(geom, {CANONICAL_SRID})"
+    return None
+
+
+def manifest_sha256(source, file_name):
+    """SHA-256 de un ZIP según el manifiesto de descarga de su fuente ('' si no hay)"""
+    directorio = DOWNLOAD_DIRS.get(source)
+    if directorio is None or not file_name:
+        return ''
+    try:
+        manifest = json.loads((directorio / DOWNLOAD_MANIFEST).read_text())
+    except (OSError, ValueError):
+        return ''
+    return (manifest.get(file_name) or {}).get('sha256') or ''
+
+
+def last_load(cur, table_name):
+    """Última carga exitosa de una tabla en load_metadata como texto para la huella"""
+    cur.execute("""
+        SELECT loaded_at, rows_count, file_name, source
+        FROM public.load_metadata
+        WHERE table_name = %s AND status = 'success'
+        ORDER BY loaded_at DESC, id DESC
+        LIMIT 1
+    """, (table_name,))
+    row = cur.fetchone()
+    if not row:
+        return f"{table_name}:-"
+    loaded_at, rows_count, file_name, source = row
+    return f"{table_name}:{loaded_at}:{rows_count}:{file_name}:{manifest_sha256(source, file_name)}"
+
+
+def state_fingerprint(conn, cve_ent, cp_table, subdivided=False):
+    """Huella de las tablas fuente de un estado (CPs y AGEBs urbanas/rurales)
+
+    Combina, por tabla, la última carga exitosa en load_metadata (fecha,
+    registros y archivo), el SHA-256 de ese archivo en el manifiesto de
+    descarga y el número de registros actual; no lee las geometrías. La
+    partición cp_estado_XX usa las cargas de las tablas cp_XX_* que la
+    llenan. Una tabla inexistente también forma parte de la huella.
+
+    Con subdivided=True se agregan el modo y, por cada copia en subdiv, su
+    última construcción en load_metadata ('subdiv.<tabla>') y el número de
+    piezas, así que cambiar de modo o reconstruir las piezas recalcula el
+    estado.
+    """
+    tablas = (('sepomex', cp_table),
+              ('inegi', f'ageb_urbana_{cve_ent}'),
+              ('inegi', f'ageb_rural_{cve_ent}'))
+    if cp_table.startswith(CP_PARTITION_PREFIX):
+        cargas_cp = get_available_tables(conn, 'sepomex', f'cp_{cve_ent}_%')
+    else:
+        cargas_cp = [cp_table]
+
+    partes = []
+    with conn.cursor() as cur:
+        for schema, table_name in tablas:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{schema}.{table_name}",))
+            if not cur.fetchone()[0]:
+                partes.append(f"{schema}.{table_name}:-")
+                continue
+
+            cur.execute(f"SELECT COUNT(*) FROM {schema}.{table_name}")
+            partes.append(f"{schema}.{table_name}:{cur.fetchone()[0]}")
+            for cargada in (cargas_cp if schema == 'sepomex' else [table_name]):
+                partes.append(last_load(cur, cargada))
+
+        if subdivided:
+            partes.append("modo:subdiv")
+            for _, table_name in tablas:
+                pieces = f"{SUBDIVIDE_SCHEMA}.{table_name}"
+                cur.execute("SELECT to_regclass(%s) IS NOT NULL", (pieces,))
+                if not cur.fetchone()[0]:
+                    partes.append(f"{pieces}:-")
+                    continue
+
+                cur.execute(f"""
+                    SELECT
+                        (SELECT MAX(loaded_at)
+                         FROM public.load_metadata
+                         WHERE table_name = %s AND status = 'success'),
+                        (SELECT COUNT(*) FROM {pieces})
+                """, (pieces,))
+                loaded_at, piezas = cur.fetchone()
+                partes.append(f"{pieces}:{loaded_at}:{piezas}")
+
+    return hashlib.md5("|".join(partes).encode()).hexdigest()
+
+
+def stored_fingerprint(conn, cve_ent):
+    """Huella registrada en el último mapeo del estado, o None
+
+    Un mapeo guardado con otro umbral de intersección no cuenta: el estado
+    se recalcula aunque sus tablas fuente no hayan cambiado.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT fingerprint
+            FROM public.cp_to_ageb_mapping_status
+            WHERE estado_cve = %s
+              AND umbral_porcentaje = %s
+        """, (cve_ent, MIN_INTERSECTION_PERCENT))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+
+def insert_intersections(cur, cve_ent, cp_table, ageb_table, tipo_ageb, subdivided=False,
+                         target=MAPPING_TABLE, cp_geom=CANONICAL_COLUMN, ageb_geom=CANONICAL_COLUMN):
+    """Insertar las intersecciones CP × AGEB de una tabla de AGEBs
+
+    La intersección de cada par y el área del CP se calculan una sola vez
+    (subconsultas con OFFSET 0 para que el planificador no las aplane y
+    repita las expresiones); el área, el porcentaje, tipo_relacion y el
+    filtro de MIN_INTERSECTION_PERCENT se derivan de esos valores. Los pares donde una geometría
+    cubre a la otra usan el área ya conocida sin llamar a ST_Intersection.
+
+    Con subdivided=True el cruce se hace entre las piezas de subdiv (mismo
+    nombre de tabla) y el área de intersección se suma por par original;
+    el área del CP sigue saliendo de la geometría completa.
+
+    target es la tabla destino en public (la de la versión en modo --bulk);
+    cp_geom y ageb_geom son las expresiones EPSG:6372 de cada tabla (geom en
+    sepomex.cp, ver geometry_6372() para tablas sin geom_6372).
+
+    Returns:
+        Número de registros insertados
+    """
+    if subdivided:
+        ageb_pieces = f"{SUBDIVIDE_SCHEMA}.{ageb_table.split('.')[-1]}"
+        pares = f"""
+            SELECT
+                cp.d_cp,
+                ageb.cvegeo,
+                cp.area_cp,
+                SUM(CASE
+                    WHEN ST_Covers(cp.geom, ageb.geom) THEN ST_Area(ageb.geom)
+                    WHEN ST_CoveredBy(cp.geom, ageb.geom) THEN ST_Area(cp.geom)
+                    ELSE ST_Area(ST_Intersection(cp.geom, ageb.geom))
+                END) AS area_interseccion
+            FROM
+                (SELECT p.parent_fid, c.d_cp, c.area_cp, p.geom
+                 FROM (SELECT ogc_fid, d_cp, ST_Area({cp_geom}) AS area_cp
+                       FROM sepomex.{cp_table}) c
+                 JOIN {SUBDIVIDE_SCHEMA}.{cp_table} p ON p.parent_fid = c.ogc_fid
+                 OFFSET 0) cp
+            JOIN
+                {ageb_pieces} ageb
+                ON ST_Intersects(cp.geom, ageb.geom)
+            GROUP BY cp.parent_fid, cp.d_cp, cp.area_cp, ageb.parent_fid, ageb.cvegeo
+        """
+    else:
+        cp_columns = "d_cp, geom_6372" if cp_geom == CANONICAL_COLUMN else f"d_cp, {cp_geom} AS geom_6372"
+        ageb_source = ageb_table if ageb_geom == CANONICAL_COLUMN else \
+            f"(SELECT cvegeo, {ageb_geom} AS geom_6372 FROM {ageb_table})"
+        pares = f"""
+            SELECT
+                cp.d_cp,
+                ageb.cvegeo,
+                cp.area_cp,
+                CASE
+                    -- AGEB completamente dentro del CP: el área ya se conoce
+                    WHEN ST_Covers(cp.geom_6372, ageb.geom_6372) THEN ST_Area(ageb.geom_6372)
+                    -- CP completamente dentro del AGEB
+                    WHEN ST_CoveredBy(cp.geom_6372, ageb.geom_6372) THEN cp.area_cp
+                    -- Solo los pares que cruzan el borde requieren el recorte exacto
+                    ELSE ST_Area(ST_Intersection(cp.geom_6372, ageb.geom_6372))
+                END AS area_interseccion
+            FROM
+                (SELECT {cp_columns}, ST_Area({cp_geom}) AS area_cp
+                 FROM sepomex.{cp_table} OFFSET 0) cp
+            JOIN
+                {ageb_source} ageb
+                ON ST_Intersects(cp.geom_6372, ageb.geom_6372)
+            OFFSET 0
+        """
+
+    cur.execute(f"""
+        INSERT INTO public.{target} (
+            estado_cve, codigo_postal,
+            clave_ageb, tipo_ageb, area_interseccion_m2,
+            porcentaje_interseccion, tipo_relacion
+        )
+        SELECT
+            %s,
+            pares.d_cp,
+            pares.cvegeo,
+            %s,
+            pares.area_interseccion,
+            pares.area_interseccion / NULLIF(pares.area_cp, 0) * 100,
+            CASE
+                WHEN pares.area_interseccion / NULLIF(pares.area_cp, 0) > 0.5
+                THEN 'principal'
+                ELSE 'parcial'
+            END
+        FROM ({pares}) pares
+        WHERE
+            pares.area_interseccion / NULLIF(pares.area_cp, 0) * 100 > %s
+    """, (cve_ent, tipo_ageb, MIN_INTERSECTION_PERCENT))
+
+    return cur.rowcount
+
+
+def relation_exists(conn, qualified_name):
+    """Verificar si existe una tabla (schema.tabla)"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (qualified_name,))
+        return cur.fetchone()[0]
+
+
+def has_subdivided_table(conn, table_name):
+    """Verificar si existe la copia subdividida de una tabla"""
+    return relation_exists(conn, f"{SUBDIVIDE_SCHEMA}.{table_name}")
+
+
+def process_state(conn, cve_ent, subdivided=False, version=None):
+    """Procesar un estado completo (CPs + AGEBs urbanas y rurales)
+
+    Con subdivided=True usa las piezas de subdiv cuando existen para el CP
+    y para el AGEB; si falta alguna, ese tipo de AGEB usa las tablas completas.
+
+    Si la huella de las tablas fuente es la misma del último mapeo el estado
+    se omite; si cambió, sus registros se reemplazan en una sola transacción.
+    Con version (modo --bulk) se escribe en las tablas vacías de esa versión,
+    sin comparar huellas ni borrar registros.
+    """
+    mapping_table, status_table = version_tables(version) if version is not None \
+        else (MAPPING_TABLE, STATUS_TABLE)
+
     print(f"\n[{cve_ent}] Procesando estado {cve_ent}...")
 
-    # Buscar tabla de códigos postales
-    cp_tables = get_available_tables(conn, 'sepomex', f'cp_{cve_ent}_%')
-    if not cp_tables:
-        print(f"  ⚠ No se encontró tabla de CPs para estado {cve_ent}")
-        return 0
+    if not subdivided and relation_exists(conn, f"sepomex.{CP_PARTITION_PREFIX}{cve_ent}"):
+        # Capa unificada: la partición del estado reúne todas sus tablas de CPs
+        cp_table, cp_geom = f"{CP_PARTITION_PREFIX}{cve_ent}", 'geom'
+        print(f"  Tabla CPs: {cp_table} (sepomex.cp)")
+    else:
+        # Buscar tabla de códigos postales
+        cp_tables = get_available_tables(conn, 'sepomex', f'cp_{cve_ent}_%')
+        if not cp_tables:
+            print(f"  ⚠ No se encontró tabla de CPs para estado {cve_ent}")
+            # Sin CPs no hay mapeo: se borra el anterior en una transacción
+            # y el estado vuelve a la consulta en vivo
+            with conn.cursor() as cur:
+                if version is None:
+                    cur.execute(f"DELETE FROM public.{MAPPING_TABLE} WHERE estado_cve = %s", (cve_ent,))
+                cur.execute(f"DELETE FROM public.{status_table} WHERE estado_cve = %s", (cve_ent,))
+            conn.commit()
+            return 0
 
-    cp_table = cp_tables[0]  # Usar la primera tabla encontrada
-    print(f"  Tabla CPs: {cp_table}")
+        cp_table = cp_tables[0]  # Usar la primera tabla encontrada
+        print(f"  Tabla CPs: {cp_table}")
 
-    # Buscar tablas de AGEBs
-    ageb_urbana_table = f"inegi.ageb_urbana_{cve_ent}"
-    ageb_rural_table = f"inegi.ageb_rural_{cve_ent}"
+        cp_geom = geometry_6372(conn, 'sepomex', cp_table)
+        if cp_geom != CANONICAL_COLUMN:
+            print(f"  ⚠ sepomex.{cp_table} no tiene {CANONICAL_COLUMN}, se transforma geom "
+                  f"(ejecutar load_shapefiles.py con CANONICAL_GEOM=true)")
+
+    fingerprint = state_fingerprint(conn, cve_ent, cp_table, subdivided=subdivided)
+    if version is None and stored_fingerprint(conn, cve_ent) == fingerprint:
+        print("  ✓ Sin cambios en las tablas fuente, se omite")
+        conn.commit()
+        return 0
+
+    cp_subdivided = subdivided and has_subdivided_table(conn, cp_table)
+    if subdivided and not cp_subdivided:
+        print(f"  ⚠ No existe {SUBDIVIDE_SCHEMA}.{cp_table}, se usan geometrías completas "
+              f"(ejecutar load_shapefiles.py con SUBDIVIDE_GEOM=true)")
 
     total_inserted = 0
+    tablas_procesadas = 0
 
-    # Procesar AGEBs urbanas
     with conn.cursor() as cur:
-        # Verificar si existe tabla de AGEBs urbanas
-        cur.execute("""
-            SELECT EXISTS (
-                SELECT 1 FROM information_schema.tables
-                WHERE table_schema = 'inegi'
-                  AND table_name = %s
-            )
-        """, (f'ageb_urbana_{cve_ent}',))
+        # Reemplazar los registros anteriores del estado
+        if version is None:
+            cur.execute(f"DELETE FROM public.{MAPPING_TABLE} WHERE estado_cve = %s", (cve_ent,))
+            if cur.rowcount:
+                print(f"  {cur.rowcount} registros anteriores eliminados")
 
-        if cur.fetchone()[0]:
-            print(f"  Procesando AGEBs urbanas...")
-            cur.execute(f"""
-                INSERT INTO public.cp_to_ageb_mapping (
-                    estado_cve, codigo_postal,
-                    clave_ageb, tipo_ageb, area_interseccion_m2,
-                    porcentaje_interseccion, tipo_relacion
-                )
-                SELECT
-                    %s,
-                    cp.d_cp,
-                    ageb.cvegeo,
-                    'urbana',
-                    ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))),
-                    ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))) / NULLIF(ST_Area(ST_Transform(cp.geom, 6372)), 0) * 100,
-                    CASE
-                        WHEN ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))) / NULLIF(ST_Area(ST_Transform(cp.geom, 6372)), 0) > 0.5
-                        THEN 'principal'
-                        ELSE 'parcial'
-                    END
-                FROM
-                    sepomex.{cp_table} cp
-                CROSS JOIN
-                    {ageb_urbana_table} ageb
-                WHERE
-                    ST_Intersects(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))
-                    AND ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ST_Transform(ageb.geom, 6372))) / NULLIF(ST_Area(ST_Transform(cp.geom, 6372)), 0) > 0.01
-            """, (cve_ent,))
-
-            count = cur.rowcount
+        for tipo_ageb, etiqueta, etiqueta_registros in (('urbana', 'urbanas', 'urbanos'),
+                                                        ('rural', 'rurales', 'rurales')):
+            # Verificar si existe tabla de AGEBs
+            ageb_table = f'ageb_{tipo_ageb}_{cve_ent}'
+            ageb_geom = geometry_6372(conn, 'inegi', ageb_table)
+            if ageb_geom is None:
+                print(f"  ⚠ No se encontró tabla de AGEBs {etiqueta}")
+                continue
+            if ageb_geom != CANONICAL_COLUMN:
+                print(f"  ⚠ inegi.{ageb_table} no tiene {CANONICAL_COLUMN}, se transforma geom")
+
+            usar_piezas = cp_subdivided and has_subdivided_table(conn, ageb_table)
+            print(f"  Procesando AGEBs {etiqueta}{' (subdivididas)' if usar_piezas else ''}...")
+            count = insert_intersections(cur, cve_ent, cp_table, f"inegi.{ageb_table}", tipo_ageb,
+                                         subdivided=usar_piezas, target=mapping_table,
+                                         cp_geom=cp_geom, ageb_geom=ageb_geom)
             total_inserted += count
-            print(f"    ✓ {count} registros urbanos insertados")
-        else:
-            print(f"  ⚠ No se encontró tabla de AGEBs urbanas")
+            tablas_procesadas += 1
+            print(f"    ✓ {count} registros {etiqueta_registros} insertados")
 
-        # Procesar AGEBs rurales
-        cur.execute("""
-            SELECT EXISTS (
-                SELECT 1 FROM information_schema.tables
-                WHERE table_schema = 'inegi'
-                  AND table_name = %s
-            )
-        """, (f'ageb_rural_{cve_ent}',))
+        if not tablas_procesadas:
+            # Sin AGEBs no hay mapeo: el estado sigue usando la consulta en vivo
+            cur.execute(f"DELETE FROM public.{status_table} WHERE estado_cve = %s", (cve_ent,))
+            conn.commit()
+            print("  ⚠ Estado sin AGEBs, no se marca como mapeado")
+            return 0
 
-        if cur.fetchone()[0]:
-            print(f"  Procesando AGEBs rurales...")
-            cur.execute(f"""
-                INSERT INTO public.cp_to_ageb_mapping (
-                    estado_cve, codigo_postal,
-                    clave_ageb, tipo_ageb, area_interseccion_m2,
-                    porcentaje_interseccion, tipo_relacion
-                )
-                SELECT
-                    %s,
-                    cp.d_cp,
-                    ageb.cvegeo,
-                    'rural',
-                    ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ageb.geom)),
-                    ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ageb.geom)) / NULLIF(ST_Area(ST_Transform(cp.geom, 6372)), 0) * 100,
-                    CASE
-                        WHEN ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ageb.geom)) / NULLIF(ST_Area(ST_Transform(cp.geom, 6372)), 0) > 0.5
-                        THEN 'principal'
-                        ELSE 'parcial'
-                    END
-                FROM
-                    sepomex.{cp_table} cp
-                CROSS JOIN
-                    {ageb_rural_table} ageb
-                WHERE
-                    ST_Intersects(ST_Transform(cp.geom, 6372), ageb.geom)
-                    AND ST_Area(ST_Intersection(ST_Transform(cp.geom, 6372), ageb.geom)) / NULLIF(ST_Area(ST_Transform(cp.geom, 6372)), 0) > 0.01
-            """, (cve_ent,))
-
-            count = cur.rowcount
-            total_inserted += count
-            print(f"    ✓ {count} registros rurales insertados")
-        else:
-            print(f"  ⚠ No se encontró tabla de AGEBs rurales")
+        # Marcar el estado como mapeado (misma transacción que los INSERT)
+        cur.execute(f"""
+            INSERT INTO public.{status_table} (estado_cve, registros, mapped_at, fingerprint, umbral_porcentaje)
+            VALUES (%s, %s, CURRENT_TIMESTAMP, %s, %s)
+            ON CONFLICT (estado_cve) DO UPDATE
+            SET registros = EXCLUDED.registros, mapped_at = EXCLUDED.mapped_at,
+                fingerprint = EXCLUDED.fingerprint, umbral_porcentaje = EXCLUDED.umbral_porcentaje
+        """, (cve_ent, total_inserted, fingerprint, MIN_INTERSECTION_PERCENT))
 
     conn.commit()
     print(f"  Total: {total_inserted} registros")
     return total_inserted
 
 
+def compact_table_exists(conn):
+    """Verificar si existe la tabla de mapeo compacta"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f"public.{COMPACT_TABLE}",))
+        return cur.fetchone()[0]
+
+
+def compact_changed_states(conn):
+    """Estados de la tabla compacta cuyo mapped_at ya no coincide con el mapeo
+
+    Incluye los estados nuevos y los que dejaron de estar mapeados.
+
+    Returns:
+        Lista de claves de estado, o None si hay que reconstruir la tabla
+        completa (no existe, no tiene estado_cve o cambiaron todos los estados)
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT to_regclass(%s) IS NOT NULL
+               AND EXISTS (SELECT 1 FROM information_schema.columns
+                           WHERE table_schema = 'public'
+                             AND table_name = %s
+                             AND column_name = 'estado_cve')
+        """, (f"public.{COMPACT_STATUS_TABLE}", COMPACT_TABLE))
+        if not cur.fetchone()[0]:
+            return None
+
+        cur.execute(f"""
+            SELECT estado_cve, s.mapped_at IS DISTINCT FROM c.mapped_at
+            FROM public.{STATUS_TABLE} s
+            FULL JOIN public.{COMPACT_STATUS_TABLE} c USING (estado_cve)
+            ORDER BY estado_cve
+        """)
+        estados = cur.fetchall()
+    conn.commit()
+
+    cambios = [estado_cve for estado_cve, cambio in estados if cambio]
+    if estados and len(cambios) == len(estados):
+        return None
+    return cambios
+
+
+def update_compact_states(conn, estados):
+    """Reemplazar en la tabla compacta los registros de algunos estados
+
+    Borra y vuelve a insertar (ordenados por CP) los registros de esos
+    estados en una transacción; las consultas siguen leyendo la versión
+    anterior hasta el COMMIT. La fila de COMPACT_STATUS_TABLE se escribe
+    antes que los datos: si el estado se vuelve a mapear mientras tanto su
+    mapped_at ya no coincide y se lee del mapeo.
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"DELETE FROM public.{COMPACT_STATUS_TABLE} WHERE estado_cve = ANY (%s)", (estados,))
+        cur.execute(f"DELETE FROM public.{COMPACT_TABLE} WHERE estado_cve = ANY (%s::SMALLINT[])",
+                    ([int(estado_cve) for estado_cve in estados],))
+        cur.execute(f"""
+            INSERT INTO public.{COMPACT_STATUS_TABLE} (estado_cve, mapped_at)
+            SELECT estado_cve, mapped_at
+            FROM public.{STATUS_TABLE}
+            WHERE estado_cve = ANY (%s)
+        """, (estados,))
+        cur.execute(f"""
+            INSERT INTO public.{COMPACT_TABLE}
+            SELECT
+                public.cvegeo_a_entero(clave_ageb),
+                area_interseccion_m2,
+                codigo_postal::INTEGER,
+                ROUND(porcentaje_interseccion * 100)::SMALLINT,
+                CASE tipo_ageb WHEN 'urbana' THEN 1 ELSE 2 END,
+                CASE tipo_relacion WHEN 'principal' THEN 1 WHEN 'parcial' THEN 2 END,
+                estado_cve::SMALLINT
+            FROM public.{MAPPING_TABLE}
+            WHERE estado_cve IN (SELECT estado_cve FROM public.{COMPACT_STATUS_TABLE}
+                                 WHERE estado_cve = ANY (%s))
+            ORDER BY codigo_postal::INTEGER, porcentaje_interseccion DESC
+        """, (estados,))
+        cur.execute(f"ANALYZE public.{COMPACT_TABLE}")
+    conn.commit()
+    print(f"{len(estados)} estado(s) actualizados ", end="")
+
+
+def rebuild_compact_table(conn):
+    """Construir la tabla compacta completa con otro nombre e intercambiarla
+
+    La tabla nueva (sufijo _new) y su COMPACT_STATUS_TABLE se llenan sin
+    bloquear a nadie; al final se intercambian con las anteriores por RENAME
+    en una transacción corta, así que las consultas no esperan la
+    reconstrucción. La vista se borra y se vuelve a crear, y las tablas
+    anteriores se borran con RESTRICT: otro objeto que dependa de ellas
+    detiene el intercambio en lugar de borrarse en cascada.
+    """
+    with conn.cursor() as cur:
+        compact_new = f"{COMPACT_TABLE}_new"
+        compact_status_new = f"{COMPACT_STATUS_TABLE}_new"
+        cur.execute(f"DROP TABLE IF EXISTS public.{compact_new}, public.{compact_status_new}")
+
+        # Estados incluidos, antes que los datos: si un estado se vuelve a
+        # mapear mientras tanto su mapped_at ya no coincide y se lee del mapeo
+        cur.execute(f"""
+            CREATE TABLE public.{compact_status_new} AS
+            SELECT estado_cve, mapped_at
+            FROM public.{STATUS_TABLE}
+        """)
+        cur.execute(f"ALTER TABLE public.{compact_status_new} ADD PRIMARY KEY (estado_cve)")
+
+        cur.execute(f"""
+            CREATE TABLE public.{compact_new} (
+                clave_ageb BIGINT NOT NULL,
+                area_interseccion_m2 DOUBLE PRECISION,
+                codigo_postal INTEGER NOT NULL,
+                porcentaje_centesimas SMALLINT,
+                tipo_ageb SMALLINT NOT NULL,
+                tipo_relacion SMALLINT,
+                estado_cve SMALLINT NOT NULL
+            )
+        """)
+        cur.execute(f"""
+            INSERT INTO public.{compact_new}
+            SELECT
+                public.cvegeo_a_entero(clave_ageb),
+                area_interseccion_m2,
+                codigo_postal::INTEGER,
+                ROUND(porcentaje_interseccion * 100)::SMALLINT,
+                CASE tipo_ageb WHEN 'urbana' THEN 1 ELSE 2 END,
+                CASE tipo_relacion WHEN 'principal' THEN 1 WHEN 'parcial' THEN 2 END,
+                estado_cve::SMALLINT
+            FROM public.{MAPPING_TABLE}
+            WHERE estado_cve IN (SELECT estado_cve FROM public.{compact_status_new})
+            ORDER BY codigo_postal::INTEGER, porcentaje_interseccion DESC
+        """)
+        cur.execute(f"CREATE INDEX idx_cp_to_ageb_compact_cp_new ON public.{compact_new} (codigo_postal, estado_cve)")
+        cur.execute(f"ANALYZE public.{compact_new}")
+
+    conn.commit()
+
+    # Intercambio: solo esta transacción toma el bloqueo exclusivo
+    with conn.cursor() as cur:
+        cur.execute(f"DROP VIEW IF EXISTS public.{COMPACT_VIEW}")
+        cur.execute(f"DROP TABLE IF EXISTS public.{COMPACT_TABLE}, public.{COMPACT_STATUS_TABLE} RESTRICT")
+        cur.execute(f"ALTER TABLE public.{compact_new} RENAME TO {COMPACT_TABLE}")
+        cur.execute(f"ALTER TABLE public.{compact_status_new} RENAME TO {COMPACT_STATUS_TABLE}")
+        cur.execute("ALTER INDEX public.idx_cp_to_ageb_compact_cp_new RENAME TO idx_cp_to_ageb_compact_cp")
+        cur.execute(f"""
+            COMMENT ON TABLE public.{COMPACT_TABLE} IS
+                'cp_to_ageb_mapping en formato compacto (ver {COMPACT_VIEW})';
+            COMMENT ON COLUMN public.{COMPACT_TABLE}.clave_ageb IS
+                'CVEGEO codificado con cvegeo_a_entero(); decodificar con entero_a_cvegeo()';
+            COMMENT ON COLUMN public.{COMPACT_TABLE}.tipo_ageb IS '1 = urbana, 2 = rural';
+            COMMENT ON COLUMN public.{COMPACT_TABLE}.tipo_relacion IS '1 = principal, 2 = parcial';
+            COMMENT ON COLUMN public.{COMPACT_TABLE}.estado_cve IS 'Clave de entidad como entero';
+            COMMENT ON TABLE public.{COMPACT_STATUS_TABLE} IS
+                'Estados incluidos en {COMPACT_TABLE} y su mapped_at al construirla';
+        """)
+
+        # Misma forma que cp_to_ageb_mapping (sin id ni created_at)
+        cur.execute(f"""
+            CREATE VIEW public.{COMPACT_VIEW} AS
+            SELECT
+                lpad(m.estado_cve::TEXT, 2, '0')::VARCHAR(2) AS estado_cve,
+                lpad(m.codigo_postal::TEXT, 5, '0')::VARCHAR(10) AS codigo_postal,
+                a.cvegeo::VARCHAR(20) AS clave_ageb,
+                (CASE m.tipo_ageb WHEN 1 THEN 'urbana' ELSE 'rural' END)::VARCHAR(10) AS tipo_ageb,
+                m.area_interseccion_m2::NUMERIC(15,2) AS area_interseccion_m2,
+                (m.porcentaje_centesimas / 100.0)::NUMERIC(5,2) AS porcentaje_interseccion,
+                (CASE m.tipo_relacion WHEN 1 THEN 'principal' WHEN 2 THEN 'parcial' END)::VARCHAR(20) AS tipo_relacion
+            FROM public.{COMPACT_TABLE} m
+            CROSS JOIN LATERAL (SELECT public.entero_a_cvegeo(m.clave_ageb) AS cvegeo) a
+        """)
+
+    conn.commit()
+
+
+def refresh_compact_table(conn):
+    """Reconstruir la tabla compacta a partir de cp_to_ageb_mapping
+
+    Por registro: clave_ageb BIGINT (CVEGEO en base 11, alfabeto 0-9 y A
+    del dígito verificador, con un 1 inicial que conserva los ceros a la
+    izquierda), codigo_postal INTEGER, porcentaje en centésimas SMALLINT y
+    tipo_ageb / tipo_relacion / estado_cve SMALLINT; sin id ni created_at.
+    Los registros se insertan ordenados por CP, así que cada CP queda en una
+    o pocas páginas; el índice (codigo_postal, estado_cve) resuelve la
+    lectura por entidad de buscar_agebs_por_cps() sin decodificar el CVEGEO.
+
+    COMPACT_STATUS_TABLE guarda la copia de mapped_at de cada estado
+    incluido; buscar_agebs_por_cps() solo lee la tabla compacta para los
+    estados cuyo mapped_at coincide con cp_to_ageb_mapping_status. Si la
+    tabla ya existe solo se reemplazan los estados cuyo mapped_at cambió
+    (ver update_compact_states); si no existe, tiene el formato anterior o
+    cambiaron todos los estados se reconstruye completa (ver
+    rebuild_compact_table).
+    """
+    print("\nActualizando tabla compacta... ", end="", flush=True)
+
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION public.cvegeo_a_entero(cvegeo TEXT)
+            RETURNS BIGINT AS $$
+            DECLARE
+                valor BIGINT := 1;
+                digito INTEGER;
+            BEGIN
+                FOR i IN 1..length(cvegeo) LOOP
+                    digito := strpos('0123456789A', upper(substr(cvegeo, i, 1))) - 1;
+                    IF digito < 0 THEN
+                        RAISE EXCEPTION 'CVEGEO % no se puede codificar', cvegeo;
+                    END IF;
+                    valor := valor * 11 + digito;
+                END LOOP;
+                RETURN valor;
+            END;
+            $$ LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE;
+
+            CREATE OR REPLACE FUNCTION public.entero_a_cvegeo(valor BIGINT)
+            RETURNS TEXT AS $$
+            DECLARE
+                cvegeo TEXT := '';
+            BEGIN
+                WHILE valor > 1 LOOP
+                    cvegeo := substr('0123456789A', (valor % 11)::INTEGER + 1, 1) || cvegeo;
+                    valor := valor / 11;
+                END LOOP;
+                RETURN cvegeo;
+            END;
+            $$ LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE;
+        """)
+
+    conn.commit()
+
+    cambios = compact_changed_states(conn)
+    if cambios is None:
+        rebuild_compact_table(conn)
+    elif cambios:
+        update_compact_states(conn, cambios)
+    else:
+        print("sin cambios ", end="")
+
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT pg_size_pretty(pg_total_relation_size(%s)),
+                   pg_size_pretty(pg_total_relation_size(%s))
+        """, (f"public.{COMPACT_TABLE}", f"public.{MAPPING_TABLE}"))
+        compacta, original = cur.fetchone()
+    conn.commit()
+    print(f"✓ {compacta} (tabla de mapeo: {original})")
+
+
 def show_summary(conn):
     """Mostrar resumen del mapeo"""
     print("\n" + "=" * 70)
@@ -282,12 +1126,101 @@ def show_summary(conn):
     print("=" * 70)
 
 
+def state_order():
+    """Estados en orden de procesamiento: grandes primero, luego el resto"""
+    return ESTADOS_GRANDES + [cve for cve in ESTADOS if cve not in ESTADOS_GRANDES]
+
+
+def process_state_safe(conn, cve_ent, subdivided=False, version=None):
+    """Procesar un estado; en caso de error hace rollback y retorna 0"""
+    try:
+        return process_state(conn, cve_ent, subdivided=subdivided, version=version)
+    except Exception as e:
+        print(f"  ✗ Error procesando estado {cve_ent}: {e}")
+        conn.rollback()  # Rollback para que la transacción no quede abortada
+        return 0
+
+
+def _process_state_worker(cve_ent, subdivided=False, version=None):
+    """Procesar un estado en un proceso independiente con su propia conexión
+
+    Returns:
+        Tupla (salida capturada, registros insertados)
+    """
+    buffer = io.StringIO()
+    with redirect_stdout(buffer):
+        try:
+            conn = get_connection()
+        except Exception as e:
+            print(f"\n[{cve_ent}] ✗ Error de conexión: {e}")
+            return buffer.getvalue(), 0
+
+        try:
+            count = process_state_safe(conn, cve_ent, subdivided=subdivided, version=version)
+        finally:
+            conn.close()
+
+    return buffer.getvalue(), count
+
+
+def process_states(conn, workers, subdivided=False, version=None):
+    """Procesar todos los estados, en paralelo si workers > 1
+
+    Cada estado hace commit por separado; en modo paralelo la salida de cada
+    estado se muestra completa al terminar.
+    """
+    total_registros = 0
+
+    if workers <= 1:
+        for cve_ent in ESTADOS.keys():
+            total_registros += process_state_safe(conn, cve_ent, subdivided=subdivided, version=version)
+        return total_registros
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_process_state_worker, cve_ent, subdivided, version)
+                   for cve_ent in state_order()]
+        for future in as_completed(futures):
+            output, count = future.result()
+            print(output, end="", flush=True)
+            total_registros += count
+
+    return total_registros
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Crear el mapeo de Códigos Postales a AGEBs")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Estados a procesar en paralelo, cada uno con su conexión (default: 1)")
+    parser.add_argument("--full", action="store_true",
+                        help="Vaciar el mapeo y recalcular los 32 estados "
+                             "(default: solo estados cuyas tablas fuente cambiaron)")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Reconstruir en una versión nueva (UNLOGGED, sin índices), indexarla "
+                             "al final y publicarla en lugar de la actual")
+    parser.add_argument("--rollback", action="store_true",
+                        help="Volver a publicar la versión anterior del mapeo y terminar")
+    parser.add_argument("--compact", action="store_true",
+                        help=f"Crear la tabla compacta {COMPACT_TABLE}; una vez creada se "
+                             "actualiza en cada ejecución")
+    parser.add_argument("--subdivided", action="store_true",
+                        help=f"Cruzar las piezas ST_Subdivide del schema {SUBDIVIDE_SCHEMA} "
+                             "(load_shapefiles.py con SUBDIVIDE_GEOM=true)")
+    args = parser.parse_args()
+    args.workers = max(1, args.workers)
+    return args
+
+
 def main():
+    args = parse_args()
+
     print("=" * 70)
     print("  Script de Mapeo CP → AGEB")
     print("=" * 70)
     print(f"Fecha: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print(f"Base de datos: {DB_CONFIG['database']}@{DB_CONFIG['host']}:{DB_CONFIG['port']}")
+    print(f"Procesos: {args.workers}")
+    print(f"Geometrías subdivididas: {'SÍ' if args.subdivided else 'NO'}")
+    print(f"Modo: {'rollback' if args.rollback else 'versión nueva (--bulk)' if args.bulk else 'completo' if args.full else 'incremental'}")
     print("=" * 70)
 
     # Conectar a la base de datos
@@ -301,31 +1234,39 @@ def main():
     # Crear tabla de mapeo
     create_mapping_table(conn)
 
-    # Preguntar si limpiar tabla existente
-    with conn.cursor() as cur:
-        cur.execute("SELECT COUNT(*) FROM public.cp_to_ageb_mapping")
-        existing_count = cur.fetchone()[0]
-
-        if existing_count > 0:
-            print(f"\n⚠ La tabla ya contiene {existing_count:,} registros")
-            response = input("¿Deseas limpiar la tabla antes de procesar? (s/N): ").strip().lower()
-            if response == 's':
-                cur.execute("TRUNCATE TABLE public.cp_to_ageb_mapping RESTART IDENTITY")
-                conn.commit()
-                print("✓ Tabla limpiada")
-
-    # Procesar cada estado
-    print("\nProcesando estados...")
-    total_registros = 0
+    if args.rollback:
+        version = rollback_version(conn)
+        if version is None:
+            print("✗ No hay versión anterior del mapeo para restaurar")
+            conn.close()
+            sys.exit(1)
+        print(f"✓ Versión {version} publicada de nuevo")
+    elif args.bulk:
+        # Reconstrucción en una versión nueva: la versión publicada sigue
+        # sirviendo lecturas hasta que se apuntan las vistas
+        version = create_version_tables(conn)
 
-    for cve_ent in ESTADOS.keys():
-        try:
-            count = process_state(conn, cve_ent)
-            total_registros += count
-        except Exception as e:
-            print(f"  ✗ Error procesando estado {cve_ent}: {e}")
-            conn.rollback()  # Rollback para que la transacción no quede abortada
-            continue
+        print("\nProcesando estados...")
+        process_states(conn, args.workers, subdivided=args.subdivided, version=version)
+
+        publish_version(conn, version, carry_over=not args.full)
+    else:
+        # Reconstrucción completa; sin --full solo se recalculan los estados
+        # cuya huella cambió
+        if args.full:
+            mapping_table, status_table = published_tables(conn)
+            with conn.cursor() as cur:
+                cur.execute(f"TRUNCATE TABLE public.{mapping_table}, public.{status_table} RESTART IDENTITY")
+            conn.commit()
+            print("✓ Tabla limpiada (--full)")
+
+        # Procesar cada estado
+        print("\nProcesando estados...")
+        process_states(conn, args.workers, subdivided=args.subdivided)
+
+    # La tabla compacta, si existe, se mantiene al día con el mapeo
+    if args.compact or compact_table_exists(conn):
+        refresh_compact_table(conn)
 
     # Mostrar resumen
     show_summary(conn)
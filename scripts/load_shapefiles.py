@@ -3,13 +3,22 @@
 Script para cargar shapefiles de SEPOMEX e INEGI a la base de datos PostGIS
 """
 
+import io
+import json
 import os
 import sys
 import subprocess
 import zipfile
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from functools import partial
+from pathlib import Path, PurePosixPath
 from datetime import datetime
 import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+import native_loader
 
 # Configuración de base de datos (desde variables de entorno o valores por defecto)
 DB_CONFIG = {
@@ -33,18 +42,94 @@ LOAD_LAYERS = {
 # "quick" = solo verificar que se puede abrir (rápido, por defecto)
 # "full" = verificar integridad completa con testzip() (lento pero exhaustivo)
 # "none" = sin validación
+# Los ZIPs verificados al descargarlos (mismo tamaño y fecha que en
+# manifest.json) no se revalidan en ningún modo
 VALIDATE_ZIPS = os.getenv('VALIDATE_ZIPS', 'quick').lower()
 
+# Control de lectura de ZIPs (desde variable de entorno)
+# "extract" (default) = descomprimir en /tmp y cargar desde disco
+# "vsizip" = ogr2ogr lee los shapefiles directo del ZIP vía /vsizip/ (sin disco temporal)
+ZIP_MODE = os.getenv('ZIP_MODE', 'extract').lower()
+
+# Archivos que componen un shapefile (los demás miembros del ZIP no se extraen
+# cuando se filtran capas)
+SHAPEFILE_EXTENSIONS = {'.shp', '.shx', '.dbf', '.prj', '.cpg'}
+
+# Capa de LOAD_LAYERS que controla cada tipo de geometría INEGI,
+# y mensaje a mostrar cuando está deshabilitada
+INEGI_LAYERS = {
+    'ageb_urbana': ('agebs', 'AGEBs deshabilitados'),
+    'ageb_rural': ('agebs', 'AGEBs deshabilitados'),
+    'manzana': ('manzanas', 'Manzanas deshabilitadas'),
+    'localidad': ('localidades', 'Localidades deshabilitadas'),
+    'municipio': ('municipios', 'Municipios deshabilitados'),
+    'entidad': ('entidades', 'Entidades deshabilitadas'),
+}
+
 # Control de sobrescritura de tablas existentes (desde variable de entorno)
 # "false" (default) = saltar tablas que ya existen en la DB (rápido)
 # "true" = sobrescribir todas las tablas
 FORCE_RELOAD = os.getenv('FORCE_RELOAD', 'false').lower() == 'true'
 
+# Manifiesto que escriben los descargadores en cada directorio de ZIPs
+# (download_utils.MANIFEST_NAME). Un ZIP descargado después de su última carga
+# exitosa en load_metadata se vuelve a cargar aunque sus tablas ya existan
+DOWNLOAD_MANIFEST = 'manifest.json'
+
+# Perfil de carga masiva (desde variable de entorno)
+# "false" (default) = ogr2ogr estándar: INSERTs, índice GiST inmediato, tablas con WAL
+# "true" = COPY, transacciones de BULK_LOAD_GT registros, tablas UNLOGGED y
+#          creación diferida de índices GiST y ANALYZE; al terminar cada estado
+#          las tablas vuelven a LOGGED (mismo esquema final)
+BULK_LOAD = os.getenv('BULK_LOAD', 'false').lower() == 'true'
+BULK_LOAD_GT = os.getenv('BULK_LOAD_GT', '65536')
+
+# Motor de carga de shapefiles (desde variable de entorno)
+# "ogr2ogr" (default) = un subproceso ogr2ogr por capa
+# "native" = lector Python de .shp/.dbf + COPY binario sobre la conexión
+#            del proceso (sin subprocesos; mismo esquema de tabla)
+LOADER_BACKEND = os.getenv('LOADER_BACKEND', 'ogr2ogr').lower()
+
+# Geometría canónica en EPSG:6372 (desde variable de entorno)
+# "true" (default) = cada tabla de SEPOMEX/INEGI incluye geom_6372, columna
+#          generada ST_Transform(geom, 6372) con su propio índice GiST; las
+#          búsquedas y el mapeo CP→AGEB la usan sin reproyectar por fila
+# "false" = solo la geometría original (geom) en su SRID de origen
+CANONICAL_GEOM = os.getenv('CANONICAL_GEOM', 'true').lower() == 'true'
+CANONICAL_SRID = 6372
+CANONICAL_COLUMN = f"geom_{CANONICAL_SRID}"
+
+# Geometrías subdivididas para el cruce CP × AGEB (desde variable de entorno)
+# "false" (default) = no se generan
+# "true" = después de cargar, copia ST_Subdivide de las tablas de CPs y de AGEBs
+#          (urbanas y rurales) en el schema subdiv, en EPSG:6372, con índice
+#          GiST y la llave del registro original (parent_fid)
+SUBDIVIDE_GEOM = os.getenv('SUBDIVIDE_GEOM', 'false').lower() == 'true'
+SUBDIVIDE_MAX_VERTICES = int(os.getenv('SUBDIVIDE_MAX_VERTICES', '256') or '256')
+SUBDIVIDE_SCHEMA = 'subdiv'
+
+# Capas unificadas particionadas por estado (desde variable de entorno)
+# "false" (default) = solo tablas por estado
+# "true" = además de las tablas por estado, llena inegi.ageb (particiones
+#          ageb_estado_XX, columna tipo) y sepomex.cp (particiones
+#          cp_estado_XX), LIST por cve_ent y geometría EPSG:6372; es una
+#          segunda copia de las geometrías, así que ocupa espacio adicional
+UNIFIED_LAYERS = os.getenv('UNIFIED_LAYERS', 'false').lower() == 'true'
+UNIFIED_AGEB_TABLE = 'ageb'
+AGEB_PARTITION_PREFIX = 'ageb_estado_'
+UNIFIED_CP_TABLE = 'cp'
+CP_PARTITION_PREFIX = 'cp_estado_'
+
 # Control de estados a cargar (desde variables de entorno)
 # Formato: "01,02,03" o "Ags,BC,BCS" o "Aguascalientes,Baja California"
 # Vacío o "all" = todos los estados
 LOAD_ESTADOS_ENV = os.getenv('LOAD_ESTADOS', 'all').strip()
 
+# Control de paralelismo (desde variable de entorno)
+# 1 (default) = cargar un estado a la vez
+# N > 1 = cargar hasta N estados simultáneamente, cada uno en su propio proceso
+LOAD_WORKERS = max(1, int(os.getenv('LOAD_WORKERS', '1') or '1'))
+
 # Mapeo de estados para SEPOMEX
 ESTADOS_SEPOMEX = {
     "01": ("Ags", "Aguascalientes"),
@@ -184,81 +269,288 @@ def parse_estados_filter() -> set:
 ESTADOS_FILTER = parse_estados_filter()
 
 
-def table_exists(schema: str, table_name: str) -> bool:
-    """Verifica si una tabla existe en la base de datos"""
-    try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cur = conn.cursor()
+# Conexión de larga duración del proceso actual (una por worker con LOAD_WORKERS > 1)
+_db_conn = None
+
+# Snapshot del catálogo tomado al iniciar la carga: {(schema, tabla)}
+# None = sin snapshot (table_exists() consulta la base de datos)
+EXISTING_TABLES = None
+
+# Registros de load_metadata pendientes de insertar (se escriben por lotes)
+_pending_loads = []
 
+
+def get_db_connection():
+    """Retorna la conexión de metadatos del proceso, abriéndola si es necesario"""
+    global _db_conn
+    if _db_conn is None or _db_conn.closed:
+        _db_conn = psycopg2.connect(**DB_CONFIG)
+        _db_conn.autocommit = True
+    return _db_conn
+
+
+def close_db_connection():
+    """Cierra la conexión de metadatos del proceso (si está abierta)"""
+    global _db_conn
+    if _db_conn is not None and not _db_conn.closed:
+        _db_conn.close()
+    _db_conn = None
+
+
+def snapshot_existing_tables() -> set:
+    """Lee una sola vez las tablas existentes en los schemas sepomex e inegi"""
+    with get_db_connection().cursor() as cur:
         cur.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables
-                WHERE table_schema = %s
-                AND table_name = %s
-            )
-        """, (schema, table_name))
+            SELECT table_schema, table_name
+            FROM information_schema.tables
+            WHERE table_schema IN ('sepomex', 'inegi')
+        """)
+        return {(row[0], row[1]) for row in cur.fetchall()}
 
-        exists = cur.fetchone()[0]
 
-        cur.close()
-        conn.close()
+def table_exists(schema: str, table_name: str) -> bool:
+    """Verifica si una tabla existe en la base de datos
+
+    Usa el snapshot del catálogo (EXISTING_TABLES) si está disponible.
+    """
+    if EXISTING_TABLES is not None:
+        return (schema, table_name) in EXISTING_TABLES
 
-        return exists
+    try:
+        with get_db_connection().cursor() as cur:
+            cur.execute("""
+                SELECT EXISTS (
+                    SELECT FROM information_schema.tables
+                    WHERE table_schema = %s
+                    AND table_name = %s
+                )
+            """, (schema, table_name))
+
+            return cur.fetchone()[0]
     except Exception as e:
         # En caso de error, asumir que no existe para intentar cargar
         return False
 
 
-def extract_zip(zip_path: Path, extract_to: Path) -> list:
+def validate_zip(zip_ref: zipfile.ZipFile):
+    """Valida un ZIP abierto según VALIDATE_ZIPS
+
+    Lanza zipfile.BadZipFile si el archivo está corrupto.
+    """
+    if VALIDATE_ZIPS == 'full':
+        # Validación completa (lenta pero exhaustiva)
+        bad_file = zip_ref.testzip()
+        if bad_file:
+            raise zipfile.BadZipFile(f"Archivo corrupto en ZIP: {bad_file}")
+    elif VALIDATE_ZIPS == 'quick':
+        # Validación rápida: verificar que namelist() funciona
+        # Esto detecta ZIPs totalmente corruptos sin verificar cada archivo interno
+        if not zip_ref.namelist():
+            raise zipfile.BadZipFile("ZIP vacío o corrupto")
+    # Si es 'none', no validar (más rápido pero sin verificación)
+
+
+def discard_corrupt_zip(zip_path: Path):
+    """Elimina un ZIP corrupto para permitir re-descarga"""
+    print(f"✗ Archivo ZIP corrupto o inválido")
+    print(f"    Eliminando {zip_path.name} para permitir re-descarga...")
+    try:
+        zip_path.unlink()
+        print(f"    ✓ Archivo eliminado. Re-ejecute para descargar de nuevo.")
+    except Exception as del_err:
+        print(f"    ✗ Error al eliminar: {del_err}")
+
+
+def _select_zip_members(zip_ref: zipfile.ZipFile, layer_filter=None) -> tuple:
+    """Selecciona los shapefiles de un ZIP a partir de su directorio central
+
+    Args:
+        zip_ref: ZIP abierto
+        layer_filter: Función opcional member_name -> motivo (str) para omitir
+                      un .shp, o None para cargarlo
+
+    Returns:
+        Tupla (shp_members, sidecar_members, omitidos) donde sidecar_members son
+        los archivos (.shp/.shx/.dbf/.prj/.cpg) de las capas seleccionadas y
+        omitidos es una lista de (nombre, motivo)
+    """
+    names = [name for name in zip_ref.namelist() if not name.startswith('__MACOSX/')]
+
+    shp_members = []
+    omitidos = []
+    for name in names:
+        if not name.lower().endswith('.shp'):
+            continue
+        reason = layer_filter(name) if layer_filter else None
+        if reason:
+            omitidos.append((PurePosixPath(name).name, reason))
+        else:
+            shp_members.append(name)
+
+    # Archivos hermanos de cada .shp seleccionado (mismo directorio y nombre base)
+    wanted = {str(PurePosixPath(name).with_suffix('')).lower() for name in shp_members}
+    sidecar_members = [
+        name for name in names
+        if PurePosixPath(name).suffix.lower() in SHAPEFILE_EXTENSIONS
+        and str(PurePosixPath(name).with_suffix('')).lower() in wanted
+    ]
+
+    return shp_members, sidecar_members, omitidos
+
+
+def _print_omitidos(omitidos: list):
+    for name, reason in omitidos:
+        print(f"    Omitiendo {name} ({reason})")
+
+
+def extract_zip(zip_path: Path, extract_to: Path, layer_filter=None) -> list:
     """Extrae archivo ZIP y retorna lista de archivos .shp
 
     Si el archivo ZIP está corrupto, lo elimina para permitir re-descarga.
 
+    Con layer_filter solo se descomprimen los archivos de las capas
+    seleccionadas (ver _select_zip_members); sin él se extrae todo el ZIP.
+
     Modos de validación (variable VALIDATE_ZIPS):
     - "quick" (default): Validación rápida - solo verifica que se puede abrir
     - "full": Validación completa - ejecuta testzip() en todos los archivos (lento)
     - "none": Sin validación - solo extrae
+    En modo "quick" los ZIPs con el tamaño y la fecha registrados en el
+    manifiesto de descarga no se revalidan (ver zip_verified_by_manifest);
+    "full" siempre ejecuta testzip().
     """
     print(f"  Extrayendo {zip_path.name}... ", end="", flush=True)
 
     try:
+        omitidos = []
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            # Validación según modo configurado
-            if VALIDATE_ZIPS == 'full':
-                # Validación completa (lenta pero exhaustiva)
-                bad_file = zip_ref.testzip()
-                if bad_file:
-                    raise zipfile.BadZipFile(f"Archivo corrupto en ZIP: {bad_file}")
-            elif VALIDATE_ZIPS == 'quick':
-                # Validación rápida: verificar que namelist() funciona
-                # Esto detecta ZIPs totalmente corruptos sin verificar cada archivo interno
-                if not zip_ref.namelist():
-                    raise zipfile.BadZipFile("ZIP vacío o corrupto")
-            # Si es 'none', no validar (más rápido pero sin verificación)
-
-            zip_ref.extractall(extract_to)
+            if VALIDATE_ZIPS == 'full' or not zip_verified_by_manifest(zip_path):
+                validate_zip(zip_ref)
+            if layer_filter:
+                _, sidecar_members, omitidos = _select_zip_members(zip_ref, layer_filter)
+                zip_ref.extractall(extract_to, members=sidecar_members)
+            else:
+                zip_ref.extractall(extract_to)
 
         # Buscar archivos .shp
         shp_files = list(extract_to.rglob("*.shp"))
         print(f"✓ ({len(shp_files)} shapefiles)")
+        _print_omitidos(omitidos)
 
         return shp_files
-    except zipfile.BadZipFile as e:
-        print(f"✗ Archivo ZIP corrupto o inválido")
-        print(f"    Eliminando {zip_path.name} para permitir re-descarga...")
-        try:
-            zip_path.unlink()
-            print(f"    ✓ Archivo eliminado. Re-ejecute para descargar de nuevo.")
-        except Exception as del_err:
-            print(f"    ✗ Error al eliminar: {del_err}")
+    except zipfile.BadZipFile:
+        discard_corrupt_zip(zip_path)
+        return []
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        return []
+
+
+def list_zip_shapefiles(zip_path: Path, layer_filter=None) -> list:
+    """Enumera los .shp de un ZIP y retorna sus rutas /vsizip/ para GDAL
+
+    Solo lee el directorio central del ZIP; ogr2ogr descomprime los datos al
+    vuelo, así que no se escribe nada en disco temporal. Valida según
+    VALIDATE_ZIPS igual que extract_zip().
+    """
+    print(f"  Leyendo {zip_path.name}... ", end="", flush=True)
+
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            if VALIDATE_ZIPS == 'full' or not zip_verified_by_manifest(zip_path):
+                validate_zip(zip_ref)
+            shp_members, _, omitidos = _select_zip_members(zip_ref, layer_filter)
+
+        # Ruta absoluta: /vsizip//data/.../archivo.zip/ruta/interna.shp
+        shp_files = [f"/vsizip/{zip_path.absolute()}/{member}" for member in shp_members]
+        print(f"✓ ({len(shp_files)} shapefiles)")
+        _print_omitidos(omitidos)
+
+        return shp_files
+    except zipfile.BadZipFile:
+        discard_corrupt_zip(zip_path)
         return []
     except Exception as e:
         print(f"✗ Error: {e}")
         return []
 
 
-def load_shapefile_to_postgis(shp_file: Path, schema: str, table_name: str, transform_to_srid: int = None) -> bool:
-    """Carga un shapefile a PostGIS usando ogr2ogr
+def get_state_shapefiles(zip_path: Path, extract_dir: Path, layer_filter=None) -> list:
+    """Retorna los shapefiles de un ZIP de estado según ZIP_MODE"""
+    if ZIP_MODE == 'vsizip':
+        return list_zip_shapefiles(zip_path, layer_filter)
+
+    extract_dir.mkdir(exist_ok=True)
+    return extract_zip(zip_path, extract_dir, layer_filter)
+
+
+def classify_inegi_layer(stem: str, cve_ent: str) -> str:
+    """Determina el tipo de geometría de un shapefile INEGI por su nombre
+
+    Returns:
+        'ageb_urbana', 'ageb_rural', 'manzana', 'localidad', 'municipio',
+        'entidad', o None si el tipo es desconocido
+    """
+    stem_lower = stem.lower()
+
+    # Patrón INEGI: {cve_ent}a, {cve_ent}ar, {cve_ent}m, etc.
+    # Verificar primero patrones específicos de INEGI
+    if stem_lower == f"{cve_ent}a":
+        return 'ageb_urbana'
+    elif stem_lower == f"{cve_ent}ar":
+        return 'ageb_rural'
+    elif stem_lower == f"{cve_ent}m":
+        return 'manzana'
+    elif stem_lower == f"{cve_ent}l" or stem_lower == f"{cve_ent}lpr":
+        return 'localidad'
+    elif stem_lower == f"{cve_ent}mun":
+        return 'municipio'
+    elif stem_lower in [f"{cve_ent}ent", f"{cve_ent}e"]:
+        return 'entidad'
+    # Patrones genéricos para otros formatos
+    elif 'ageb_urb' in stem_lower or 'ageb urbana' in stem_lower:
+        return 'ageb_urbana'
+    elif 'ageb_rur' in stem_lower or 'ageb rural' in stem_lower:
+        return 'ageb_rural'
+    elif 'manzana' in stem_lower:
+        return 'manzana'
+    elif 'localidad' in stem_lower:
+        return 'localidad'
+    elif 'municipio' in stem_lower:
+        return 'municipio'
+    elif 'entidad' in stem_lower:
+        return 'entidad'
+
+    return None
+
+
+def inegi_skip_reason(member_name: str, cve_ent: str) -> str:
+    """Motivo para omitir un shapefile INEGI, o None si se debe cargar
+
+    Se evalúa sobre el nombre dentro del ZIP, antes de extraer, para no
+    descomprimir capas deshabilitadas en LOAD_LAYERS.
+    """
+    geom_type = classify_inegi_layer(PurePosixPath(member_name).stem, cve_ent)
+    if geom_type is None:
+        return "tipo desconocido"
+
+    layer, reason = INEGI_LAYERS[geom_type]
+    if not LOAD_LAYERS[layer]:
+        return reason
+
+    return None
+
+
+def shapefile_name(shp_file) -> PurePosixPath:
+    """Nombre de un shapefile extraído (Path) o dentro de un ZIP (/vsizip/)"""
+    return PurePosixPath(PurePosixPath(str(shp_file)).name)
+
+
+def load_shapefile_to_postgis(shp_file: Path, schema: str, table_name: str, transform_to_srid: int = None,
+                              force: bool = False) -> bool:
+    """Carga un shapefile a PostGIS usando ogr2ogr o el cargador nativo (LOADER_BACKEND)
+
+    Con force=True la tabla se sobrescribe aunque exista (igual que FORCE_RELOAD).
 
     Retorna:
         True si se cargó exitosamente
@@ -267,11 +559,23 @@ def load_shapefile_to_postgis(shp_file: Path, schema: str, table_name: str, tran
     """
     try:
         # Verificar si la tabla ya existe (a menos que FORCE_RELOAD esté activo)
-        if not FORCE_RELOAD and table_exists(schema, table_name):
+        if not (FORCE_RELOAD or force) and table_exists(schema, table_name):
             print(f"    [✓] {schema}.{table_name} (ya cargado)")
             return None  # Indica que se saltó
 
-        print(f"    Cargando {shp_file.name} → {schema}.{table_name}... ", end="", flush=True)
+        print(f"    Cargando {shapefile_name(shp_file)} → {schema}.{table_name}... ", end="", flush=True)
+
+        if LOADER_BACKEND == 'native':
+            # BULK_LOAD: tabla UNLOGGED e índice diferido a finalize_bulk_tables
+            stats = native_loader.load_shapefile(
+                get_db_connection(), shp_file, schema, table_name,
+                transform_to_srid=transform_to_srid,
+                unlogged=BULK_LOAD,
+                spatial_index=not BULK_LOAD,
+            )
+            omitidos = f", {stats['skipped']} omitidos" if stats['skipped'] else ""
+            print(f"✓ ({stats['rows']:,} registros{omitidos})")
+            return True
 
         # Build connection string - omit host if empty (Unix socket)
         if DB_CONFIG['host']:
@@ -300,6 +604,16 @@ def load_shapefile_to_postgis(shp_file: Path, schema: str, table_name: str, tran
         if transform_to_srid:
             cmd.extend(["-t_srs", f"EPSG:{transform_to_srid}"])
 
+        # Perfil de carga masiva: COPY, lotes grandes, sin WAL ni índice inline
+        # (el índice GiST y ANALYZE se crean en finalize_bulk_tables)
+        if BULK_LOAD:
+            cmd[1:1] = ["--config", "PG_USE_COPY", "YES"]
+            cmd.extend([
+                "-gt", BULK_LOAD_GT,
+                "-lco", "UNLOGGED=ON",
+                "-lco", "SPATIAL_INDEX=NONE",
+            ])
+
         result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
 
         if result.returncode == 0:
@@ -319,24 +633,730 @@ def load_shapefile_to_postgis(shp_file: Path, schema: str, table_name: str, tran
         return False
 
 
-def register_load(table_name: str, source: str, file_name: str, rows_count: int = None, status: str = 'success'):
-    """Registra la carga en la tabla de metadatos"""
+def run_table_step(tables: list, step) -> list:
+    """Ejecuta step(cur, schema, tabla) sobre cada tabla e informa el resultado
+
+    Un error en una tabla no detiene las demás.
+
+    Returns:
+        Lista de (schema, tabla) en las que step falló
+    """
+    fallidas = []
+    errores = []
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cur = conn.cursor()
+        with get_db_connection().cursor() as cur:
+            for schema, table_name in tables:
+                try:
+                    step(cur, schema, table_name)
+                except Exception as e:
+                    fallidas.append((schema, table_name))
+                    errores.append(f"{schema}.{table_name}: {e}")
+    except Exception as e:
+        fallidas = list(tables)
+        errores = [str(e)]
+
+    if errores:
+        print(f"✗ Error en {len(fallidas)} tabla(s)")
+        for error in errores:
+            print(f"    ✗ {error}")
+    else:
+        print("✓")
+    return fallidas
+
+
+def canonical_column_sql() -> sql.Composed:
+    """Cláusula ADD COLUMN de geom_6372, columna generada a partir de geom"""
+    return sql.SQL(
+        "ADD COLUMN IF NOT EXISTS {} geometry(Geometry, {}) "
+        "GENERATED ALWAYS AS (ST_Transform(geom, {})) STORED"
+    ).format(sql.Identifier(CANONICAL_COLUMN), sql.Literal(CANONICAL_SRID), sql.Literal(CANONICAL_SRID))
+
+
+def finalize_bulk_tables(tables: list) -> list:
+    """Etapa post-carga del perfil BULK_LOAD
+
+    Para cada (schema, tabla): vuelve la tabla a LOGGED, crea el índice GiST
+    que ogr2ogr habría creado (mismo nombre) y ejecuta ANALYZE. Con
+    CANONICAL_GEOM, geom_6372 se agrega en el mismo ALTER TABLE que SET
+    LOGGED, así que la tabla se reescribe una sola vez (el índice de
+    geom_6372 y ANALYZE quedan para add_canonical_geometry).
+
+    Returns:
+        Lista de (schema, tabla) en las que falló
+    """
+    if not BULK_LOAD or not tables:
+        return []
+
+    print(f"  Post-carga ({len(tables)} tablas): LOGGED, índices GiST, ANALYZE... ", end="", flush=True)
+
+    def finalize(cur, schema, table_name):
+        table = sql.Identifier(schema, table_name)
+        if CANONICAL_GEOM:
+            cur.execute(sql.SQL("ALTER TABLE {} SET LOGGED, {}").format(table, canonical_column_sql()))
+        else:
+            cur.execute(sql.SQL("ALTER TABLE {} SET LOGGED").format(table))
+        cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING GIST (geom)").format(
+            sql.Identifier(f"{table_name}_geom_geom_idx"), table))
+        if not CANONICAL_GEOM:
+            cur.execute(sql.SQL("ANALYZE {}").format(table))
+
+    return run_table_step(tables, finalize)
+
+
+def add_canonical_geometry(tables: list) -> list:
+    """Agrega la geometría canónica (geom_6372) a cada (schema, tabla)
 
+    Es una columna generada, así que se mantiene sincronizada con geom y se
+    calcula una sola vez por registro. Tablas que ya la tienen no se tocan
+    (bajo BULK_LOAD la agrega finalize_bulk_tables y aquí solo se indexa).
+
+    Returns:
+        Lista de (schema, tabla) en las que falló
+    """
+    if not CANONICAL_GEOM or not tables:
+        return []
+
+    print(f"  Geometría canónica EPSG:{CANONICAL_SRID} ({len(tables)} tablas)... ", end="", flush=True)
+
+    def add_column(cur, schema, table_name):
+        table = sql.Identifier(schema, table_name)
+        cur.execute(sql.SQL("ALTER TABLE {} {}").format(table, canonical_column_sql()))
+        cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING GIST ({})").format(
+            sql.Identifier(f"{table_name}_{CANONICAL_COLUMN}_idx"), table,
+            sql.Identifier(CANONICAL_COLUMN)))
+        cur.execute(sql.SQL("ANALYZE {}").format(table))
+
+    return run_table_step(tables, add_column)
+
+
+def post_load_tables(tables: list, source: str, file_name: str) -> list:
+    """Post-carga de las tablas de un estado y registro de cada carga
+
+    Ejecuta finalize_bulk_tables y add_canonical_geometry; una tabla en la que
+    alguna falla se registra como 'failed' en load_metadata.
+
+    Returns:
+        Lista de (schema, tabla) cargadas correctamente
+    """
+    fallidas = finalize_bulk_tables(tables)
+    fallidas += add_canonical_geometry([t for t in tables if t not in fallidas])
+
+    for schema, table_name in tables:
+        status = 'failed' if (schema, table_name) in fallidas else 'success'
+        register_load(table_name, source, file_name, status=status)
+    return [t for t in tables if t not in fallidas]
+
+
+def tables_without_canonical_geometry() -> list:
+    """Tablas de SEPOMEX/INEGI con geom pero sin geom_6372 (cargas anteriores)"""
+    with get_db_connection().cursor() as cur:
         cur.execute("""
-            INSERT INTO public.load_metadata (table_name, source, file_name, rows_count, status)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (table_name, source, file_name, rows_count, status))
+            SELECT c.table_schema, c.table_name
+            FROM information_schema.columns c
+            WHERE c.table_schema IN ('sepomex', 'inegi')
+              AND c.column_name = 'geom'
+              AND NOT EXISTS (
+                  SELECT 1 FROM information_schema.columns g
+                  WHERE g.table_schema = c.table_schema
+                    AND g.table_name = c.table_name
+                    AND g.column_name = %s
+              )
+            ORDER BY c.table_schema, c.table_name
+        """, (CANONICAL_COLUMN,))
+        # Las capas unificadas ya guardan geom en EPSG:6372
+        return [(schema, table_name) for schema, table_name in cur.fetchall()
+                if not is_unified_table(schema, table_name)]
+
+
+def is_sepomex_cp_table(schema: str, table_name: str) -> bool:
+    """Indica si la tabla es una tabla de CPs por estado (cp_{cve}_{nombre})"""
+    return schema == 'sepomex' and table_name.startswith('cp_') and \
+        not is_unified_table(schema, table_name)
+
+
+def subdivide_key(schema: str, table_name: str) -> str:
+    """Columna llave que se copia a la tabla subdividida, o None si no aplica"""
+    if is_sepomex_cp_table(schema, table_name):
+        return 'd_cp'
+    if schema == 'inegi' and table_name.startswith(('ageb_urbana_', 'ageb_rural_')):
+        return 'cvegeo'
+    return None
 
-        conn.commit()
-        cur.close()
-        conn.close()
+
+def build_subdivided_tables(tables: list):
+    """Materializa copias subdivididas (ST_Subdivide) de las tablas de CPs y AGEBs
+
+    Cada pieza guarda parent_fid (ogc_fid del registro original) y la llave
+    (d_cp o cvegeo); las piezas de un mismo registro no se traslapan, así que
+    la suma de áreas de intersección por pieza es igual a la del original.
+    Cada construcción se registra en load_metadata como 'subdiv.<tabla>'
+    (create_cp_ageb_mapping.py --subdivided la incluye en la huella).
+    """
+    if not SUBDIVIDE_GEOM:
+        return
+
+    tables = [(schema, table_name) for schema, table_name in tables if subdivide_key(schema, table_name)]
+    if not tables:
+        return
+
+    print(f"  Geometrías subdivididas ({len(tables)} tablas, máx. {SUBDIVIDE_MAX_VERTICES} vértices)... ",
+          end="", flush=True)
+
+    geom_6372 = sql.Identifier(CANONICAL_COLUMN) if CANONICAL_GEOM else \
+        sql.SQL("ST_Transform(geom, {})").format(sql.Literal(CANONICAL_SRID))
+
+    errores = []
+    with get_db_connection().cursor() as cur:
+        for schema, table_name in tables:
+            target = sql.Identifier(SUBDIVIDE_SCHEMA, table_name)
+            try:
+                cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(target))
+                cur.execute(sql.SQL("""
+                    CREATE TABLE {target} AS
+                    SELECT ogc_fid AS parent_fid, {key},
+                           ST_Subdivide({geom}, {max_vertices})::geometry(Geometry, {srid}) AS geom
+                    FROM {source}
+                    WHERE geom IS NOT NULL
+                """).format(
+                    target=target,
+                    key=sql.Identifier(subdivide_key(schema, table_name)),
+                    geom=geom_6372,
+                    max_vertices=sql.Literal(SUBDIVIDE_MAX_VERTICES),
+                    srid=sql.Literal(CANONICAL_SRID),
+                    source=sql.Identifier(schema, table_name),
+                ))
+                piezas = cur.rowcount
+                cur.execute(sql.SQL("CREATE INDEX {} ON {} USING GIST (geom)").format(
+                    sql.Identifier(f"{table_name}_geom_idx"), target))
+                cur.execute(sql.SQL("CREATE INDEX {} ON {} (parent_fid)").format(
+                    sql.Identifier(f"{table_name}_parent_fid_idx"), target))
+                cur.execute(sql.SQL("ANALYZE {}").format(target))
+                register_load(f"{SUBDIVIDE_SCHEMA}.{table_name}", "SUBDIV", table_name, piezas)
+            except Exception as e:
+                errores.append(f"{table_name}: {e}")
+                register_load(f"{SUBDIVIDE_SCHEMA}.{table_name}", "SUBDIV", table_name, status='failed')
+
+    if errores:
+        print(f"✗ {len(errores)} con error")
+        for error in errores:
+            print(f"    ✗ {error.splitlines()[0][:100]}")
+    else:
+        print("✓")
+
+
+def tables_without_subdivision() -> list:
+    """Tablas de CPs/AGEBs sin copia subdividida (cargas anteriores)"""
+    with get_db_connection().cursor() as cur:
+        cur.execute("""
+            SELECT t.table_schema, t.table_name
+            FROM information_schema.tables t
+            WHERE t.table_schema IN ('sepomex', 'inegi')
+              AND NOT EXISTS (
+                  SELECT 1 FROM information_schema.tables s
+                  WHERE s.table_schema = %s
+                    AND s.table_name = t.table_name
+              )
+            ORDER BY t.table_schema, t.table_name
+        """, (SUBDIVIDE_SCHEMA,))
+        return [(schema, table_name) for schema, table_name in cur.fetchall()
+                if subdivide_key(schema, table_name)]
+
+
+def is_unified_table(schema: str, table_name: str) -> bool:
+    """Indica si la tabla es una capa unificada o una de sus particiones"""
+    if schema == 'inegi':
+        return table_name == UNIFIED_AGEB_TABLE or table_name.startswith(AGEB_PARTITION_PREFIX)
+    if schema == 'sepomex':
+        return table_name == UNIFIED_CP_TABLE or table_name.startswith(CP_PARTITION_PREFIX)
+    return False
+
+
+def ensure_unified_layers():
+    """Crea inegi.ageb y sepomex.cp (particionadas por entidad) y sus índices
+
+    Se ejecuta una vez en main(), antes de los procesos de carga; los
+    procesos solo crean y llenan particiones.
+    """
+    with get_db_connection().cursor() as cur:
+        cur.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {table} (
+                cve_ent VARCHAR(2) NOT NULL,
+                tipo VARCHAR(10) NOT NULL,
+                cvegeo VARCHAR(20),
+                source_fid INTEGER NOT NULL,
+                geom geometry(Geometry, {srid}) NOT NULL
+            ) PARTITION BY LIST (cve_ent)
+        """).format(table=sql.Identifier('inegi', UNIFIED_AGEB_TABLE), srid=sql.Literal(CANONICAL_SRID)))
+        cur.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {table} (
+                cve_ent VARCHAR(2) NOT NULL,
+                d_cp VARCHAR(10),
+                source_table VARCHAR(100) NOT NULL,
+                source_fid INTEGER NOT NULL,
+                geom geometry(Geometry, {srid}) NOT NULL
+            ) PARTITION BY LIST (cve_ent)
+        """).format(table=sql.Identifier('sepomex', UNIFIED_CP_TABLE), srid=sql.Literal(CANONICAL_SRID)))
+
+        for schema, table_name, column, method in (('inegi', UNIFIED_AGEB_TABLE, 'geom', 'GIST'),
+                                                   ('inegi', UNIFIED_AGEB_TABLE, 'cvegeo', 'BTREE'),
+                                                   ('sepomex', UNIFIED_CP_TABLE, 'geom', 'GIST'),
+                                                   ('sepomex', UNIFIED_CP_TABLE, 'd_cp', 'BTREE')):
+            cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING {} ({})").format(
+                sql.Identifier(f"{table_name}_{column}_idx"), sql.Identifier(schema, table_name),
+                sql.SQL(method), sql.Identifier(column)))
+
+
+def rebuild_state_partition(cur, schema: str, parent: str, prefix: str, cve_ent: str,
+                            columns: list, selects: list):
+    """Vacía y vuelve a llenar la partición de un estado en una transacción
+
+    columns son las columnas destino y selects los SELECT (sql.Composed)
+    que producen sus filas.
+    """
+    partition = sql.Identifier(schema, f"{prefix}{cve_ent}")
+    cur.execute("BEGIN")
+    try:
+        cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES IN ({})").format(
+            partition, sql.Identifier(schema, parent), sql.Literal(cve_ent)))
+        cur.execute(sql.SQL("TRUNCATE {}").format(partition))
+        for select in selects:
+            cur.execute(sql.SQL("INSERT INTO {} ({}) {}").format(
+                partition, sql.SQL(', ').join(map(sql.Identifier, columns)), select))
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    cur.execute(sql.SQL("ANALYZE {}").format(partition))
+
+
+def canonical_geometry_expr():
+    """Expresión de la geometría en EPSG:6372 de una tabla de origen"""
+    if CANONICAL_GEOM:
+        return sql.Identifier(CANONICAL_COLUMN)
+    return sql.SQL("ST_Transform(geom, {})").format(sql.Literal(CANONICAL_SRID))
+
+
+def refresh_unified_ageb(tables: list):
+    """Reconstruye la partición de inegi.ageb de cada estado con AGEBs cargadas
+
+    Cada partición (ageb_estado_XX) se vacía y se llena con las AGEBs
+    urbanas y rurales del estado en una sola transacción.
+    """
+    if not UNIFIED_LAYERS:
+        return
+
+    estados = sorted({table_name[-2:] for schema, table_name in tables
+                      if schema == 'inegi' and table_name.startswith(('ageb_urbana_', 'ageb_rural_'))})
+    if not estados:
+        return
+
+    print(f"  Capa unificada inegi.{UNIFIED_AGEB_TABLE} ({len(estados)} estados)... ", end="", flush=True)
+
+    try:
+        with get_db_connection().cursor() as cur:
+            for cve_ent in estados:
+                selects = []
+                for tipo in ('urbana', 'rural'):
+                    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f"inegi.ageb_{tipo}_{cve_ent}",))
+                    if not cur.fetchone()[0]:
+                        continue
+                    selects.append(sql.SQL("""
+                        SELECT {cve_ent}, {tipo}, cvegeo, ogc_fid, {geom}
+                        FROM {source}
+                        WHERE geom IS NOT NULL
+                    """).format(
+                        cve_ent=sql.Literal(cve_ent),
+                        tipo=sql.Literal(tipo),
+                        geom=canonical_geometry_expr(),
+                        source=sql.Identifier('inegi', f"ageb_{tipo}_{cve_ent}"),
+                    ))
+                rebuild_state_partition(cur, 'inegi', UNIFIED_AGEB_TABLE, AGEB_PARTITION_PREFIX, cve_ent,
+                                        ['cve_ent', 'tipo', 'cvegeo', 'source_fid', 'geom'], selects)
+        print("✓")
+    except Exception as e:
+        print(f"✗ Error: {e}")
+
+
+def refresh_unified_cp(tables: list):
+    """Reconstruye la partición de sepomex.cp de cada estado con CPs cargados
+
+    Cada partición (cp_estado_XX) se vacía y se llena con todas las tablas
+    cp_XX_* del estado en una sola transacción; source_table y source_fid
+    identifican el registro de origen.
+    """
+    if not UNIFIED_LAYERS:
+        return
+
+    estados = sorted({table_name[3:5] for schema, table_name in tables
+                      if is_sepomex_cp_table(schema, table_name)})
+    if not estados:
+        return
+
+    print(f"  Capa unificada sepomex.{UNIFIED_CP_TABLE} ({len(estados)} estados)... ", end="", flush=True)
+
+    try:
+        with get_db_connection().cursor() as cur:
+            for cve_ent in estados:
+                cur.execute("""
+                    SELECT table_name
+                    FROM information_schema.tables
+                    WHERE table_schema = 'sepomex'
+                      AND table_name LIKE %s
+                    ORDER BY table_name
+                """, (f"cp\\_{cve_ent}\\_%",))
+                selects = [
+                    sql.SQL("""
+                        SELECT {cve_ent}, d_cp, {source_table}, ogc_fid, {geom}
+                        FROM {source}
+                        WHERE geom IS NOT NULL
+                    """).format(
+                        cve_ent=sql.Literal(cve_ent),
+                        source_table=sql.Literal(table_name),
+                        geom=canonical_geometry_expr(),
+                        source=sql.Identifier('sepomex', table_name),
+                    )
+                    for (table_name,) in cur.fetchall()
+                ]
+                rebuild_state_partition(cur, 'sepomex', UNIFIED_CP_TABLE, CP_PARTITION_PREFIX, cve_ent,
+                                        ['cve_ent', 'd_cp', 'source_table', 'source_fid', 'geom'], selects)
+        print("✓")
+    except Exception as e:
+        print(f"✗ Error: {e}")
+
+
+def states_missing_unified_layers() -> list:
+    """Tablas de AGEBs/CPs de estados sin partición en la capa unificada (cargas anteriores)"""
+    with get_db_connection().cursor() as cur:
+        cur.execute("""
+            SELECT t.table_schema, t.table_name
+            FROM information_schema.tables t
+            WHERE (t.table_schema = 'inegi'
+                   AND (t.table_name LIKE 'ageb\\_urbana\\_%%' OR t.table_name LIKE 'ageb\\_rural\\_%%')
+                   AND to_regclass(format('inegi.%%I', %s || right(t.table_name, 2))) IS NULL)
+               OR (t.table_schema = 'sepomex'
+                   AND t.table_name ~ '^cp_[0-9]{2}_'
+                   AND to_regclass(format('sepomex.%%I', %s || substr(t.table_name, 4, 2))) IS NULL)
+            ORDER BY t.table_schema, t.table_name
+        """, (AGEB_PARTITION_PREFIX, CP_PARTITION_PREFIX))
+        return cur.fetchall()
+
+
+def ensure_subdivide_schema():
+    """Crea el schema de piezas subdivididas en bases inicializadas antes de que existiera"""
+    with get_db_connection().cursor() as cur:
+        cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(SUBDIVIDE_SCHEMA)))
+
+
+def ensure_cp_directory():
+    """Crea public.cp_directory en bases inicializadas antes de que existiera"""
+    with get_db_connection().cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.cp_directory (
+                d_cp VARCHAR(10) NOT NULL,
+                cve_ent VARCHAR(2) NOT NULL,
+                source_table VARCHAR(100) NOT NULL,
+                bbox geometry(Polygon, 6372),
+                area_m2 DOUBLE PRECISION,
+                PRIMARY KEY (d_cp, source_table)
+            )
+        """)
+
+
+def refresh_cp_directory(tables: list):
+    """Reconstruye las entradas de public.cp_directory de cada tabla SEPOMEX
+
+    Una fila por (d_cp, tabla) con la entidad, el bbox y el área en EPSG:6372,
+    para que las búsquedas resuelvan la entidad con una lectura del índice.
+    """
+    tables = [(schema, table_name) for schema, table_name in tables
+              if is_sepomex_cp_table(schema, table_name)]
+    if not tables:
+        return
+
+    print(f"  Directorio de CPs ({len(tables)} tablas)... ", end="", flush=True)
+
+    geom_6372 = sql.Identifier(CANONICAL_COLUMN) if CANONICAL_GEOM else \
+        sql.SQL("ST_Transform(geom, {})").format(sql.Literal(CANONICAL_SRID))
+
+    try:
+        with get_db_connection().cursor() as cur:
+            for schema, table_name in tables:
+                cur.execute("BEGIN")
+                try:
+                    cur.execute("DELETE FROM public.cp_directory WHERE source_table = %s", (table_name,))
+                    cur.execute(sql.SQL("""
+                        INSERT INTO public.cp_directory (d_cp, cve_ent, source_table, bbox, area_m2)
+                        SELECT d_cp, {cve_ent}, {source_table},
+                               ST_SetSRID(ST_Extent(g)::geometry, {srid}), SUM(ST_Area(g))
+                        FROM (SELECT d_cp, {geom} AS g FROM {table} WHERE d_cp IS NOT NULL) t
+                        GROUP BY d_cp
+                    """).format(
+                        cve_ent=sql.Literal(table_name[3:5]),
+                        source_table=sql.Literal(table_name),
+                        srid=sql.Literal(CANONICAL_SRID),
+                        geom=geom_6372,
+                        table=sql.Identifier(schema, table_name),
+                    ))
+                    cur.execute("COMMIT")
+                except Exception:
+                    cur.execute("ROLLBACK")
+                    raise
+        print("✓")
+    except Exception as e:
+        print(f"✗ Error: {e}")
+
+
+def tables_missing_from_cp_directory() -> list:
+    """Tablas SEPOMEX sin entradas en public.cp_directory (cargas anteriores)"""
+    with get_db_connection().cursor() as cur:
+        cur.execute("""
+            SELECT t.table_schema, t.table_name
+            FROM information_schema.tables t
+            WHERE t.table_schema = 'sepomex'
+              AND t.table_name LIKE 'cp\\_%'
+              AND NOT EXISTS (
+                  SELECT 1 FROM public.cp_directory d
+                  WHERE d.source_table = t.table_name
+              )
+            ORDER BY t.table_name
+        """)
+        return [(schema, table_name) for schema, table_name in cur.fetchall()
+                if is_sepomex_cp_table(schema, table_name)]
+
+
+def download_manifest_entry(zip_file: Path) -> dict:
+    """Entrada de un ZIP en el manifiesto de descarga de su directorio ({} si no hay)"""
+    try:
+        manifest = json.loads((zip_file.parent / DOWNLOAD_MANIFEST).read_text())
+    except (OSError, ValueError):
+        return {}
+    return manifest.get(zip_file.name) or {}
+
+
+def zip_verified_by_manifest(zip_file: Path) -> bool:
+    """True si el ZIP tiene el tamaño y la fecha con que se verificó al descargarlo
+
+    El descargador revisa el directorio central al terminar la descarga; si el
+    archivo no cambió desde entonces no hace falta repetir la validación rápida.
+    No sustituye a testzip(): VALIDATE_ZIPS=full descomprime el ZIP de todos modos.
+    """
+    entry = download_manifest_entry(zip_file)
+    if not entry:
+        return False
+    try:
+        stat = zip_file.stat()
+    except OSError:
+        return False
+    return entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns
+
+
+def zip_changed_since_load(zip_file: Path) -> bool:
+    """True si el manifiesto de descarga registra el ZIP como descargado después
+    de su última carga exitosa (estados sin cargas previas se cargan de todos modos)
+    """
+    downloaded_at = download_manifest_entry(zip_file).get('downloaded_at')
+    if not downloaded_at:
+        return False
+
+    try:
+        with get_db_connection().cursor() as cur:
+            cur.execute("""
+                SELECT MAX(loaded_at) < %s::timestamptz
+                FROM public.load_metadata
+                WHERE file_name = %s AND status = 'success'
+            """, (downloaded_at, zip_file.name))
+            return bool(cur.fetchone()[0])
+    except Exception:
+        return False
+
+
+def register_load(table_name: str, source: str, file_name: str, rows_count: int = None, status: str = 'success'):
+    """Registra la carga en la tabla de metadatos
+
+    El registro queda pendiente hasta el siguiente flush_load_metadata().
+    """
+    _pending_loads.append((table_name, source, file_name, rows_count, status))
+
+
+def flush_load_metadata():
+    """Inserta en un solo lote los registros de carga pendientes"""
+    if not _pending_loads:
+        return
+
+    rows = list(_pending_loads)
+    _pending_loads.clear()
+
+    try:
+        with get_db_connection().cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO public.load_metadata (table_name, source, file_name, rows_count, status)
+                VALUES %s
+            """, rows)
     except Exception as e:
         print(f"  Advertencia: No se pudo registrar la carga: {e}")
 
 
+def _init_worker(existing_tables):
+    """Inicializa un proceso worker: snapshot del catálogo y conexión propia"""
+    global EXISTING_TABLES, _db_conn
+    EXISTING_TABLES = existing_tables
+    _db_conn = None
+
+
+def _run_buffered(job, args) -> tuple:
+    """Ejecuta un job de estado capturando su salida para imprimirla completa
+
+    Los registros de load_metadata que el job dejó pendientes se escriben
+    aunque falle, para no perder los de las tablas que sí se cargaron.
+
+    Returns:
+        Tupla (salida, (exitosos, fallidos))
+    """
+    buffer = io.StringIO()
+    with redirect_stdout(buffer):
+        try:
+            counts = job(*args)
+        except Exception as e:
+            print(f"  ✗ Error inesperado en estado {args[0]}: {e}")
+            counts = (0, 1)
+        finally:
+            flush_load_metadata()
+    return buffer.getvalue(), counts
+
+
+def run_state_jobs(job, jobs: list) -> tuple:
+    """Ejecuta job(*args) para cada estado y acumula sus contadores
+
+    Con LOAD_WORKERS > 1 cada estado se procesa en su propio proceso (máximo
+    LOAD_WORKERS simultáneos). La salida de cada estado se acumula en memoria y
+    se imprime completa al terminar, para que los logs no se intercalen.
+
+    Returns:
+        Tupla (exitosos, fallidos) sumada sobre todos los estados
+    """
+    exitosos = 0
+    fallidos = 0
+
+    if LOAD_WORKERS <= 1 or len(jobs) <= 1:
+        for args in jobs:
+            estado_exitosos, estado_fallidos = job(*args)
+            exitosos += estado_exitosos
+            fallidos += estado_fallidos
+        return exitosos, fallidos
+
+    workers = min(LOAD_WORKERS, len(jobs))
+    print(f"Cargando {len(jobs)} estados con {workers} procesos en paralelo...\n", flush=True)
+
+    # Cada worker abre su propia conexión; no compartir la del proceso padre
+    flush_load_metadata()
+    close_db_connection()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(EXISTING_TABLES,)) as pool:
+        futures = [pool.submit(_run_buffered, job, args) for args in jobs]
+        for future in as_completed(futures):
+            output, (estado_exitosos, estado_fallidos) = future.result()
+            print(output, end="", flush=True)
+            exitosos += estado_exitosos
+            fallidos += estado_fallidos
+
+    return exitosos, fallidos
+
+
+def load_sepomex_state(cve_ent: str, zip_file: Path, temp_dir: Path, reload: bool = False) -> tuple:
+    """Carga los shapefiles de SEPOMEX de un estado
+
+    Con reload=True (ZIP nuevo según el manifiesto) sus tablas se sobrescriben.
+
+    Returns:
+        Tupla (exitosos, fallidos)
+    """
+    exitosos = 0
+    fallidos = 0
+
+    print(f"[{cve_ent}] {ESTADOS_SEPOMEX[cve_ent][1]}")
+
+    # Extraer ZIP (o leerlo directamente con /vsizip/)
+    extract_dir = temp_dir / f"cp_{cve_ent}"
+    shp_files = get_state_shapefiles(zip_file, extract_dir)
+
+    # Cargar cada shapefile
+    loaded_tables = []
+    for shp_file in shp_files:
+        table_name = f"cp_{cve_ent}_{shapefile_name(shp_file).stem.lower()}"
+
+        # Cargar con proyección nativa (ambos usan Lambert Conformal Conic)
+        if load_shapefile_to_postgis(shp_file, "sepomex", table_name, force=reload):
+            loaded_tables.append(("sepomex", table_name))
+        else:
+            register_load(table_name, "SEPOMEX", zip_file.name, status='failed')
+            fallidos += 1
+
+    cargadas = post_load_tables(loaded_tables, "SEPOMEX", zip_file.name)
+    exitosos += len(cargadas)
+    fallidos += len(loaded_tables) - len(cargadas)
+    loaded_tables = cargadas
+
+    refresh_cp_directory(loaded_tables)
+    build_subdivided_tables(loaded_tables)
+    refresh_unified_cp(loaded_tables)
+    flush_load_metadata()
+
+    # Limpiar archivos temporales
+    if extract_dir.exists():
+        subprocess.run(["rm", "-rf", str(extract_dir)], check=False)
+
+    return exitosos, fallidos
+
+
+def load_inegi_state(cve_ent: str, zip_file: Path, temp_dir: Path, reload: bool = False) -> tuple:
+    """Carga los shapefiles de INEGI de un estado según LOAD_LAYERS
+
+    Con reload=True (ZIP nuevo según el manifiesto) sus tablas se sobrescriben.
+
+    Returns:
+        Tupla (exitosos, fallidos)
+    """
+    exitosos = 0
+    fallidos = 0
+
+    print(f"[{cve_ent}] {ESTADOS_INEGI[cve_ent].title()}")
+
+    # Extraer ZIP (o leerlo directamente con /vsizip/), solo capas habilitadas
+    extract_dir = temp_dir / f"ageb_{cve_ent}"
+    layer_filter = partial(inegi_skip_reason, cve_ent=cve_ent)
+    shp_files = get_state_shapefiles(zip_file, extract_dir, layer_filter)
+
+    # Cargar cada shapefile
+    loaded_tables = []
+    for shp_file in shp_files:
+        # Determinar tipo de geometría por nombre de archivo
+        geom_type = classify_inegi_layer(shapefile_name(shp_file).stem, cve_ent)
+        table_name = f"{geom_type}_{cve_ent}"
+
+        # INEGI usa SRID 900916 nativo (no requiere transformación)
+        if load_shapefile_to_postgis(shp_file, "inegi", table_name, force=reload):
+            loaded_tables.append(("inegi", table_name))
+        else:
+            register_load(table_name, "INEGI", zip_file.name, status='failed')
+            fallidos += 1
+
+    cargadas = post_load_tables(loaded_tables, "INEGI", zip_file.name)
+    exitosos += len(cargadas)
+    fallidos += len(loaded_tables) - len(cargadas)
+    loaded_tables = cargadas
+
+    build_subdivided_tables(loaded_tables)
+    refresh_unified_ageb(loaded_tables)
+    flush_load_metadata()
+
+    # Limpiar archivos temporales
+    if extract_dir.exists():
+        subprocess.run(["rm", "-rf", str(extract_dir)], check=False)
+
+    return exitosos, fallidos
+
+
 def load_sepomex_shapefiles():
     """Carga todos los shapefiles de SEPOMEX"""
     print("\n=== Cargando Shapefiles de SEPOMEX (Códigos Postales) ===\n")
@@ -351,7 +1371,8 @@ def load_sepomex_shapefiles():
 
     cp_dir = Path("/data/cp_shapefiles")
     temp_dir = Path("/tmp/cp_extracts")
-    temp_dir.mkdir(exist_ok=True)
+    if ZIP_MODE != 'vsizip':
+        temp_dir.mkdir(exist_ok=True)
 
     if not cp_dir.exists():
         print("⚠ Directorio /data/cp_shapefiles no encontrado")
@@ -360,6 +1381,7 @@ def load_sepomex_shapefiles():
     exitosos = 0
     fallidos = 0
     omitidos = 0
+    jobs = []
 
     for cve_ent, (abrev, nombre) in ESTADOS_SEPOMEX.items():
         # Filtrar por estados si está configurado
@@ -374,28 +1396,14 @@ def load_sepomex_shapefiles():
             fallidos += 1
             continue
 
-        print(f"[{cve_ent}] {nombre}")
-
-        # Extraer ZIP
-        extract_dir = temp_dir / f"cp_{cve_ent}"
-        extract_dir.mkdir(exist_ok=True)
-
-        shp_files = extract_zip(zip_file, extract_dir)
+        reload = not FORCE_RELOAD and zip_changed_since_load(zip_file)
+        if reload:
+            print(f"↻ {zip_file.name} descargado después de su última carga (se recarga)")
+        jobs.append((cve_ent, zip_file, temp_dir, reload))
 
-        # Cargar cada shapefile
-        for shp_file in shp_files:
-            table_name = f"cp_{cve_ent}_{shp_file.stem.lower()}"
-
-            # Cargar con proyección nativa (ambos usan Lambert Conformal Conic)
-            if load_shapefile_to_postgis(shp_file, "sepomex", table_name):
-                register_load(table_name, "SEPOMEX", zip_file.name)
-                exitosos += 1
-            else:
-                register_load(table_name, "SEPOMEX", zip_file.name, status='failed')
-                fallidos += 1
-
-        # Limpiar archivos temporales
-        subprocess.run(["rm", "-rf", str(extract_dir)], check=False)
+    estado_exitosos, estado_fallidos = run_state_jobs(load_sepomex_state, jobs)
+    exitosos += estado_exitosos
+    fallidos += estado_fallidos
 
     resultado = f"\nSEPOMEX - Exitosos: {exitosos}, Fallidos: {fallidos}"
     if omitidos > 0:
@@ -425,7 +1433,8 @@ def load_inegi_shapefiles():
 
     ageb_dir = Path("/data/ageb_shapefiles")
     temp_dir = Path("/tmp/ageb_extracts")
-    temp_dir.mkdir(exist_ok=True)
+    if ZIP_MODE != 'vsizip':
+        temp_dir.mkdir(exist_ok=True)
 
     if not ageb_dir.exists():
         print("⚠ Directorio /data/ageb_shapefiles no encontrado")
@@ -434,6 +1443,7 @@ def load_inegi_shapefiles():
     exitosos = 0
     fallidos = 0
     omitidos = 0
+    jobs = []
 
     for cve_ent, nombre_archivo in ESTADOS_INEGI.items():
         # Filtrar por estados si está configurado
@@ -448,84 +1458,14 @@ def load_inegi_shapefiles():
             fallidos += 1
             continue
 
-        print(f"[{cve_ent}] {nombre_archivo.title()}")
-
-        # Extraer ZIP
-        extract_dir = temp_dir / f"ageb_{cve_ent}"
-        extract_dir.mkdir(exist_ok=True)
-
-        shp_files = extract_zip(zip_file, extract_dir)
-
-        # Cargar cada shapefile
-        for shp_file in shp_files:
-            # Determinar tipo de geometría por nombre de archivo
-            stem_lower = shp_file.stem.lower()
-
-            # Patrón INEGI: {cve_ent}a, {cve_ent}ar, {cve_ent}m, etc.
-            # Verificar primero patrones específicos de INEGI
-            if stem_lower == f"{cve_ent}a":
-                geom_type = 'ageb_urbana'
-            elif stem_lower == f"{cve_ent}ar":
-                geom_type = 'ageb_rural'
-            elif stem_lower == f"{cve_ent}m":
-                geom_type = 'manzana'
-            elif stem_lower == f"{cve_ent}l" or stem_lower == f"{cve_ent}lpr":
-                geom_type = 'localidad'
-            elif stem_lower == f"{cve_ent}mun":
-                geom_type = 'municipio'
-            elif stem_lower in [f"{cve_ent}ent", f"{cve_ent}e"]:
-                geom_type = 'entidad'
-            # Patrones genéricos para otros formatos
-            elif 'ageb_urb' in stem_lower or 'ageb urbana' in stem_lower:
-                geom_type = 'ageb_urbana'
-            elif 'ageb_rur' in stem_lower or 'ageb rural' in stem_lower:
-                geom_type = 'ageb_rural'
-            elif 'manzana' in stem_lower:
-                geom_type = 'manzana'
-            elif 'localidad' in stem_lower:
-                geom_type = 'localidad'
-            elif 'municipio' in stem_lower:
-                geom_type = 'municipio'
-            elif 'entidad' in stem_lower:
-                geom_type = 'entidad'
-            else:
-                # Omitir archivos que no coincidan con tipos conocidos
-                print(f"    Omitiendo {shp_file.name} (tipo desconocido)")
-                continue
-
-            # Verificar si se debe cargar esta capa
-            skip = False
-            if geom_type in ['ageb_urbana', 'ageb_rural'] and not LOAD_LAYERS['agebs']:
-                print(f"    Omitiendo {shp_file.name} (AGEBs deshabilitados)")
-                skip = True
-            elif geom_type == 'manzana' and not LOAD_LAYERS['manzanas']:
-                print(f"    Omitiendo {shp_file.name} (Manzanas deshabilitadas)")
-                skip = True
-            elif geom_type == 'localidad' and not LOAD_LAYERS['localidades']:
-                print(f"    Omitiendo {shp_file.name} (Localidades deshabilitadas)")
-                skip = True
-            elif geom_type == 'municipio' and not LOAD_LAYERS['municipios']:
-                print(f"    Omitiendo {shp_file.name} (Municipios deshabilitados)")
-                skip = True
-            elif geom_type == 'entidad' and not LOAD_LAYERS['entidades']:
-                print(f"    Omitiendo {shp_file.name} (Entidades deshabilitadas)")
-                skip = True
-
-            if skip:
-                continue
-
-            table_name = f"{geom_type}_{cve_ent}"
-
-            # INEGI usa SRID 900916 nativo (no requiere transformación)
-            if load_shapefile_to_postgis(shp_file, "inegi", table_name):
-                register_load(table_name, "INEGI", zip_file.name)
-                exitosos += 1
-            else:
-                register_load(table_name, "INEGI", zip_file.name, status='failed')
-                fallidos += 1
+        reload = not FORCE_RELOAD and zip_changed_since_load(zip_file)
+        if reload:
+            print(f"↻ {zip_file.name} descargado después de su última carga (se recarga)")
+        jobs.append((cve_ent, zip_file, temp_dir, reload))
 
-        # Limpiar archivos temporales
-        subprocess.run(["rm", "-rf", str(extract_dir)], check=False)
+    estado_exitosos, estado_fallidos = run_state_jobs(load_inegi_state, jobs)
+    exitosos += estado_exitosos
+    fallidos += estado_fallidos
 
     resultado = f"\nINEGI - Exitosos: {exitosos}, Fallidos: {fallidos}"
     if omitidos > 0:
@@ -548,13 +1488,27 @@ def main():
     }
     validation_desc = validation_modes.get(VALIDATE_ZIPS, 'Desconocido')
     print(f"Validación de ZIPs: {validation_desc}")
+    print(f"Lectura de ZIPs: {'Directa (/vsizip/)' if ZIP_MODE == 'vsizip' else 'Extracción a /tmp'}")
+    print(f"Procesos de carga: {LOAD_WORKERS}")
+    print(f"Carga masiva (BULK_LOAD): {'SÍ' if BULK_LOAD else 'NO'}")
+    print(f"Motor de carga: {'Nativo (COPY binario)' if LOADER_BACKEND == 'native' else 'ogr2ogr'}")
+    print(f"Geometría canónica ({CANONICAL_COLUMN}): {'SÍ' if CANONICAL_GEOM else 'NO'}")
+    print(f"Geometrías subdivididas ({SUBDIVIDE_SCHEMA}): {'SÍ' if SUBDIVIDE_GEOM else 'NO'}")
+    print(f"Capas unificadas (inegi.{UNIFIED_AGEB_TABLE}, sepomex.{UNIFIED_CP_TABLE}): "
+          f"{'SÍ' if UNIFIED_LAYERS else 'NO'}")
     print("=" * 70)
 
-    # Verificar conexión a base de datos
+    # Verificar conexión a base de datos y tomar snapshot del catálogo
+    global EXISTING_TABLES
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        conn.close()
-        print("✓ Conexión a base de datos exitosa\n")
+        EXISTING_TABLES = snapshot_existing_tables()
+        ensure_cp_directory()
+        if SUBDIVIDE_GEOM:
+            ensure_subdivide_schema()
+        if UNIFIED_LAYERS:
+            ensure_unified_layers()
+        print("✓ Conexión a base de datos exitosa")
+        print(f"  Tablas existentes: {len(EXISTING_TABLES)}\n")
     except Exception as e:
         print(f"✗ Error conectando a base de datos: {e}")
         sys.exit(1)
@@ -563,6 +1517,37 @@ def main():
     load_sepomex_shapefiles()
     load_inegi_shapefiles()
 
+    # Completar geom_6372 en tablas cargadas antes de activar CANONICAL_GEOM
+    if CANONICAL_GEOM:
+        pendientes = tables_without_canonical_geometry()
+        if pendientes:
+            print(f"\n=== Backfill de {CANONICAL_COLUMN} ===\n")
+            add_canonical_geometry(pendientes)
+
+    # Completar el directorio de CPs con tablas cargadas antes de que existiera
+    pendientes = tables_missing_from_cp_directory()
+    if pendientes:
+        print("\n=== Directorio de códigos postales ===\n")
+        refresh_cp_directory(pendientes)
+
+    # Generar piezas subdivididas de tablas cargadas antes de activar SUBDIVIDE_GEOM
+    if SUBDIVIDE_GEOM:
+        pendientes = tables_without_subdivision()
+        if pendientes:
+            print(f"\n=== Geometrías subdivididas ({SUBDIVIDE_SCHEMA}) ===\n")
+            build_subdivided_tables(pendientes)
+
+    # Particiones de inegi.ageb / sepomex.cp para estados cargados antes de UNIFIED_LAYERS
+    if UNIFIED_LAYERS:
+        pendientes = states_missing_unified_layers()
+        if pendientes:
+            print(f"\n=== Capas unificadas (inegi.{UNIFIED_AGEB_TABLE}, sepomex.{UNIFIED_CP_TABLE}) ===\n")
+            refresh_unified_ageb(pendientes)
+            refresh_unified_cp(pendientes)
+
+    flush_load_metadata()
+    close_db_connection()
+
     print("\n" + "=" * 70)
     print("  Carga completada")
     print("=" * 70)
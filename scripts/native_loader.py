@@ -0,0 +1,731 @@
+#!/usr/bin/env python3
+"""
+Cargador nativo de shapefiles a PostGIS (alternativa a ogr2ogr)
+
+Lee los registros .shp/.dbf en streaming (desde disco o directamente desde un
+ZIP con rutas /vsizip/), codifica las geometrías como EWKB y las envía con
+COPY ... FROM STDIN (FORMAT binary) sobre una conexión existente.
+
+Reproduce el esquema que genera ogr2ogr en load_shapefiles.py:
+ogc_fid SERIAL PRIMARY KEY, geom Multi* (PROMOTE_TO_MULTI), nombres de columna
+en minúsculas, campos numéricos NUMERIC(ancho,decimales) e índice GiST
+{tabla}_geom_geom_idx. Un campo cuyo nombre choca con ogc_fid, geom u otro
+campo se renombra con sufijo numérico (geom → geom2). Las geometrías Z/M se
+cargan en 2D (se descartan las ordenadas Z y M).
+"""
+
+import codecs
+import io
+import re
+import struct
+import sys
+import zipfile
+from array import array
+from contextlib import contextmanager
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from operator import mul
+from pathlib import Path, PurePosixPath
+
+from psycopg2 import sql
+
+# Tipos de shape soportados (2D) → (tipo geometría PostGIS, código WKB Multi*)
+SHAPE_TYPES = {
+    1: ('MULTIPOINT', 4),        # Point
+    3: ('MULTILINESTRING', 5),   # PolyLine
+    5: ('MULTIPOLYGON', 6),      # Polygon
+    8: ('MULTIPOINT', 4),        # MultiPoint
+}
+
+# Tipos Z y M → tipo 2D equivalente. Sus registros guardan X,Y en la misma
+# posición que el tipo 2D y agregan las ordenadas Z/M al final, que se ignoran
+SHAPE_TYPES_2D = {
+    11: 1, 13: 3, 15: 5, 18: 8,  # PointZ, PolyLineZ, PolygonZ, MultiPointZ
+    21: 1, 23: 3, 25: 5, 28: 8,  # PointM, PolyLineM, PolygonM, MultiPointM
+}
+
+WKB_SRID_FLAG = 0x20000000
+
+# Encabezado y fin de COPY ... (FORMAT binary)
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_TRAILER = struct.pack('>h', -1)
+
+# Tamaño aproximado de cada bloque enviado por COPY
+COPY_CHUNK_SIZE = 1 << 20
+
+# Rango de SRIDs para proyecciones sin equivalente en spatial_ref_sys (el
+# mismo en que las da de alta ogr2ogr: el siguiente libre desde 32768)
+CUSTOM_SRID_MIN = 32768
+CUSTOM_SRID_MAX = 900912
+
+# PROJECTION del WKT (ESRI u OGC) → proyección PROJ
+PROJ_PROJECTIONS = {
+    'mercator': 'merc',
+    'mercator_1sp': 'merc',
+    'mercator_auxiliary_sphere': 'merc',
+    'popular_visualisation_pseudo_mercator': 'merc',
+    'lambert_conformal_conic': 'lcc',
+    'lambert_conformal_conic_2sp': 'lcc',
+    'lambert_conformal_conic_1sp': 'lcc',
+    'transverse_mercator': 'tmerc',
+}
+
+# PARAMETER del WKT → parámetro PROJ
+PROJ_PARAMETERS = {
+    'false_easting': 'x_0',
+    'false_northing': 'y_0',
+    'central_meridian': 'lon_0',
+    'longitude_of_origin': 'lon_0',
+    'longitude_of_center': 'lon_0',
+    'latitude_of_origin': 'lat_0',
+    'latitude_of_center': 'lat_0',
+    'standard_parallel_1': 'lat_1',
+    'standard_parallel_2': 'lat_2',
+    'scale_factor': 'k',
+}
+
+# Columnas que crea el cargador además de los campos del .dbf
+RESERVED_COLUMNS = ('ogc_fid', 'geom')
+
+POSTGRES_EPOCH = date(2000, 1, 1).toordinal()
+
+_NEEDS_BYTESWAP = sys.byteorder != 'little'
+
+
+# ----------------------------------------------------------------------------
+# Apertura de los archivos del shapefile (disco o /vsizip/)
+# ----------------------------------------------------------------------------
+
+def _split_vsizip(source: str) -> tuple:
+    """Separa '/vsizip/<archivo.zip>/<miembro>' en (ruta_zip, miembro)"""
+    path = source[len('/vsizip/'):]
+    match = re.search(r'\.zip/', path, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Ruta /vsizip/ inválida: {source}")
+    return path[:match.end() - 1], path[match.end():]
+
+
+@contextmanager
+def open_shapefile(source):
+    """Abre los archivos .shp/.dbf/.prj/.cpg de un shapefile
+
+    Args:
+        source: Path a un .shp extraído, o ruta '/vsizip/...' dentro de un ZIP
+
+    Yields:
+        Dict extensión → archivo binario abierto ('.shp' y '.dbf' obligatorios)
+    """
+    source = str(source)
+    opened = {}
+    zip_ref = None
+
+    try:
+        if source.startswith('/vsizip/'):
+            zip_path, member = _split_vsizip(source)
+            zip_ref = zipfile.ZipFile(zip_path, 'r')
+            base = str(PurePosixPath(member).with_suffix('')).lower()
+            for name in zip_ref.namelist():
+                stem, ext = str(PurePosixPath(name).with_suffix('')), PurePosixPath(name).suffix.lower()
+                if stem.lower() == base and ext in ('.shp', '.dbf', '.prj', '.cpg'):
+                    opened[ext] = zip_ref.open(name)
+        else:
+            shp_path = Path(source)
+            for sibling in shp_path.parent.glob(f"{shp_path.stem}.*"):
+                ext = sibling.suffix.lower()
+                if ext in ('.shp', '.dbf', '.prj', '.cpg'):
+                    opened[ext] = open(sibling, 'rb')
+
+        for required in ('.shp', '.dbf'):
+            if required not in opened:
+                raise FileNotFoundError(f"Falta el archivo {required} de {source}")
+
+        yield opened
+    finally:
+        for f in opened.values():
+            f.close()
+        if zip_ref is not None:
+            zip_ref.close()
+
+
+# ----------------------------------------------------------------------------
+# Lectura de .shp y codificación EWKB
+# ----------------------------------------------------------------------------
+
+def _read_exact(f, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise EOFError("Shapefile truncado")
+    return data
+
+
+def read_shp_header(f) -> int:
+    """Lee el encabezado de 100 bytes del .shp y retorna el tipo de shape"""
+    header = _read_exact(f, 100)
+    file_code, = struct.unpack_from('>i', header, 0)
+    if file_code != 9994:
+        raise ValueError("Archivo .shp inválido")
+    shape_type, = struct.unpack_from('<i', header, 32)
+    return shape_type
+
+
+def iter_shp_records(f):
+    """Genera el contenido binario de cada registro del .shp (sin encabezado)"""
+    while True:
+        record_header = f.read(8)
+        if len(record_header) < 8:
+            return
+        _, content_words = struct.unpack('>ii', record_header)
+        yield _read_exact(f, content_words * 2)
+
+
+def _coords(raw: bytes) -> array:
+    coords = array('d')
+    coords.frombytes(raw)
+    if _NEEDS_BYTESWAP:
+        coords.byteswap()
+    return coords
+
+
+def _signed_area(coords: array) -> float:
+    """Área con signo (fórmula del listón); negativa para anillos horarios"""
+    xs, ys = coords[0::2], coords[1::2]
+    return (sum(map(mul, xs, ys[1:])) - sum(map(mul, xs[1:], ys))) / 2.0
+
+
+def _bbox(coords: array) -> tuple:
+    xs, ys = coords[0::2], coords[1::2]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _point_in_ring(x: float, y: float, coords: array) -> bool:
+    """Prueba punto-en-polígono por cruce de rayos"""
+    inside = False
+    xs, ys = coords[0::2], coords[1::2]
+    j = len(xs) - 1
+    for i in range(len(xs)):
+        if (ys[i] > y) != (ys[j] > y):
+            if x < (xs[j] - xs[i]) * (y - ys[i]) / (ys[j] - ys[i]) + xs[i]:
+                inside = not inside
+        j = i
+    return inside
+
+
+def _group_polygon_rings(rings: list) -> list:
+    """Agrupa anillos de un shapefile Polygon en polígonos (exterior + huecos)
+
+    En el formato shapefile los anillos exteriores van en sentido horario y los
+    huecos en sentido antihorario. Cada hueco se asigna al exterior que lo
+    contiene; si ninguno lo contiene se trata como un exterior más.
+    """
+    if len(rings) == 1:
+        return [[rings[0][0]]]
+
+    outers = []
+    holes = []
+    for raw, coords in rings:
+        if _signed_area(coords) <= 0:
+            outers.append(([raw], coords, _bbox(coords)))
+        else:
+            holes.append((raw, coords))
+
+    for raw, coords in holes:
+        x, y = coords[0], coords[1]
+        candidates = [
+            outer for outer in outers
+            if outer[2][0] <= x <= outer[2][2] and outer[2][1] <= y <= outer[2][3]
+        ]
+        if len(candidates) > 1:
+            candidates = [outer for outer in candidates if _point_in_ring(x, y, outer[1])]
+
+        if candidates:
+            candidates[0][0].append(raw)
+        else:
+            outers.append(([raw], coords, _bbox(coords)))
+
+    return [outer[0] for outer in outers]
+
+
+def shape_to_ewkb(content: bytes, srid: int) -> bytes:
+    """Convierte un registro .shp en EWKB Multi* con SRID, o None si es nulo
+
+    Las coordenadas del shapefile ya son doubles little-endian en pares x,y,
+    igual que WKB (byte order 1), así que se copian sin decodificar. En los
+    tipos Z/M solo se copian X,Y (ver SHAPE_TYPES_2D).
+    """
+    shape_type, = struct.unpack_from('<i', content, 0)
+    if shape_type == 0:
+        return None
+    shape_type = SHAPE_TYPES_2D.get(shape_type, shape_type)
+    if shape_type not in SHAPE_TYPES:
+        raise ValueError(f"Tipo de shape no soportado: {shape_type}")
+
+    _, multi_code = SHAPE_TYPES[shape_type]
+    header = struct.pack('<BII', 1, multi_code | WKB_SRID_FLAG, srid)
+
+    if shape_type == 1:
+        point = struct.pack('<BI', 1, 1) + content[4:20]
+        return header + struct.pack('<I', 1) + point
+
+    if shape_type == 8:
+        num_points, = struct.unpack_from('<i', content, 36)
+        points = [
+            struct.pack('<BI', 1, 1) + content[40 + 16 * i:56 + 16 * i]
+            for i in range(num_points)
+        ]
+        return header + struct.pack('<I', num_points) + b''.join(points)
+
+    # PolyLine / Polygon: bbox, numParts, numPoints, parts[], points[]
+    num_parts, num_points = struct.unpack_from('<ii', content, 36)
+    parts = list(struct.unpack_from(f'<{num_parts}i', content, 44)) + [num_points]
+    points_offset = 44 + 4 * num_parts
+
+    part_bytes = []
+    for start, end in zip(parts[:-1], parts[1:]):
+        raw = content[points_offset + 16 * start:points_offset + 16 * end]
+        part_bytes.append((struct.pack('<I', end - start) + raw, raw))
+
+    if shape_type == 3:
+        lines = [struct.pack('<BI', 1, 2) + ring for ring, _ in part_bytes]
+        return header + struct.pack('<I', len(lines)) + b''.join(lines)
+
+    if len(part_bytes) == 1:
+        rings = [(part_bytes[0][0], None)]
+    else:
+        rings = [(ring, _coords(raw)) for ring, raw in part_bytes]
+
+    polygons = [
+        struct.pack('<BII', 1, 3, len(group)) + b''.join(group)
+        for group in _group_polygon_rings(rings)
+    ]
+    return header + struct.pack('<I', len(polygons)) + b''.join(polygons)
+
+
+# ----------------------------------------------------------------------------
+# Lectura de .dbf
+# ----------------------------------------------------------------------------
+
+def read_dbf_header(f) -> tuple:
+    """Lee el encabezado del .dbf
+
+    Returns:
+        Tupla (num_registros, longitud_registro, campos) donde cada campo es
+        (nombre, tipo, longitud, decimales)
+    """
+    header = _read_exact(f, 32)
+    num_records, header_length, record_length = struct.unpack_from('<IHH', header, 4)
+
+    descriptors = _read_exact(f, header_length - 32)
+    fields = []
+    for offset in range(0, len(descriptors) - 1, 32):
+        if descriptors[offset] == 0x0D:
+            break
+        descriptor = descriptors[offset:offset + 32]
+        name = descriptor[:11].split(b'\x00', 1)[0].decode('ascii', 'replace')
+        field_type = chr(descriptor[11])
+        fields.append((name, field_type, descriptor[16], descriptor[17]))
+
+    return num_records, record_length, fields
+
+
+def iter_dbf_records(f, num_records: int, record_length: int):
+    """Genera (borrado, bytes_del_registro) para cada registro del .dbf"""
+    for _ in range(num_records):
+        record = _read_exact(f, record_length)
+        yield record[:1] == b'*', record[1:]
+
+
+def dbf_encoding(cpg_file) -> str:
+    """Codificación de texto del .dbf según su .cpg (ISO-8859-1 por defecto)"""
+    if cpg_file is None:
+        return 'latin-1'
+
+    name = cpg_file.read().decode('ascii', 'ignore').strip()
+    candidates = [name]
+    if name.isdigit():
+        candidates = ['iso8859-1' if name == '88591' else f'cp{name}']
+    elif name.upper().startswith('8859'):
+        candidates = [f'iso{name}']
+
+    for candidate in candidates:
+        try:
+            return codecs.lookup(candidate).name
+        except LookupError:
+            continue
+    return 'latin-1'
+
+
+# ----------------------------------------------------------------------------
+# Columnas: tipos PostgreSQL y codificación binaria para COPY
+# ----------------------------------------------------------------------------
+
+def launder_name(name: str) -> str:
+    """Nombre de columna como lo deja ogr2ogr (LAUNDER=YES)"""
+    return re.sub(r'[^a-z0-9_]', '_', name.strip().lower())
+
+
+def column_names(names: list) -> list:
+    """Nombres de columna (launder_name) sin repetidos ni choques con ogc_fid/geom
+
+    Como ogr2ogr con campos duplicados, el nombre ya usado recibe un sufijo
+    numérico a partir de 2.
+    """
+    used = set(RESERVED_COLUMNS)
+    result = []
+    for name in names:
+        base = candidate = launder_name(name)
+        suffix = 1
+        while candidate in used:
+            suffix += 1
+            candidate = f"{base}{suffix}"
+        used.add(candidate)
+        result.append(candidate)
+    return result
+
+
+def column_type(field_type: str, length: int, decimals: int) -> str:
+    """Tipo PostgreSQL de un campo dBase, siguiendo el mapeo de ogr2ogr
+
+    Los campos numéricos conservan ancho y decimales (PRECISION=YES, el
+    default del driver PostgreSQL), también los enteros: NUMERIC(ancho,0).
+    """
+    if field_type == 'C':
+        return f"VARCHAR({length})"
+    if field_type in ('N', 'F'):
+        return f"NUMERIC({length},{decimals})"
+    if field_type == 'D':
+        return "DATE"
+    if field_type == 'L':
+        return "BOOLEAN"
+    return f"VARCHAR({length})"
+
+
+def encode_numeric(value: Decimal) -> bytes:
+    """Codifica un Decimal en el formato binario de NUMERIC de PostgreSQL"""
+    sign = 0x4000 if value.is_signed() else 0x0000
+    text = format(abs(value), 'f')
+    int_part, _, frac_part = text.partition('.')
+    dscale = len(frac_part)
+
+    int_part = int_part.lstrip('0')
+    int_part = '0' * (-len(int_part) % 4) + int_part
+    frac_part = frac_part + '0' * (-len(frac_part) % 4)
+
+    digits = [int(int_part[i:i + 4]) for i in range(0, len(int_part), 4)]
+    weight = len(digits) - 1
+    digits += [int(frac_part[i:i + 4]) for i in range(0, len(frac_part), 4)]
+
+    while digits and digits[0] == 0:
+        digits.pop(0)
+        weight -= 1
+    while digits and digits[-1] == 0:
+        digits.pop()
+
+    if not digits:
+        return struct.pack('>hhHH', 0, 0, 0, dscale)
+
+    return struct.pack(f'>hhHH{len(digits)}H', len(digits), weight, sign, dscale, *digits)
+
+
+def make_field_encoder(field_type: str, pg_type: str, encoding: str):
+    """Retorna una función bytes_dbf → bytes binarios COPY (o None si es NULL)"""
+    if field_type == 'C' or pg_type.startswith('VARCHAR'):
+        def encode(raw):
+            text = raw.decode(encoding, 'replace').strip()
+            return text.encode('utf-8') if text else None
+        return encode
+
+    if field_type == 'D':
+        def encode(raw):
+            text = raw.decode('ascii', 'ignore').strip()
+            try:
+                value = date(int(text[:4]), int(text[4:6]), int(text[6:8]))
+            except ValueError:
+                return None
+            return struct.pack('>i', value.toordinal() - POSTGRES_EPOCH)
+        return encode
+
+    if field_type == 'L':
+        def encode(raw):
+            flag = raw[:1].upper()
+            if flag in (b'Y', b'T'):
+                return b'\x01'
+            if flag in (b'N', b'F'):
+                return b'\x00'
+            return None
+        return encode
+
+    def parse(raw):
+        text = raw.decode('ascii', 'ignore').strip()
+        if not text or text.startswith('*'):
+            return None
+        try:
+            return Decimal(text)
+        except InvalidOperation:
+            return None
+
+    def encode(raw):
+        value = parse(raw)
+        return None if value is None else encode_numeric(value)
+    return encode
+
+
+# ----------------------------------------------------------------------------
+# SRID
+# ----------------------------------------------------------------------------
+
+def normalize_wkt(wkt: str) -> str:
+    """WKT sin espacios ni diferencias de mayúsculas, para comparar srtext"""
+    return re.sub(r'\s+', '', wkt).upper()
+
+
+def _proj_number(value: float) -> str:
+    return format(value, '.15g')
+
+
+def wkt_to_proj4(wkt: str) -> str:
+    """Cadena PROJ (proj4text) equivalente a un WKT de .prj
+
+    Cubre las proyecciones de PROJ_PROJECTIONS y las coordenadas geográficas;
+    lanza ValueError con cualquier otra, para no registrar un SRID sin
+    definición que ST_Transform no podría usar.
+    """
+    spheroid = re.search(r'SPHEROID\["[^"]*",\s*([-\d.eE+]+),\s*([-\d.eE+]+)', wkt, re.IGNORECASE)
+    if not spheroid:
+        raise ValueError("El .prj no define un elipsoide (SPHEROID)")
+    a = _proj_number(float(spheroid.group(1)))
+    rf = float(spheroid.group(2))
+    # Aplanamiento inverso 0 = esfera (p. ej. la esfera auxiliar de Web Mercator)
+    ellipsoid = f"+a={a} +b={a}" if rf == 0 else f"+a={a} +rf={_proj_number(rf)}"
+
+    if not wkt.lstrip().upper().startswith('PROJCS'):
+        return f"+proj=longlat {ellipsoid} +no_defs"
+
+    projection = re.search(r'PROJECTION\["([^"]+)"', wkt, re.IGNORECASE)
+    name = projection.group(1) if projection else ''
+    proj = PROJ_PROJECTIONS.get(name.lower())
+    if proj is None:
+        raise ValueError(f"Proyección no soportada por el cargador nativo: {name or 'desconocida'} "
+                         f"(usar LOADER_BACKEND=ogr2ogr)")
+
+    parts = [f"+proj={proj}"]
+    for param, value in re.findall(r'PARAMETER\["([^"]+)",\s*([-\d.eE+]+)\]', wkt, re.IGNORECASE):
+        key = PROJ_PARAMETERS.get(param.lower())
+        if key is None:
+            continue
+        if proj == 'merc' and key == 'lat_1':
+            key = 'lat_ts'
+        parts.append(f"+{key}={_proj_number(float(value))}")
+
+    # Unidad lineal: la última UNIT del PROJCS
+    units = re.findall(r'UNIT\["[^"]*",\s*([-\d.eE+]+)', wkt, re.IGNORECASE)
+    to_meter = float(units[-1]) if units else 1.0
+    parts.append(ellipsoid)
+    parts.append("+units=m" if to_meter == 1.0 else f"+to_meter={_proj_number(to_meter)}")
+    parts.append("+no_defs")
+    return " ".join(parts)
+
+
+def resolve_srid(conn, prj_file) -> int:
+    """Obtiene el SRID de la proyección del .prj, registrándola si no existe
+
+    Busca primero por autoridad EPSG declarada en el WKT y luego por srtext
+    equivalente (sin espacios ni mayúsculas), así que reutiliza los SRIDs que
+    da de alta docker/init-db.sh (900914, 900916). Si no hay coincidencia
+    inserta el WKT con su proj4text (wkt_to_proj4) en el siguiente SRID libre
+    del rango de ogr2ogr (CUSTOM_SRID_MIN..CUSTOM_SRID_MAX).
+    """
+    if prj_file is None:
+        return 0
+
+    wkt = prj_file.read().decode('latin-1').strip()
+    if not wkt:
+        return 0
+
+    with conn.cursor() as cur:
+        epsg = re.search(r'AUTHORITY\["EPSG",\s*"?(\d+)"?\]\s*\]\s*$', wkt)
+        if epsg:
+            cur.execute("SELECT srid FROM spatial_ref_sys WHERE auth_name = 'EPSG' AND auth_srid = %s",
+                        (int(epsg.group(1)),))
+            row = cur.fetchone()
+            if row:
+                return row[0]
+
+        cur.execute("BEGIN")
+        try:
+            # Serializar el alta de SRIDs entre workers que cargan en paralelo
+            cur.execute("LOCK TABLE spatial_ref_sys IN SHARE ROW EXCLUSIVE MODE")
+            cur.execute("""
+                SELECT srid FROM spatial_ref_sys
+                WHERE upper(regexp_replace(srtext, '\\s+', '', 'g')) = %s
+                ORDER BY srid
+                LIMIT 1
+            """, (normalize_wkt(wkt),))
+            row = cur.fetchone()
+            if row:
+                srid = row[0]
+            else:
+                cur.execute("""
+                    INSERT INTO spatial_ref_sys (srid, auth_name, auth_srid, srtext, proj4text)
+                    SELECT COALESCE(MAX(srid) + 1, %s), NULL, NULL, %s, %s
+                    FROM spatial_ref_sys
+                    WHERE srid BETWEEN %s AND %s
+                    RETURNING srid
+                """, (CUSTOM_SRID_MIN, wkt, wkt_to_proj4(wkt), CUSTOM_SRID_MIN, CUSTOM_SRID_MAX))
+                srid = cur.fetchone()[0]
+                if srid > CUSTOM_SRID_MAX:
+                    raise ValueError("No quedan SRIDs libres para proyecciones personalizadas")
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+
+    return srid
+
+
+# ----------------------------------------------------------------------------
+# COPY binario
+# ----------------------------------------------------------------------------
+
+class _ChunkStream(io.RawIOBase):
+    """Archivo de solo lectura sobre un generador de bloques de bytes"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def _copy_chunks(shp_records, dbf_records, encoders: list, srid: int, stats: dict):
+    """Genera los bloques COPY binario: una tupla por registro del shapefile"""
+    field_count = struct.pack('>h', len(encoders) + 1)
+    null = struct.pack('>i', -1)
+    pending = [COPY_SIGNATURE]
+    pending_size = len(COPY_SIGNATURE)
+
+    for content, (deleted, record) in zip(shp_records, dbf_records):
+        if deleted:
+            continue
+
+        try:
+            geometry = shape_to_ewkb(content, srid)
+        except (ValueError, struct.error):
+            stats['skipped'] += 1
+            continue
+
+        values = [field_count]
+        for encode, start, end in encoders:
+            value = encode(record[start:end])
+            values.append(null if value is None else struct.pack('>i', len(value)) + value)
+        values.append(null if geometry is None else struct.pack('>i', len(geometry)) + geometry)
+
+        row = b''.join(values)
+        pending.append(row)
+        pending_size += len(row)
+        stats['rows'] += 1
+
+        if pending_size >= COPY_CHUNK_SIZE:
+            yield b''.join(pending)
+            pending = []
+            pending_size = 0
+
+    pending.append(COPY_TRAILER)
+    yield b''.join(pending)
+
+
+def load_shapefile(conn, source, schema: str, table_name: str, transform_to_srid: int = None,
+                   unlogged: bool = False, spatial_index: bool = True) -> dict:
+    """Carga un shapefile en schema.table_name con COPY binario
+
+    Reemplaza la tabla si existe (como ogr2ogr -overwrite). Los registros con
+    geometría no soportada se omiten (como -skipfailures).
+
+    Args:
+        conn: Conexión psycopg2 en modo autocommit (se reutiliza entre capas)
+        source: Path a un .shp o ruta '/vsizip/...'
+        schema, table_name: Tabla destino
+        transform_to_srid: SRID al que reproyectar después de cargar
+        unlogged: Crear la tabla UNLOGGED (perfil BULK_LOAD)
+        spatial_index: Crear el índice GiST al terminar
+
+    Returns:
+        Dict con 'rows' (registros cargados) y 'skipped' (omitidos)
+    """
+    stats = {'rows': 0, 'skipped': 0}
+    table = sql.Identifier(schema, table_name)
+
+    with open_shapefile(source) as files:
+        shp = files['.shp']
+        dbf = files['.dbf']
+
+        shape_type = read_shp_header(shp)
+        shape_type = SHAPE_TYPES_2D.get(shape_type, shape_type)
+        if shape_type not in SHAPE_TYPES:
+            raise ValueError(f"Tipo de shape no soportado por el cargador nativo: {shape_type} "
+                             f"(usar LOADER_BACKEND=ogr2ogr)")
+        geometry_type, _ = SHAPE_TYPES[shape_type]
+
+        num_records, record_length, fields = read_dbf_header(dbf)
+        encoding = dbf_encoding(files.get('.cpg'))
+        srid = resolve_srid(conn, files.get('.prj'))
+
+        columns = []
+        encoders = []
+        offset = 0
+        names = column_names([field[0] for field in fields])
+        for name, (_, field_type, length, decimals) in zip(names, fields):
+            pg_type = column_type(field_type, length, decimals)
+            columns.append((name, pg_type))
+            encoders.append((make_field_encoder(field_type, pg_type, encoding), offset, offset + length))
+            offset += length
+
+        column_defs = [sql.SQL("ogc_fid SERIAL PRIMARY KEY"),
+                       sql.SQL("geom geometry({}, {})").format(sql.SQL(geometry_type), sql.Literal(srid))]
+        column_defs += [sql.SQL("{} {}").format(sql.Identifier(name), sql.SQL(pg_type))
+                        for name, pg_type in columns]
+
+        with conn.cursor() as cur:
+            cur.execute("BEGIN")
+            try:
+                cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(table))
+                cur.execute(sql.SQL("CREATE {} TABLE {} ({})").format(
+                    sql.SQL("UNLOGGED" if unlogged else ""), table, sql.SQL(", ").join(column_defs)))
+
+                copy_columns = sql.SQL(", ").join(
+                    [sql.Identifier(name) for name, _ in columns] + [sql.Identifier('geom')])
+                copy_sql = sql.SQL("COPY {} ({}) FROM STDIN (FORMAT binary)").format(table, copy_columns)
+
+                stream = _ChunkStream(_copy_chunks(
+                    iter_shp_records(shp),
+                    iter_dbf_records(dbf, num_records, record_length),
+                    encoders, srid, stats))
+                cur.copy_expert(copy_sql.as_string(conn), stream, size=COPY_CHUNK_SIZE)
+
+                if transform_to_srid and transform_to_srid != srid:
+                    cur.execute(sql.SQL(
+                        "ALTER TABLE {} ALTER COLUMN geom TYPE geometry({}, {}) USING ST_Transform(geom, {})"
+                    ).format(table, sql.SQL(geometry_type), sql.Literal(transform_to_srid),
+                             sql.Literal(transform_to_srid)))
+
+                if spatial_index:
+                    cur.execute(sql.SQL("CREATE INDEX {} ON {} USING GIST (geom)").format(
+                        sql.Identifier(f"{table_name}_geom_geom_idx"), table))
+
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    return stats
@@ -273,6 +273,79 @@ class TestSpatialQueries:
             inegi_indexes = cur.fetchone()[0]
             assert inegi_indexes > 0, "No hay índices espaciales en INEGI"
 
+    def test_canonical_geometry_column(self, db_conn):
+        """Verificar que las tablas tienen geom_6372 en EPSG:6372 con índice GiST"""
+        with db_conn.cursor() as cur:
+            cur.execute("""
+                SELECT f_table_schema, f_table_name, srid
+                FROM geometry_columns
+                WHERE f_table_schema IN ('sepomex', 'inegi')
+                AND f_geometry_column = 'geom_6372';
+            """)
+            columns = cur.fetchall()
+            if not columns:
+                pytest.skip("No hay tablas con geom_6372 (CANONICAL_GEOM=false)")
+
+            for schema, table, srid in columns:
+                assert srid == 6372, f"{schema}.{table}.geom_6372 tiene SRID {srid}"
+
+            cur.execute("""
+                SELECT COUNT(*)
+                FROM pg_indexes
+                WHERE schemaname IN ('sepomex', 'inegi')
+                AND indexdef LIKE '%USING gist (geom_6372)%';
+            """)
+            assert cur.fetchone()[0] == len(columns), "Faltan índices GiST en geom_6372"
+
+    def test_unified_ageb_layer(self, db_conn):
+        """inegi.ageb tiene una partición por estado con todas sus AGEBs"""
+        with db_conn.cursor() as cur:
+            cur.execute("""
+                SELECT c.relname
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = to_regclass('inegi.ageb')
+                ORDER BY c.relname;
+            """)
+            partitions = [row[0] for row in cur.fetchall()]
+            if not partitions:
+                pytest.skip("No existe inegi.ageb (UNIFIED_LAYERS=false)")
+
+            cve_ent = partitions[0][-2:]
+            cur.execute("SELECT tipo, COUNT(*) FROM inegi.ageb WHERE cve_ent = %s GROUP BY tipo;", (cve_ent,))
+            counts = dict(cur.fetchall())
+
+            for tipo, count in counts.items():
+                cur.execute(f"SELECT COUNT(*) FROM inegi.ageb_{tipo}_{cve_ent} WHERE geom IS NOT NULL;")
+                assert cur.fetchone()[0] == count
+
+            cur.execute("SELECT DISTINCT ST_SRID(geom) FROM inegi.ageb WHERE cve_ent = %s;", (cve_ent,))
+            assert [row[0] for row in cur.fetchall()] == [6372]
+
+    def test_unified_cp_layer(self, db_conn):
+        """sepomex.cp tiene una partición por estado con los CPs de sus tablas"""
+        with db_conn.cursor() as cur:
+            cur.execute("""
+                SELECT c.relname
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = to_regclass('sepomex.cp')
+                ORDER BY c.relname;
+            """)
+            partitions = [row[0] for row in cur.fetchall()]
+            if not partitions:
+                pytest.skip("No existe sepomex.cp (UNIFIED_LAYERS=false)")
+
+            cve_ent = partitions[0][-2:]
+            cur.execute("SELECT source_table, COUNT(*) FROM sepomex.cp WHERE cve_ent = %s GROUP BY source_table;",
+                        (cve_ent,))
+            counts = dict(cur.fetchall())
+            assert counts
+
+            for source_table, count in counts.items():
+                cur.execute(f"SELECT COUNT(*) FROM sepomex.{source_table} WHERE geom IS NOT NULL;")
+                assert cur.fetchone()[0] == count
+
     def test_srid_consistency(self, db_conn):
         """Verificar que las geometrías tienen SRIDs correctos"""
         with db_conn.cursor() as cur:
@@ -412,5 +485,54 @@ class TestBuscarAgebsPorCPFunction:
                 # row[3] puede ser float o Decimal
 
 
+    def test_batch_function_matches_single(self, db_conn):
+        """buscar_agebs_por_cps devuelve lo mismo que buscar_agebs_por_cp, con CP de entrada y fuente"""
+        with db_conn.cursor() as cur:
+            cur.execute("""
+                SELECT array_agg(d_cp) FROM (
+                    SELECT DISTINCT d_cp FROM public.cp_directory ORDER BY d_cp LIMIT 5
+                ) t;
+            """)
+            cps = cur.fetchone()[0]
+            if not cps:
+                pytest.skip("No hay CPs en cp_directory para probar")
+
+            cur.execute("SELECT * FROM buscar_agebs_por_cps(%s) ORDER BY 1, 2, 3;", (cps,))
+            batch = cur.fetchall()
+
+            single = []
+            for cp in cps:
+                cur.execute("SELECT * FROM buscar_agebs_por_cp(%s);", (cp,))
+                single.extend(cur.fetchall())
+
+            assert all(len(row) == 5 for row in batch)
+            assert all(row[0] in cps for row in batch)
+            assert all(row[4] in ('mapeo', 'en_vivo') for row in batch)
+            assert sorted(row[:4] for row in batch) == sorted(single)
+            # Las filas del mapeo salen una vez por entidad, aunque tenga varias tablas de CPs
+            mapeo = [row[:4] for row in batch if row[4] == 'mapeo']
+            assert len(mapeo) == len(set(mapeo))
+
+    def test_compact_mapping_matches_mapping(self, db_conn):
+        """La vista compacta reproduce las filas de cp_to_ageb_mapping"""
+        with db_conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('public.cp_to_ageb_mapping_compact_view') IS NOT NULL;")
+            if not cur.fetchone()[0]:
+                pytest.skip("No existe la tabla compacta (create_cp_ageb_mapping.py --compact)")
+
+            cur.execute("""
+                SELECT estado_cve, codigo_postal, clave_ageb, tipo_ageb,
+                       porcentaje_interseccion, tipo_relacion
+                FROM public.cp_to_ageb_mapping
+                EXCEPT ALL
+                SELECT estado_cve, codigo_postal, clave_ageb, tipo_ageb,
+                       porcentaje_interseccion, tipo_relacion
+                FROM public.cp_to_ageb_mapping_compact_view;
+            """)
+            assert cur.fetchall() == []
+
+            cur.execute("SELECT public.entero_a_cvegeo(public.cvegeo_a_entero('0100100010A29'));")
+            assert cur.fetchone()[0] == '0100100010A29'
+
 if __name__ == '__main__':
     pytest.main([__file__, '-v'])
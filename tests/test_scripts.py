@@ -3,7 +3,10 @@
 Tests para los scripts Python de descarga y carga
 """
 
+import hashlib
+import json
 import pytest
+import requests
 import sys
 import os
 from pathlib import Path
@@ -15,6 +18,7 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 # Import scripts
 import download_shapefiles
 import download_ageb_shapefiles
+import download_utils
 
 
 class TestDownloadShapefilesScript:
@@ -42,97 +46,6 @@ class TestDownloadShapefilesScript:
         assert download_shapefiles.BASE_URL.startswith('http')
         assert 'sepomex' in download_shapefiles.BASE_URL.lower()
 
-    @patch('download_shapefiles.requests.get')
-    def test_download_file_success(self, mock_get):
-        """Test de descarga exitosa de archivo"""
-        import tempfile
-        import zipfile
-
-        # Crear un ZIP válido en memoria
-        zip_buffer = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-        with zipfile.ZipFile(zip_buffer.name, 'w') as zf:
-            zf.writestr('test.txt', 'test content')
-
-        # Leer el contenido del ZIP válido
-        with open(zip_buffer.name, 'rb') as f:
-            valid_zip_data = f.read()
-
-        # Limpiar archivo temporal
-        import os
-        os.unlink(zip_buffer.name)
-
-        # Mock response con ZIP válido
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.headers = {'content-length': str(len(valid_zip_data))}
-        mock_response.iter_content = Mock(return_value=[valid_zip_data])
-        mock_get.return_value = mock_response
-
-        # Crear directorio temporal
-        with tempfile.TemporaryDirectory() as tmpdir:
-            output_path = Path(tmpdir) / 'test.zip'
-            url = 'http://example.com/test.zip'
-
-            result = download_shapefiles.download_file(url, output_path)
-
-            assert result is True
-            assert output_path.exists()
-
-    @patch('download_shapefiles.requests.get')
-    def test_download_file_overwrites_existing(self, mock_get):
-        """Test de descarga que sobrescribe archivo existente"""
-        import tempfile
-        import zipfile
-        import os
-
-        # Crear un ZIP válido en memoria
-        zip_buffer = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-        with zipfile.ZipFile(zip_buffer.name, 'w') as zf:
-            zf.writestr('new_file.txt', 'new data')
-
-        # Leer el contenido del ZIP válido
-        with open(zip_buffer.name, 'rb') as f:
-            valid_zip_data = f.read()
-
-        # Limpiar archivo temporal
-        os.unlink(zip_buffer.name)
-
-        # Mock response con ZIP válido
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.headers = {'content-length': str(len(valid_zip_data))}
-        mock_response.iter_content = Mock(return_value=[valid_zip_data])
-        mock_get.return_value = mock_response
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            output_path = Path(tmpdir) / 'test.zip'
-            output_path.write_text('existing data')
-
-            url = 'http://example.com/test.zip'
-            result = download_shapefiles.download_file(url, output_path)
-
-            # La función descarga incluso si el archivo existe (sobrescribe)
-            mock_get.assert_called_once()
-            assert result is True
-            # Verificar que el archivo fue sobrescrito
-            assert output_path.exists()
-
-    @patch('download_shapefiles.requests.get')
-    def test_download_file_404_error(self, mock_get):
-        """Test de error 404"""
-        mock_response = Mock()
-        mock_response.status_code = 404
-        mock_get.return_value = mock_response
-
-        import tempfile
-        with tempfile.TemporaryDirectory() as tmpdir:
-            output_path = Path(tmpdir) / 'test.zip'
-            url = 'http://example.com/test.zip'
-
-            result = download_shapefiles.download_file(url, output_path)
-
-            assert result is False
-
 
 class TestDownloadAgebShapefilesScript:
     """Tests para el script download_ageb_shapefiles.py"""
@@ -169,6 +82,319 @@ class TestDownloadAgebShapefilesScript:
         assert 'inegi' in download_ageb_shapefiles.BASE_URL.lower()
 
 
+def _zip_bytes(name='test.txt', content='test content'):
+    """Contenido de un ZIP válido con un solo archivo"""
+    import io
+    import zipfile
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        zf.writestr(name, content)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def local_http_server(tmp_path):
+    """Servidor HTTP local que sirve tmp_path/www con ETag, If-None-Match y Range
+
+    stats registra la concurrencia máxima y los Range atendidos; con
+    stats['cut_after'] = N la siguiente respuesta se corta tras N bytes.
+    """
+    import hashlib
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    www = tmp_path / 'www'
+    www.mkdir()
+    stats = {'active': 0, 'max_active': 0, 'requests': 0, 'delay': 0.0,
+             'ranges': [], 'cut_after': None, 'not_modified': 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                stats['active'] += 1
+                stats['requests'] += 1
+                stats['max_active'] = max(stats['max_active'], stats['active'])
+            try:
+                time.sleep(stats['delay'])
+                self._serve()
+            finally:
+                with lock:
+                    stats['active'] -= 1
+
+        def _serve(self):
+            path = www / self.path.lstrip('/')
+            if not path.is_file():
+                self.send_error(404)
+                return
+            data = path.read_bytes()
+            etag = f'"{hashlib.md5(data).hexdigest()}"'
+            if self.headers.get('If-None-Match') == etag:
+                stats['not_modified'] += 1
+                self.send_response(304)
+                self.end_headers()
+                return
+            start = 0
+            if self.headers.get('Range') and self.headers.get('If-Range') == etag:
+                start = int(self.headers['Range'].split('=')[1].split('-')[0])
+                stats['ranges'].append(start)
+            body = data[start:]
+
+            self.send_response(206 if start else 200)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            if start:
+                self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+            self.end_headers()
+
+            with lock:
+                cut, stats['cut_after'] = stats['cut_after'], None
+            self.wfile.write(body if cut is None else body[:cut])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}", www, stats
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class TestDownloadUtils:
+    """Tests para download_utils.py contra un servidor HTTP local"""
+
+    def test_download_all_concurrent(self, local_http_server, tmp_path):
+        """Todas las descargas terminan y no quedan archivos .part"""
+        base_url, www, stats = local_http_server
+        for i in range(4):
+            (www / f'{i:02d}.zip').write_bytes(_zip_bytes(content=f'estado {i}'))
+        output_dir = tmp_path / 'out'
+        jobs = [(f'estado {i}', f'{base_url}/{i:02d}.zip', output_dir / f'{i:02d}.zip') for i in range(4)]
+
+        result = download_utils.download_all(jobs, timeout=5, workers=4, per_host=4)
+
+        assert result == (4, 0)
+        assert sorted(p.name for p in output_dir.iterdir()) == ['00.zip', '01.zip', '02.zip', '03.zip']
+
+    def test_per_host_limit(self, local_http_server, tmp_path):
+        """No hay más descargas simultáneas contra un host que per_host"""
+        base_url, www, stats = local_http_server
+        stats['delay'] = 0.1
+        for i in range(6):
+            (www / f'{i:02d}.zip').write_bytes(_zip_bytes())
+        jobs = [(f'estado {i}', f'{base_url}/{i:02d}.zip', tmp_path / 'out' / f'{i:02d}.zip') for i in range(6)]
+
+        result = download_utils.download_all(jobs, timeout=5, workers=6, per_host=2)
+
+        assert result == (6, 0)
+        assert stats['requests'] == 6
+        assert stats['max_active'] <= 2
+
+    def test_invalid_zip_leaves_no_file(self, local_http_server, tmp_path):
+        """Un ZIP inválido no se renombra al nombre final ni deja el .part"""
+        base_url, www, stats = local_http_server
+        (www / 'roto.zip').write_bytes(b'no es un zip')
+        output_path = tmp_path / 'out' / 'roto.zip'
+
+        with pytest.raises(download_utils.InvalidZipError):
+            download_utils.fetch_to_file(f'{base_url}/roto.zip', output_path, timeout=5)
+
+        assert not output_path.exists()
+        assert not download_utils.part_path(output_path).exists()
+
+    def test_download_overwrites_existing_file(self, local_http_server, tmp_path):
+        """Una descarga reemplaza el archivo existente con el ZIP del servidor"""
+        base_url, www, stats = local_http_server
+        (www / 'nuevo.zip').write_bytes(_zip_bytes('new_file.txt', 'new data'))
+        output_path = tmp_path / 'out' / 'nuevo.zip'
+        output_path.parent.mkdir()
+        output_path.write_text('existing data')
+
+        entry = download_utils.fetch_to_file(f'{base_url}/nuevo.zip', output_path, timeout=5)
+
+        assert output_path.read_bytes() == (www / 'nuevo.zip').read_bytes()
+        assert entry['size'] == output_path.stat().st_size
+
+    def test_http_error_counts_as_failed(self, local_http_server, tmp_path):
+        """Un 404 se reporta como descarga fallida y no deja archivos"""
+        base_url, www, stats = local_http_server
+        output_path = tmp_path / 'out' / 'no_existe.zip'
+
+        with pytest.raises(requests.HTTPError):
+            download_utils.fetch_to_file(f'{base_url}/no_existe.zip', output_path, timeout=5)
+
+        result = download_utils.download_all([('no existe', f'{base_url}/no_existe.zip', output_path)],
+                                             timeout=5)
+
+        assert result == (0, 1)
+        assert not output_path.exists()
+        assert not download_utils.part_path(output_path).exists()
+
+    def test_interrupted_download_keeps_previous_file(self, tmp_path):
+        """Si la descarga se interrumpe el archivo final no se toca y el .part queda para reanudar"""
+        output_path = tmp_path / 'CP_Jal.zip'
+        output_path.write_bytes(b'anterior')
+
+        def chunks(chunk_size):
+            yield b'PK'
+            raise requests.exceptions.ConnectionError("conexión perdida")
+
+        response = Mock(status_code=200, headers={'etag': '"v1"'})
+        response.iter_content = chunks
+        session = Mock()
+        session.get.return_value = response
+
+        with patch.object(download_utils, 'DOWNLOAD_RETRIES', 0), \
+                pytest.raises(requests.exceptions.ConnectionError):
+            download_utils.fetch_to_file('http://example.com/CP_Jal.zip', output_path, session=session)
+
+        assert output_path.read_bytes() == b'anterior'
+        assert download_utils.part_path(output_path).read_bytes() == b'PK'
+
+    def test_resume_after_cut_connection(self, local_http_server, tmp_path):
+        """Tras un corte se piden solo los bytes faltantes con Range + If-Range"""
+        base_url, www, stats = local_http_server
+        data = _zip_bytes(content='x' * 5000)
+        (www / 'CP_Jal.zip').write_bytes(data)
+        stats['cut_after'] = 100
+        output_path = tmp_path / 'out' / 'CP_Jal.zip'
+
+        with patch.object(download_utils, 'RETRY_BACKOFF', 0), \
+                patch.object(download_utils, 'CHUNK_SIZE', 50):
+            entry = download_utils.fetch_to_file(f'{base_url}/CP_Jal.zip', output_path, timeout=5)
+
+        assert entry['size'] == len(data)
+        assert entry['sha256'] == hashlib.sha256(data).hexdigest()
+        assert output_path.read_bytes() == data
+        assert stats['ranges'] == [100]
+        assert not download_utils.part_path(output_path).exists()
+        assert not download_utils.part_meta_path(output_path).exists()
+
+    def test_part_from_previous_run_is_resumed(self, local_http_server, tmp_path):
+        """Un .part de una ejecución anterior con el mismo ETag se completa"""
+        base_url, www, stats = local_http_server
+        data = _zip_bytes(content='y' * 5000)
+        (www / 'CP_Jal.zip').write_bytes(data)
+        url = f'{base_url}/CP_Jal.zip'
+        output_path = tmp_path / 'CP_Jal.zip'
+
+        stats['cut_after'] = 300
+        with patch.object(download_utils, 'DOWNLOAD_RETRIES', 0), \
+                patch.object(download_utils, 'CHUNK_SIZE', 50), \
+                pytest.raises(requests.exceptions.RequestException):
+            download_utils.fetch_to_file(url, output_path, timeout=5)
+        assert download_utils.part_path(output_path).stat().st_size == 300
+
+        entry = download_utils.fetch_to_file(url, output_path, timeout=5)
+
+        assert output_path.read_bytes() == data
+        assert entry['sha256'] == hashlib.sha256(data).hexdigest()
+        assert stats['ranges'] == [300]
+
+    def test_changed_file_restarts_from_zero(self, local_http_server, tmp_path):
+        """Si el archivo cambió en el servidor (otro ETag) el .part se descarta"""
+        base_url, www, stats = local_http_server
+        data = _zip_bytes(content='nueva versión')
+        (www / 'CP_Jal.zip').write_bytes(data)
+        url = f'{base_url}/CP_Jal.zip'
+        output_path = tmp_path / 'CP_Jal.zip'
+        download_utils.part_path(output_path).write_bytes(b'PK-anterior')
+        download_utils.part_meta_path(output_path).write_text(
+            json.dumps({'url': url, 'etag': '"viejo"', 'last_modified': None}))
+
+        download_utils.fetch_to_file(url, output_path, timeout=5)
+
+        assert output_path.read_bytes() == data
+        assert stats['ranges'] == []
+
+    def test_manifest_records_download(self, local_http_server, tmp_path):
+        """El manifiesto guarda URL, ETag, tamaño y SHA-256 de cada archivo"""
+        base_url, www, stats = local_http_server
+        data = _zip_bytes()
+        (www / 'CP_Jal.zip').write_bytes(data)
+        manifest_file = tmp_path / 'manifest.json'
+        jobs = [('Jalisco', f'{base_url}/CP_Jal.zip', tmp_path / 'CP_Jal.zip')]
+
+        download_utils.download_all(jobs, timeout=5, manifest_file=manifest_file)
+
+        entry = download_utils.load_manifest(manifest_file)['CP_Jal.zip']
+        assert entry['url'] == f'{base_url}/CP_Jal.zip'
+        assert entry['etag'] == f'"{hashlib.md5(data).hexdigest()}"'
+        assert entry['size'] == len(data)
+        assert entry['sha256'] == hashlib.sha256(data).hexdigest()
+        assert entry['downloaded_at']
+
+    def test_refresh_downloads_only_changed_files(self, local_http_server, tmp_path):
+        """Con archivos existentes la petición es condicional: 304 no reemplaza nada"""
+        base_url, www, stats = local_http_server
+        (www / 'CP_Jal.zip').write_bytes(_zip_bytes(content='v1'))
+        (www / 'CP_Col.zip').write_bytes(_zip_bytes(content='v1'))
+        manifest_file = tmp_path / 'manifest.json'
+        jobs = [(name, f'{base_url}/{name}.zip', tmp_path / f'{name}.zip') for name in ('CP_Jal', 'CP_Col')]
+        download_utils.download_all(jobs, timeout=5, manifest_file=manifest_file)
+        before = download_utils.load_manifest(manifest_file)
+
+        nueva = _zip_bytes(content='v2')
+        (www / 'CP_Jal.zip').write_bytes(nueva)
+        result = download_utils.download_all(jobs, timeout=5, manifest_file=manifest_file)
+
+        after = download_utils.load_manifest(manifest_file)
+        assert result == (2, 0)
+        assert stats['not_modified'] == 1
+        assert (tmp_path / 'CP_Jal.zip').read_bytes() == nueva
+        assert after['CP_Col.zip'] == before['CP_Col.zip']
+        assert after['CP_Jal.zip']['sha256'] != before['CP_Jal.zip']['sha256']
+
+    def test_validate_zip_reads_only_central_directory(self, tmp_path):
+        """La validación no descomprime (testzip) y detecta cabeceras locales dañadas"""
+        import zipfile
+        path = tmp_path / 'CP_Jal.zip'
+        path.write_bytes(_zip_bytes())
+
+        with patch.object(zipfile.ZipFile, 'testzip', side_effect=AssertionError("testzip")):
+            assert download_utils.validate_zip(path) == 1
+
+            data = bytearray(path.read_bytes())
+            data[0:4] = b'XXXX'
+            path.write_bytes(bytes(data))
+            with pytest.raises(download_utils.InvalidZipError):
+                download_utils.validate_zip(path)
+
+    def test_matches_manifest_by_size_and_mtime(self, tmp_path):
+        """Un archivo tocado después de descargarlo deja de coincidir con el manifiesto"""
+        import os
+        path = tmp_path / 'CP_Jal.zip'
+        path.write_bytes(_zip_bytes())
+        entry = download_utils.manifest_entry('http://example.com/CP_Jal.zip', path)
+
+        assert download_utils.matches_manifest(path, entry)
+        os.utime(path, ns=(entry['mtime_ns'] + 10**9, entry['mtime_ns'] + 10**9))
+        assert not download_utils.matches_manifest(path, entry)
+
+
+@pytest.fixture
+def load_shapefiles():
+    """Módulo scripts/load_shapefiles.py (skip si no está disponible)"""
+    sys.path.insert(0, str(Path(__file__).parent.parent / 'scripts'))
+    try:
+        import load_shapefiles
+    except ImportError:
+        pytest.skip("Script load_shapefiles no disponible")
+    return load_shapefiles
+
+
+def _fake_state_job(cve_ent, exitosos, fallidos):
+    """Job de estado para tests: imprime dos líneas y retorna contadores"""
+    print(f"[{cve_ent}] inicio")
+    print(f"[{cve_ent}] fin")
+    return exitosos, fallidos
+
+
 class TestLoadShapefilesHelpers:
     """Tests para funciones helper del script de carga"""
 
@@ -340,6 +566,1067 @@ class TestLoadShapefilesHelpers:
         except (ImportError, AttributeError) as e:
             pytest.skip(f"Script load_shapefiles no disponible: {e}")
 
+    # Carga de estados en paralelo (LOAD_WORKERS)
+
+    def test_run_state_jobs_sequential(self, load_shapefiles):
+        """Con LOAD_WORKERS=1 los contadores se suman en orden"""
+        jobs = [('01', 2, 0), ('02', 1, 1)]
+
+        with patch.object(load_shapefiles, 'LOAD_WORKERS', 1):
+            result = load_shapefiles.run_state_jobs(_fake_state_job, jobs)
+
+        assert result == (3, 1)
+
+    def test_run_state_jobs_parallel(self, load_shapefiles, capsys):
+        """Con LOAD_WORKERS>1 los contadores coinciden y la salida no se intercala"""
+        jobs = [(f"{i:02d}", 1, i % 2) for i in range(1, 7)]
+
+        with patch.object(load_shapefiles, 'LOAD_WORKERS', 3):
+            result = load_shapefiles.run_state_jobs(_fake_state_job, jobs)
+
+        assert result == (6, 3)
+
+        lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith('[')]
+        assert len(lines) == 12
+        # Cada estado imprime sus dos líneas de forma contigua
+        for inicio, fin in zip(lines[::2], lines[1::2]):
+            assert inicio.split()[0] == fin.split()[0]
+
+    def test_run_buffered_captures_errors(self, load_shapefiles):
+        """Un error en un estado se reporta como fallido sin detener la carga"""
+        def failing_job(cve_ent):
+            raise RuntimeError("boom")
+
+        with patch.object(load_shapefiles, 'flush_load_metadata') as mock_flush:
+            output, counts = load_shapefiles._run_buffered(failing_job, ('05',))
+
+        assert counts == (0, 1)
+        assert 'boom' in output
+        # Los registros pendientes del estado se escriben aunque falle
+        mock_flush.assert_called_once()
+
+    # Lectura de shapefiles desde ZIPs
+
+    def _make_zip(self, path):
+        import zipfile
+        with zipfile.ZipFile(path, 'w') as zf:
+            for ext in ('shp', 'shx', 'dbf', 'prj'):
+                zf.writestr(f"conjunto_de_datos/14a.{ext}", b'x')
+                zf.writestr(f"conjunto_de_datos/14m.{ext}", b'x')
+            zf.writestr("__MACOSX/conjunto_de_datos/._14a.shp", b'x')
+
+    def test_list_zip_shapefiles_vsizip_paths(self, load_shapefiles, tmp_path):
+        """Enumera .shp del directorio central sin escribir a disco"""
+        zip_path = tmp_path / '14_jalisco.zip'
+        self._make_zip(zip_path)
+
+        shp_files = load_shapefiles.list_zip_shapefiles(zip_path)
+
+        assert sorted(shp_files) == [
+            f"/vsizip/{zip_path}/conjunto_de_datos/14a.shp",
+            f"/vsizip/{zip_path}/conjunto_de_datos/14m.shp",
+        ]
+        assert sorted(p.name for p in tmp_path.iterdir()) == ['14_jalisco.zip']
+
+    def test_shapefile_name_from_vsizip(self, load_shapefiles):
+        """El nombre del shapefile se obtiene igual desde /vsizip/ o Path"""
+        vsizip = "/vsizip//data/ageb_shapefiles/14_jalisco.zip/conjunto_de_datos/14ar.shp"
+        assert load_shapefiles.shapefile_name(vsizip).stem == '14ar'
+        assert load_shapefiles.shapefile_name(Path('/tmp/x/14ar.shp')).name == '14ar.shp'
+
+    def test_list_zip_shapefiles_corrupt_zip_removed(self, load_shapefiles, tmp_path):
+        """Un ZIP corrupto se elimina para permitir re-descarga"""
+        zip_path = tmp_path / 'CP_Jal.zip'
+        zip_path.write_bytes(b'no es un zip')
+
+        assert load_shapefiles.list_zip_shapefiles(zip_path) == []
+        assert not zip_path.exists()
+
+    # Extracción selectiva de capas INEGI según LOAD_LAYERS
+
+    def test_classify_inegi_layer(self, load_shapefiles):
+        """Clasificación de capas por nombre de archivo"""
+        assert load_shapefiles.classify_inegi_layer('14a', '14') == 'ageb_urbana'
+        assert load_shapefiles.classify_inegi_layer('14AR', '14') == 'ageb_rural'
+        assert load_shapefiles.classify_inegi_layer('14m', '14') == 'manzana'
+        assert load_shapefiles.classify_inegi_layer('14lpr', '14') == 'localidad'
+        assert load_shapefiles.classify_inegi_layer('14mun', '14') == 'municipio'
+        assert load_shapefiles.classify_inegi_layer('14ent', '14') == 'entidad'
+        assert load_shapefiles.classify_inegi_layer('14fm', '14') is None
+
+    def test_extract_only_enabled_layers(self, load_shapefiles, tmp_path):
+        """Solo se descomprimen los archivos de las capas habilitadas"""
+        import zipfile
+        from functools import partial
+
+        zip_path = tmp_path / '14_jalisco.zip'
+        with zipfile.ZipFile(zip_path, 'w') as zf:
+            for stem in ('14a', '14ar', '14m', '14mun'):
+                for ext in ('shp', 'shx', 'dbf', 'prj', 'cpg', 'shp.xml'):
+                    zf.writestr(f"conjunto_de_datos/{stem}.{ext}", b'x')
+            zf.writestr("metadatos/14a.html", b'x')
+
+        layers = {'agebs': True, 'manzanas': False, 'localidades': False,
+                  'municipios': False, 'entidades': False}
+        extract_dir = tmp_path / 'ageb_14'
+
+        with patch.dict(load_shapefiles.LOAD_LAYERS, layers):
+            layer_filter = partial(load_shapefiles.inegi_skip_reason, cve_ent='14')
+            shp_files = load_shapefiles.extract_zip(zip_path, extract_dir, layer_filter)
+
+        assert sorted(p.name for p in shp_files) == ['14a.shp', '14ar.shp']
+        extracted = sorted(p.name for p in extract_dir.rglob('*') if p.is_file())
+        assert extracted == sorted(
+            f"{stem}.{ext}" for stem in ('14a', '14ar') for ext in ('shp', 'shx', 'dbf', 'prj', 'cpg')
+        )
+
+    # Sesión de metadatos del cargador
+
+    def test_table_exists_uses_snapshot(self, load_shapefiles):
+        """Con snapshot del catálogo no se consulta la base de datos"""
+        snapshot = {('sepomex', 'cp_14_cp_jal'), ('inegi', 'ageb_urbana_14')}
+
+        with patch.object(load_shapefiles, 'EXISTING_TABLES', snapshot), \
+                patch.object(load_shapefiles, 'get_db_connection') as mock_conn:
+            assert load_shapefiles.table_exists('sepomex', 'cp_14_cp_jal') is True
+            assert load_shapefiles.table_exists('inegi', 'ageb_rural_14') is False
+            mock_conn.assert_not_called()
+
+    def test_register_load_batches_inserts(self, load_shapefiles):
+        """Los registros de carga se insertan en un solo lote"""
+        with patch.object(load_shapefiles, 'get_db_connection'), \
+                patch.object(load_shapefiles, 'execute_values') as mock_execute:
+            load_shapefiles.register_load('ageb_urbana_14', 'INEGI', '14_jalisco.zip')
+            load_shapefiles.register_load('ageb_rural_14', 'INEGI', '14_jalisco.zip', status='failed')
+            mock_execute.assert_not_called()
+
+            load_shapefiles.flush_load_metadata()
+            load_shapefiles.flush_load_metadata()
+
+        assert mock_execute.call_count == 1
+        rows = mock_execute.call_args[0][2]
+        assert [row[0] for row in rows] == ['ageb_urbana_14', 'ageb_rural_14']
+        assert rows[1][4] == 'failed'
+
+    # Perfil de carga masiva (BULK_LOAD)
+
+    def _ogr2ogr_cmd(self, load_shapefiles, bulk):
+        with patch.object(load_shapefiles, 'BULK_LOAD', bulk), \
+                patch.object(load_shapefiles, 'table_exists', return_value=False), \
+                patch.object(load_shapefiles.subprocess, 'run') as mock_run:
+            mock_run.return_value = Mock(returncode=0, stderr='')
+            result = load_shapefiles.load_shapefile_to_postgis(Path('/tmp/14a.shp'), 'inegi', 'ageb_urbana_14')
+
+        assert result is True
+        return mock_run.call_args[0][0]
+
+    def test_default_command_unchanged(self, load_shapefiles):
+        """Sin BULK_LOAD el comando de ogr2ogr no incluye opciones de carga masiva"""
+        cmd = self._ogr2ogr_cmd(load_shapefiles, bulk=False)
+
+        assert 'PG_USE_COPY' not in cmd
+        assert 'UNLOGGED=ON' not in cmd
+        assert 'SPATIAL_INDEX=NONE' not in cmd
+
+    def test_bulk_command_options(self, load_shapefiles):
+        """Con BULK_LOAD se usa COPY, lotes grandes, UNLOGGED y sin índice inline"""
+        cmd = self._ogr2ogr_cmd(load_shapefiles, bulk=True)
+
+        assert cmd[0] == 'ogr2ogr'
+        assert cmd[1:4] == ['--config', 'PG_USE_COPY', 'YES']
+        assert cmd[cmd.index('-gt') + 1] == load_shapefiles.BULK_LOAD_GT
+        assert 'UNLOGGED=ON' in cmd
+        assert 'SPATIAL_INDEX=NONE' in cmd
+
+    # Selección del cargador nativo (LOADER_BACKEND=native)
+
+    def test_backend_dispatch(self, load_shapefiles):
+        """Con LOADER_BACKEND=native no se invoca ogr2ogr"""
+        with patch.object(load_shapefiles, 'LOADER_BACKEND', 'native'), \
+                patch.object(load_shapefiles, 'table_exists', return_value=False), \
+                patch.object(load_shapefiles, 'get_db_connection'), \
+                patch.object(load_shapefiles.native_loader, 'load_shapefile',
+                             return_value={'rows': 10, 'skipped': 0}) as mock_load, \
+                patch.object(load_shapefiles.subprocess, 'run') as mock_run:
+            result = load_shapefiles.load_shapefile_to_postgis(
+                Path('/tmp/14a.shp'), 'inegi', 'ageb_urbana_14', transform_to_srid=900919)
+
+        assert result is True
+        mock_run.assert_not_called()
+        args, kwargs = mock_load.call_args
+        assert args[1:] == (Path('/tmp/14a.shp'), 'inegi', 'ageb_urbana_14')
+        assert kwargs['transform_to_srid'] == 900919
+
+    # Geometría canónica geom_6372 (CANONICAL_GEOM)
+
+    def _executed_sql(self, load_shapefiles, enabled, tables):
+        cursor = MagicMock()
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+        with patch.object(load_shapefiles, 'CANONICAL_GEOM', enabled), \
+                patch.object(load_shapefiles, 'get_db_connection', return_value=conn):
+            load_shapefiles.add_canonical_geometry(tables)
+        return [c[0][0] for c in cursor.execute.call_args_list]
+
+    def test_adds_generated_column_and_index(self, load_shapefiles):
+        """Cada tabla recibe geom_6372 generada con ST_Transform y su índice GiST"""
+        from psycopg2 import sql
+        statements = self._executed_sql(load_shapefiles, True, [('inegi', 'ageb_urbana_14')])
+
+        assert len(statements) == 3
+        assert all(isinstance(stmt, sql.Composed) for stmt in statements)
+        alter, index, analyze = (repr(stmt) for stmt in statements)
+        assert 'ADD COLUMN IF NOT EXISTS' in alter
+        assert 'ST_Transform(geom' in alter and 'STORED' in alter
+        assert "Identifier('ageb_urbana_14_geom_6372_idx')" in index
+        assert 'ANALYZE' in analyze
+
+    def test_canonical_geometry_disabled_does_nothing(self, load_shapefiles):
+        """Con CANONICAL_GEOM=false no se modifica ninguna tabla"""
+        assert self._executed_sql(load_shapefiles, False, [('inegi', 'ageb_urbana_14')]) == []
+        assert self._executed_sql(load_shapefiles, True, []) == []
+
+    def test_bulk_finalize_rewrites_once(self, load_shapefiles):
+        """Bajo BULK_LOAD, SET LOGGED y geom_6372 van en un solo ALTER TABLE"""
+        cursor = MagicMock()
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+        with patch.object(load_shapefiles, 'BULK_LOAD', True), \
+                patch.object(load_shapefiles, 'CANONICAL_GEOM', True), \
+                patch.object(load_shapefiles, 'get_db_connection', return_value=conn):
+            fallidas = load_shapefiles.finalize_bulk_tables([('inegi', 'ageb_urbana_14')])
+
+        assert fallidas == []
+        alters = [repr(c[0][0]) for c in cursor.execute.call_args_list if 'ALTER TABLE' in repr(c[0][0])]
+        assert len(alters) == 1
+        assert 'SET LOGGED' in alters[0] and 'ADD COLUMN IF NOT EXISTS' in alters[0]
+
+    def test_post_load_failure_registers_failed(self, load_shapefiles, capsys):
+        """Una tabla cuya post-carga falla se registra como fallida y no sigue adelante"""
+        def execute(stmt, *args):
+            if 'cp_14_b' in repr(stmt):
+                raise RuntimeError('sin espacio')
+
+        cursor = MagicMock()
+        cursor.execute.side_effect = execute
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+        tables = [('sepomex', 'cp_14_a'), ('sepomex', 'cp_14_b')]
+        with patch.object(load_shapefiles, 'BULK_LOAD', True), \
+                patch.object(load_shapefiles, 'CANONICAL_GEOM', True), \
+                patch.object(load_shapefiles, 'get_db_connection', return_value=conn), \
+                patch.object(load_shapefiles, 'register_load') as mock_register:
+            cargadas = load_shapefiles.post_load_tables(tables, 'SEPOMEX', 'CP_Jal.zip')
+
+        assert cargadas == [('sepomex', 'cp_14_a')]
+        registros = {c[0][0]: c[1]['status'] for c in mock_register.call_args_list}
+        assert registros == {'cp_14_a': 'success', 'cp_14_b': 'failed'}
+        assert 'sepomex.cp_14_b: sin espacio' in capsys.readouterr().out
+
+    # Directorio de códigos postales (public.cp_directory)
+
+    def test_refresh_replaces_rows_per_table(self, load_shapefiles):
+        """Cada tabla SEPOMEX se reemplaza en una transacción; INEGI se ignora"""
+        cursor = MagicMock()
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+
+        with patch.object(load_shapefiles, 'get_db_connection', return_value=conn):
+            load_shapefiles.refresh_cp_directory([('sepomex', 'cp_14_cp_jal'), ('inegi', 'ageb_urbana_14')])
+
+        calls = cursor.execute.call_args_list
+        assert [c[0][0] for c in calls if isinstance(c[0][0], str) and c[0][0] in ('BEGIN', 'COMMIT')] == \
+            ['BEGIN', 'COMMIT']
+        assert calls[1][0] == ("DELETE FROM public.cp_directory WHERE source_table = %s", ('cp_14_cp_jal',))
+        insert = repr(calls[2][0][0])
+        assert "Literal('14')" in insert
+        assert "Literal('cp_14_cp_jal')" in insert
+
+    def test_refresh_without_sepomex_tables(self, load_shapefiles):
+        """Sin tablas SEPOMEX no se abre conexión"""
+        with patch.object(load_shapefiles, 'get_db_connection') as mock_conn:
+            load_shapefiles.refresh_cp_directory([('inegi', 'ageb_urbana_14')])
+
+        mock_conn.assert_not_called()
+
+    # Piezas ST_Subdivide del schema subdiv (SUBDIVIDE_GEOM)
+
+    def test_builds_pieces_for_cp_and_ageb_tables(self, load_shapefiles):
+        """Solo CPs y AGEBs se subdividen, con parent_fid, llave e índices"""
+        cursor = MagicMock(rowcount=7)
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+
+        with patch.object(load_shapefiles, 'SUBDIVIDE_GEOM', True), \
+                patch.object(load_shapefiles, 'get_db_connection', return_value=conn), \
+                patch.object(load_shapefiles, 'register_load') as mock_register:
+            load_shapefiles.build_subdivided_tables([('sepomex', 'cp_14_cp_jal'),
+                                                     ('inegi', 'ageb_urbana_14'),
+                                                     ('inegi', 'manzanas_14')])
+
+        statements = [repr(c[0][0]) for c in cursor.execute.call_args_list]
+        creates = [stmt for stmt in statements if 'CREATE TABLE' in stmt]
+        assert len(creates) == 2
+        assert "Identifier('d_cp')" in creates[0] and 'ST_Subdivide' in creates[0]
+        assert "Identifier('cvegeo')" in creates[1] and 'parent_fid' in creates[1]
+        assert not any('manzanas_14' in stmt for stmt in statements)
+        assert sum('USING GIST' in stmt for stmt in statements) == 2
+        # El schema se crea una sola vez en main(), no en cada proceso
+        assert not any('CREATE SCHEMA' in stmt for stmt in statements)
+        # Cada construcción queda en load_metadata para la huella del mapeo
+        mock_register.assert_any_call('subdiv.cp_14_cp_jal', 'SUBDIV', 'cp_14_cp_jal', 7)
+        assert mock_register.call_count == 2
+
+    def test_subdivide_disabled_does_nothing(self, load_shapefiles):
+        """Con SUBDIVIDE_GEOM=false no se crea ninguna tabla"""
+        with patch.object(load_shapefiles, 'SUBDIVIDE_GEOM', False), \
+                patch.object(load_shapefiles, 'get_db_connection') as mock_conn:
+            load_shapefiles.build_subdivided_tables([('sepomex', 'cp_14_cp_jal')])
+
+        mock_conn.assert_not_called()
+
+    # Capas unificadas inegi.ageb y sepomex.cp (UNIFIED_LAYERS)
+
+    def test_partition_rebuilt_per_state(self, load_shapefiles):
+        """Cada estado con AGEBs reconstruye su partición con urbanas y rurales"""
+        cursor = MagicMock()
+        cursor.fetchone.return_value = (True,)
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+
+        with patch.object(load_shapefiles, 'UNIFIED_LAYERS', True), \
+                patch.object(load_shapefiles, 'get_db_connection', return_value=conn):
+            load_shapefiles.refresh_unified_ageb([('inegi', 'ageb_urbana_14'),
+                                                  ('inegi', 'manzana_14'),
+                                                  ('sepomex', 'cp_14_cp_jal')])
+
+        statements = [repr(c[0][0]) for c in cursor.execute.call_args_list]
+        assert sum('PARTITION OF' in stmt for stmt in statements) == 1
+        assert any("Identifier('inegi', 'ageb_estado_14')" in stmt and 'TRUNCATE' in stmt
+                   for stmt in statements)
+        inserts = [stmt for stmt in statements if 'INSERT INTO' in stmt]
+        assert len(inserts) == 2
+        assert "Literal('urbana')" in inserts[0] and "Literal('rural')" in inserts[1]
+        assert "'COMMIT'" in statements
+        # La tabla padre se crea una sola vez en main(), no en cada proceso
+        assert not any('PARTITION BY LIST' in stmt for stmt in statements)
+
+    def test_unified_tables_are_not_source_tables(self, load_shapefiles):
+        """inegi.ageb y sus particiones no reciben geom_6372 ni se subdividen"""
+        assert load_shapefiles.is_unified_table('inegi', 'ageb')
+        assert load_shapefiles.is_unified_table('inegi', 'ageb_estado_14')
+        assert not load_shapefiles.is_unified_table('inegi', 'ageb_urbana_14')
+        assert load_shapefiles.subdivide_key('inegi', 'ageb_estado_14') is None
+
+    def test_cp_partition_combines_state_tables(self, load_shapefiles):
+        """La partición de sepomex.cp reúne todas las tablas cp_XX_* del estado"""
+        cursor = MagicMock()
+        cursor.fetchone.return_value = (True,)
+        cursor.fetchall.return_value = [('cp_14_cp_jal',), ('cp_14_cp_jal_norte',)]
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+
+        with patch.object(load_shapefiles, 'UNIFIED_LAYERS', True), \
+                patch.object(load_shapefiles, 'get_db_connection', return_value=conn):
+            load_shapefiles.refresh_unified_cp([('sepomex', 'cp_14_cp_jal'),
+                                                ('sepomex', 'cp_14_cp_jal_norte'),
+                                                ('sepomex', 'cp_estado_14')])
+
+        statements = [repr(c[0][0]) for c in cursor.execute.call_args_list]
+        assert sum('PARTITION OF' in stmt for stmt in statements) == 1
+        inserts = [stmt for stmt in statements if 'INSERT INTO' in stmt]
+        assert len(inserts) == 2
+        assert "Literal('cp_14_cp_jal')" in inserts[0]
+        assert "Literal('cp_14_cp_jal_norte')" in inserts[1]
+        assert not any('PARTITION BY LIST' in stmt for stmt in statements)
+
+    def test_cp_partitions_are_not_source_tables(self, load_shapefiles):
+        """sepomex.cp y sus particiones no entran al directorio ni se subdividen"""
+        assert load_shapefiles.is_unified_table('sepomex', 'cp_estado_14')
+        assert not load_shapefiles.is_sepomex_cp_table('sepomex', 'cp_estado_14')
+        assert load_shapefiles.is_sepomex_cp_table('sepomex', 'cp_14_cp_jal')
+        assert load_shapefiles.subdivide_key('sepomex', 'cp_estado_14') is None
+
+    # manifest.json de descargas (recarga y revalidación)
+
+    def _changed(self, load_shapefiles, tmp_path, manifest, newer):
+        zip_file = tmp_path / 'CP_Jal.zip'
+        zip_file.write_bytes(b'PK')
+        (tmp_path / 'manifest.json').write_text(json.dumps(manifest))
+        cursor = MagicMock()
+        cursor.fetchone.return_value = (newer,)
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+        with patch.object(load_shapefiles, 'get_db_connection', return_value=conn):
+            return load_shapefiles.zip_changed_since_load(zip_file), cursor
+
+    def test_zip_newer_than_last_load(self, load_shapefiles, tmp_path):
+        """Un ZIP descargado después de su última carga se recarga"""
+        manifest = {'CP_Jal.zip': {'downloaded_at': '2026-01-02T00:00:00+00:00'}}
+        changed, cursor = self._changed(load_shapefiles, tmp_path, manifest, True)
+
+        assert changed is True
+        assert cursor.execute.call_args[0][1] == ('2026-01-02T00:00:00+00:00', 'CP_Jal.zip')
+
+    def test_zip_without_manifest_entry(self, load_shapefiles, tmp_path):
+        """Sin entrada en el manifiesto no se consulta la base de datos"""
+        changed, cursor = self._changed(load_shapefiles, tmp_path, {}, True)
+
+        assert changed is False
+        cursor.execute.assert_not_called()
+
+    def test_verified_zip_skips_revalidation(self, load_shapefiles, tmp_path):
+        """Un ZIP con el tamaño y la fecha del manifiesto no se revalida al extraer"""
+        zip_file = tmp_path / 'CP_Jal.zip'
+        zip_file.write_bytes(_zip_bytes('cp.shp'))
+        entry = download_utils.manifest_entry('http://example.com/CP_Jal.zip', zip_file)
+        (tmp_path / 'manifest.json').write_text(json.dumps({'CP_Jal.zip': entry}))
+
+        with patch.object(load_shapefiles, 'validate_zip') as mock_validate:
+            shp_files = load_shapefiles.extract_zip(zip_file, tmp_path / 'out')
+            mock_validate.assert_not_called()
+
+            zip_file.write_bytes(_zip_bytes('cp.shp', 'otro contenido más largo'))
+            load_shapefiles.extract_zip(zip_file, tmp_path / 'out2')
+            mock_validate.assert_called_once()
+
+        assert [p.name for p in shp_files] == ['cp.shp']
+
+    def test_full_validation_ignores_manifest(self, load_shapefiles, tmp_path):
+        """Con VALIDATE_ZIPS=full se ejecuta testzip() aunque el manifiesto coincida"""
+        import zipfile
+
+        zip_file = tmp_path / 'CP_Jal.zip'
+        zip_file.write_bytes(_zip_bytes('cp.shp'))
+        entry = download_utils.manifest_entry('http://example.com/CP_Jal.zip', zip_file)
+        (tmp_path / 'manifest.json').write_text(json.dumps({'CP_Jal.zip': entry}))
+
+        with patch.object(load_shapefiles, 'VALIDATE_ZIPS', 'full'), \
+                patch.object(zipfile.ZipFile, 'testzip', return_value=None) as mock_testzip:
+            load_shapefiles.extract_zip(zip_file, tmp_path / 'out')
+
+        mock_testzip.assert_called_once()
+
+
+def _write_test_shapefile(base: Path):
+    """Escribe un shapefile Polygon mínimo (.shp/.dbf/.cpg) para los tests"""
+    import struct
+
+    outer = [(0, 0), (0, 10), (10, 10), (10, 0), (0, 0)]     # horario → exterior
+    hole = [(2, 2), (4, 2), (4, 4), (2, 4), (2, 2)]          # antihorario → hueco
+    island = [(20, 20), (20, 30), (30, 30), (20, 20)]        # segundo exterior
+
+    def polygon_record(rings):
+        points = [pt for ring in rings for pt in ring]
+        parts, offset = [], 0
+        for ring in rings:
+            parts.append(offset)
+            offset += len(ring)
+        content = struct.pack('<i4d2i', 5, 0, 0, 30, 30, len(parts), len(points))
+        content += struct.pack(f'<{len(parts)}i', *parts)
+        content += b''.join(struct.pack('<2d', *pt) for pt in points)
+        return content
+
+    records = [polygon_record([outer, hole, island]), struct.pack('<i', 0)]
+    body = b''.join(
+        struct.pack('>2i', i + 1, len(content) // 2) + content
+        for i, content in enumerate(records)
+    )
+    header = struct.pack('>7i', 9994, 0, 0, 0, 0, 0, (100 + len(body)) // 2)
+    header += struct.pack('<2i4d4d', 1000, 5, 0, 0, 30, 30, 0, 0, 0, 0)
+    base.with_suffix('.shp').write_bytes(header + body)
+
+    fields = [(b'CVE_AGEB', b'C', 4, 0), (b'POBTOT', b'N', 8, 0), (b'AREA', b'N', 12, 3)]
+    record_length = 1 + sum(f[2] for f in fields)
+    dbf = struct.pack('<B3BIHH20x', 3, 124, 1, 1, 2, 32 + 32 * len(fields) + 1, record_length)
+    for name, ftype, length, decimals in fields:
+        dbf += name.ljust(11, b'\x00') + ftype + b'\x00' * 4 + bytes([length, decimals]) + b'\x00' * 14
+    dbf += b'\x0d'
+    dbf += b' ' + 'Ñ01A'.encode('utf-8')[:4] + b'     150' + b'    1234.500'
+    dbf += b' ' + b'    ' + b'        ' + b'            '
+    dbf += b'\x1a'
+    base.with_suffix('.dbf').write_bytes(dbf)
+    base.with_suffix('.cpg').write_bytes(b'UTF-8')
+
+
+class TestNativeLoader:
+    """Tests para el cargador nativo de shapefiles (LOADER_BACKEND=native)"""
+
+    def _import_native(self):
+        sys.path.insert(0, str(Path(__file__).parent.parent / 'scripts'))
+        try:
+            import native_loader
+        except ImportError:
+            pytest.skip("Script native_loader no disponible")
+        return native_loader
+
+    def _read_records(self, native_loader, source):
+        with native_loader.open_shapefile(source) as files:
+            shape_type = native_loader.read_shp_header(files['.shp'])
+            num_records, record_length, fields = native_loader.read_dbf_header(files['.dbf'])
+            encoding = native_loader.dbf_encoding(files.get('.cpg'))
+            shapes = list(native_loader.iter_shp_records(files['.shp']))
+            records = list(native_loader.iter_dbf_records(files['.dbf'], num_records, record_length))
+        return shape_type, fields, encoding, shapes, records
+
+    def test_reads_shp_and_dbf(self, tmp_path):
+        """Lee encabezados, registros y codificación del .cpg"""
+        native_loader = self._import_native()
+        _write_test_shapefile(tmp_path / '14a')
+
+        shape_type, fields, encoding, shapes, records = self._read_records(native_loader, tmp_path / '14a.shp')
+
+        assert shape_type == 5
+        assert [f[0] for f in fields] == ['CVE_AGEB', 'POBTOT', 'AREA']
+        assert encoding == 'utf-8'
+        assert len(shapes) == 2 and len(records) == 2
+
+    def test_reads_from_vsizip(self, tmp_path):
+        """Las rutas /vsizip/ se leen directamente del ZIP"""
+        import zipfile
+        native_loader = self._import_native()
+        _write_test_shapefile(tmp_path / '14a')
+
+        zip_path = tmp_path / '14_jalisco.zip'
+        with zipfile.ZipFile(zip_path, 'w') as zf:
+            for ext in ('.shp', '.dbf', '.cpg'):
+                zf.write(tmp_path / f'14a{ext}', f'conjunto_de_datos/14a{ext}')
+
+        source = f"/vsizip/{zip_path}/conjunto_de_datos/14a.shp"
+        shape_type, _, _, shapes, _ = self._read_records(native_loader, source)
+
+        assert shape_type == 5
+        assert len(shapes) == 2
+
+    def test_polygon_rings_grouped_into_multipolygon(self, tmp_path):
+        """El hueco se asigna a su exterior y la isla queda como segundo polígono"""
+        import struct
+        native_loader = self._import_native()
+        _write_test_shapefile(tmp_path / '14a')
+        _, _, _, shapes, _ = self._read_records(native_loader, tmp_path / '14a.shp')
+
+        ewkb = native_loader.shape_to_ewkb(shapes[0], 900919)
+        byte_order, wkb_type, srid, num_polygons = struct.unpack_from('<BIII', ewkb, 0)
+
+        assert byte_order == 1
+        assert wkb_type == 6 | native_loader.WKB_SRID_FLAG
+        assert srid == 900919
+        assert num_polygons == 2
+        # Primer polígono: exterior + hueco
+        assert struct.unpack_from('<BII', ewkb, 13) == (1, 3, 2)
+        # Geometría nula
+        assert native_loader.shape_to_ewkb(shapes[1], 900919) is None
+
+    def test_z_and_m_shapes_load_as_2d(self):
+        """PolygonZ/PointM se cargan en 2D: se copian X,Y y se descartan Z/M"""
+        import struct
+        native_loader = self._import_native()
+        ring = [(0, 0), (0, 10), (10, 10), (0, 0)]
+        xy = b''.join(struct.pack('<2d', *pt) for pt in ring)
+        polygon_2d = struct.pack('<i4d2i', 5, 0, 0, 10, 10, 1, len(ring)) + struct.pack('<i', 0) + xy
+        z = struct.pack('<2d', 0, 5) + struct.pack(f'<{len(ring)}d', *[5] * len(ring))
+        polygon_z = struct.pack('<i', 15) + polygon_2d[4:] + z + z
+
+        assert native_loader.shape_to_ewkb(polygon_z, 6372) == native_loader.shape_to_ewkb(polygon_2d, 6372)
+
+        point_m = struct.pack('<i3d', 21, 1.5, 2.5, 99)
+        ewkb = native_loader.shape_to_ewkb(point_m, 6372)
+        assert struct.unpack_from('<2d', ewkb, len(ewkb) - 16) == (1.5, 2.5)
+
+    def test_unsupported_shape_type_is_reported(self):
+        """Un tipo sin equivalente 2D (MultiPatch) se rechaza con un mensaje claro"""
+        import struct
+        native_loader = self._import_native()
+
+        with pytest.raises(ValueError, match='no soportado'):
+            native_loader.shape_to_ewkb(struct.pack('<i', 31) + b'\x00' * 40, 6372)
+
+    def test_wkt_to_proj4(self):
+        """El proj4text del SRID personalizado se arma a partir del .prj"""
+        native_loader = self._import_native()
+        lcc = ('PROJCS["MEXICO_ITRF_2008_LCC",GEOGCS["GCS_ITRF_2008",DATUM["D_ITRF_2008",'
+               'SPHEROID["GRS_1980",6378137.0,298.257222101]],PRIMEM["Greenwich",0.0],'
+               'UNIT["Degree",0.0174532925199433]],PROJECTION["Lambert_Conformal_Conic"],'
+               'PARAMETER["False_Easting",2500000.0],PARAMETER["False_Northing",0.0],'
+               'PARAMETER["Central_Meridian",-102.0],PARAMETER["Standard_Parallel_1",17.5],'
+               'PARAMETER["Standard_Parallel_2",29.5],PARAMETER["Latitude_Of_Origin",12.0],'
+               'UNIT["Meter",1.0]]')
+
+        assert native_loader.wkt_to_proj4(lcc) == (
+            '+proj=lcc +x_0=2500000 +y_0=0 +lon_0=-102 +lat_1=17.5 +lat_2=29.5 +lat_0=12 '
+            '+a=6378137 +rf=298.257222101 +units=m +no_defs')
+        with pytest.raises(ValueError, match='no soportada'):
+            native_loader.wkt_to_proj4(lcc.replace('Lambert_Conformal_Conic', 'Krovak'))
+
+    def test_resolve_srid_reuses_equivalent_srtext(self):
+        """Un .prj con el srtext de init-db.sh (con otros espacios) reutiliza su SRID"""
+        import io
+        native_loader = self._import_native()
+        cursor = MagicMock()
+        cursor.fetchone.return_value = (900914,)
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+
+        srid = native_loader.resolve_srid(conn, io.BytesIO(b'PROJCS["WGS_1984_Web_Mercator", GEOGCS["x"]]\n'))
+
+        assert srid == 900914
+        queries = [c[0] for c in cursor.execute.call_args_list]
+        lookup = next(q for q in queries if 'regexp_replace' in q[0])
+        assert lookup[1] == ('PROJCS["WGS_1984_WEB_MERCATOR",GEOGCS["X"]]',)
+        assert not any('INSERT' in q[0] for q in queries)
+
+    def test_field_encoders(self, tmp_path):
+        """Los valores del .dbf se codifican en binario COPY (vacíos → NULL)"""
+        from decimal import Decimal
+        native_loader = self._import_native()
+        _write_test_shapefile(tmp_path / '14a')
+        _, fields, encoding, _, records = self._read_records(native_loader, tmp_path / '14a.shp')
+
+        types = [native_loader.column_type(f[1], f[2], f[3]) for f in fields]
+        assert types == ['VARCHAR(4)', 'NUMERIC(8,0)', 'NUMERIC(12,3)']
+
+        encoders = [native_loader.make_field_encoder(f[1], t, encoding) for f, t in zip(fields, types)]
+        record = records[0][1]
+        assert encoders[0](record[0:4]) == 'Ñ01'.encode('utf-8')
+        assert encoders[1](record[4:12]) == native_loader.encode_numeric(Decimal('150'))
+        assert encoders[2](record[12:24]) == native_loader.encode_numeric(Decimal('1234.500'))
+
+        empty = records[1][1]
+        assert encoders[0](empty[0:4]) is None
+        assert encoders[1](empty[4:12]) is None
+
+    def test_encode_numeric(self):
+        """Formato binario de NUMERIC: dígitos base 10000, peso, signo y escala"""
+        import struct
+        from decimal import Decimal
+        native_loader = self._import_native()
+
+        assert native_loader.encode_numeric(Decimal('1234.500')) == struct.pack('>hhHH2H', 2, 0, 0, 3, 1234, 5000)
+        assert native_loader.encode_numeric(Decimal('-0.01')) == struct.pack('>hhHH1H', 1, -1, 0x4000, 2, 100)
+        assert native_loader.encode_numeric(Decimal('0')) == struct.pack('>hhHH', 0, 0, 0, 0)
+
+    def test_launder_name(self):
+        """Los nombres de columna se normalizan como ogr2ogr"""
+        native_loader = self._import_native()
+
+        assert native_loader.launder_name('CVE_AGEB') == 'cve_ageb'
+        assert native_loader.launder_name('Área-1') == '_rea_1'
+
+    def test_column_names_avoid_collisions(self):
+        """Campos que chocan con ogc_fid, geom u otro campo reciben sufijo numérico"""
+        native_loader = self._import_native()
+
+        assert native_loader.column_names(['CVEGEO', 'GEOM', 'OGC_FID', 'A B', 'a_b']) == \
+            ['cvegeo', 'geom2', 'ogc_fid2', 'a_b', 'a_b2']
+
+
+def _fake_process_state(conn, cve_ent, subdivided=False, version=None):
+    return 1
+
+
+class TestMappingScript:
+    """Tests para create_cp_ageb_mapping.py"""
+
+    def _import_mapping(self):
+        sys.path.insert(0, str(Path(__file__).parent.parent / 'scripts'))
+        try:
+            import create_cp_ageb_mapping
+        except ImportError:
+            pytest.skip("Script create_cp_ageb_mapping no disponible")
+        return create_cp_ageb_mapping
+
+    def test_state_order_large_states_first(self):
+        """Los estados grandes se programan primero y no se repite ninguno"""
+        mapping = self._import_mapping()
+        order = mapping.state_order()
+
+        assert order[:4] == ['15', '14', '30', '21']
+        assert sorted(order) == sorted(mapping.ESTADOS)
+
+    def test_sequential_processing(self):
+        """Con un worker se procesan los 32 estados en la misma conexión"""
+        mapping = self._import_mapping()
+        conn = Mock()
+
+        with patch.object(mapping, 'process_state', side_effect=_fake_process_state) as mock_process:
+            total = mapping.process_states(conn, 1)
+
+        assert total == 32
+        assert all(c[0][0] is conn for c in mock_process.call_args_list)
+
+    def test_intersection_computed_once(self):
+        """El INSERT evalúa ST_Intersection y el área del CP una sola vez por par"""
+        mapping = self._import_mapping()
+        cur = Mock(rowcount=7)
+
+        count = mapping.insert_intersections(cur, '14', 'cp_14_cp_jal', 'inegi.ageb_urbana_14', 'urbana')
+
+        query, params = cur.execute.call_args[0]
+        assert count == 7
+        # Mismo umbral que el cálculo en vivo: > 0.01% del área del CP
+        assert params == ('14', 'urbana', 0.01)
+        assert 'NULLIF(pares.area_cp, 0) * 100 > %s' in query
+        assert query.count('ST_Intersection(') == 1
+        assert query.count('ST_Area(geom_6372)') == 1
+        assert 'ST_Covers(cp.geom_6372, ageb.geom_6372)' in query
+        assert 'ST_CoveredBy(cp.geom_6372, ageb.geom_6372)' in query
+        assert query.count('OFFSET 0') == 2
+
+    def test_subdivided_sums_pieces_per_pair(self):
+        """Con piezas el cruce usa subdiv y suma el área por CP/AGEB original"""
+        mapping = self._import_mapping()
+        cur = Mock(rowcount=3)
+
+        mapping.insert_intersections(cur, '14', 'cp_14_cp_jal', 'inegi.ageb_urbana_14', 'urbana',
+                                     subdivided=True)
+
+        query = cur.execute.call_args[0][0]
+        assert 'JOIN subdiv.cp_14_cp_jal p ON p.parent_fid = c.ogc_fid' in query
+        assert 'subdiv.ageb_urbana_14 ageb' in query
+        assert 'SUM(CASE' in query
+        assert 'GROUP BY cp.parent_fid, cp.d_cp, cp.area_cp, ageb.parent_fid, ageb.cvegeo' in query
+        assert query.count('ST_Intersection(') == 1
+
+    def _run_state(self, mapping, stored, version=None, unified=False, agebs=True,
+                   cp_tables=('cp_14_cp_jal',)):
+        cursor = MagicMock(rowcount=0)
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+        with patch.object(mapping, 'relation_exists', return_value=unified), \
+                patch.object(mapping, 'get_available_tables', return_value=list(cp_tables)), \
+                patch.object(mapping, 'has_canonical_geometry',
+                             side_effect=lambda conn, schema, table: schema == 'sepomex' or agebs), \
+                patch.object(mapping, 'state_fingerprint', return_value='nueva'), \
+                patch.object(mapping, 'stored_fingerprint', return_value=stored), \
+                patch.object(mapping, 'insert_intersections', return_value=5) as mock_insert:
+            total = mapping.process_state(conn, '14', version=version)
+        return total, cursor, mock_insert
+
+    def test_unchanged_state_is_skipped(self):
+        """Un estado con la misma huella no se recalcula"""
+        mapping = self._import_mapping()
+        total, cursor, mock_insert = self._run_state(mapping, 'nueva')
+
+        assert total == 0
+        mock_insert.assert_not_called()
+        cursor.execute.assert_not_called()
+
+    def test_changed_state_replaces_rows(self):
+        """Un estado con huella distinta borra sus registros y guarda la nueva huella"""
+        mapping = self._import_mapping()
+        total, cursor, mock_insert = self._run_state(mapping, 'anterior')
+
+        assert total == 10
+        assert mock_insert.call_count == 2
+        first_query, first_params = cursor.execute.call_args_list[0][0]
+        assert 'DELETE FROM public.cp_to_ageb_mapping' in first_query
+        assert first_params == ('14',)
+        status_query, status_params = cursor.execute.call_args_list[-1][0]
+        assert 'fingerprint' in status_query
+        assert status_params == ('14', 10, 'nueva', 0.01)
+        assert 'umbral_porcentaje' in status_query
+
+    def test_stored_fingerprint_requires_same_threshold(self):
+        """Un mapeo guardado con otro umbral no cuenta como huella vigente"""
+        mapping = self._import_mapping()
+        cursor = MagicMock()
+        cursor.fetchone.return_value = None
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+
+        assert mapping.stored_fingerprint(conn, '14') is None
+        query, params = cursor.execute.call_args[0]
+        assert 'umbral_porcentaje = %s' in query
+        assert params == ('14', mapping.MIN_INTERSECTION_PERCENT)
+
+    def test_state_without_agebs_is_not_marked_mapped(self):
+        """Sin tablas de AGEBs se borra el estado del status para seguir en vivo"""
+        mapping = self._import_mapping()
+        total, cursor, mock_insert = self._run_state(mapping, 'anterior', agebs=False)
+
+        assert total == 0
+        mock_insert.assert_not_called()
+        queries = [c[0][0] for c in cursor.execute.call_args_list]
+        assert 'DELETE FROM public.cp_to_ageb_mapping_status' in queries[-1]
+        assert not any('INSERT' in query for query in queries)
+
+    def test_state_without_cp_table_drops_mapping(self):
+        """Si la tabla de CPs desapareció se borran el mapeo y el status del estado"""
+        mapping = self._import_mapping()
+        total, cursor, mock_insert = self._run_state(mapping, 'anterior', cp_tables=())
+
+        assert total == 0
+        mock_insert.assert_not_called()
+        queries = [c[0][0] for c in cursor.execute.call_args_list]
+        assert 'DELETE FROM public.cp_to_ageb_mapping WHERE' in queries[0]
+        assert 'DELETE FROM public.cp_to_ageb_mapping_status' in queries[1]
+
+    def test_unified_cp_partition_is_preferred(self):
+        """Si existe sepomex.cp_estado_XX se usa como fuente de CPs con su columna geom"""
+        mapping = self._import_mapping()
+        total, cursor, mock_insert = self._run_state(mapping, 'anterior', unified=True)
+
+        assert total == 10
+        for llamada in mock_insert.call_args_list:
+            assert llamada[0][2] == 'cp_estado_14'
+            assert llamada[1]['cp_geom'] == 'geom'
+
+    def test_insert_reads_unified_cp_geometry(self):
+        """Con cp_geom=geom la consulta renombra la columna en lugar de leer geom_6372"""
+        mapping = self._import_mapping()
+        cur = MagicMock(rowcount=3)
+
+        mapping.insert_intersections(cur, '14', 'cp_estado_14', 'ageb_urbana_14', 'urbana',
+                                     cp_geom='geom')
+
+        query = cur.execute.call_args[0][0]
+        assert 'd_cp, geom AS geom_6372, ST_Area(geom) AS area_cp' in query
+        assert 'FROM sepomex.cp_estado_14' in query
+
+    def test_tables_without_canonical_geometry_are_transformed(self):
+        """Sin geom_6372 (CANONICAL_GEOM=false) se transforma geom en lugar de omitir el estado"""
+        mapping = self._import_mapping()
+        cursor = MagicMock(rowcount=0)
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+
+        with patch.object(mapping, 'relation_exists', side_effect=lambda conn, name: 'cp_estado' not in name), \
+                patch.object(mapping, 'get_available_tables', return_value=['cp_14_cp_jal']), \
+                patch.object(mapping, 'has_canonical_geometry', return_value=False), \
+                patch.object(mapping, 'state_fingerprint', return_value='nueva'), \
+                patch.object(mapping, 'stored_fingerprint', return_value=None), \
+                patch.object(mapping, 'insert_intersections', return_value=5) as mock_insert:
+            total = mapping.process_state(conn, '14')
+
+        assert total == 10
+        for llamada in mock_insert.call_args_list:
+            assert llamada[1]['cp_geom'] == 'ST_Transform(geom, 6372)'
+            assert llamada[1]['ageb_geom'] == 'ST_Transform(geom, 6372)'
+
+        cur = MagicMock(rowcount=3)
+        mapping.insert_intersections(cur, '14', 'cp_14_cp_jal', 'inegi.ageb_urbana_14', 'urbana',
+                                     cp_geom='ST_Transform(geom, 6372)',
+                                     ageb_geom='ST_Transform(geom, 6372)')
+        query = cur.execute.call_args[0][0]
+        assert '(SELECT cvegeo, ST_Transform(geom, 6372) AS geom_6372 FROM inegi.ageb_urbana_14) ageb' in query
+
+    def test_bulk_state_writes_to_version(self):
+        """En modo --bulk no se compara la huella ni se borra; se escribe en la versión"""
+        mapping = self._import_mapping()
+        total, cursor, mock_insert = self._run_state(mapping, 'nueva', version=3)
+
+        assert total == 10
+        assert all(c[1]['target'] == 'cp_to_ageb_mapping_v3' for c in mock_insert.call_args_list)
+        queries = [c[0][0] for c in cursor.execute.call_args_list]
+        assert not any('DELETE' in query for query in queries)
+        assert 'INSERT INTO public.cp_to_ageb_mapping_status_v3' in queries[-1]
+
+    def _publish(self, mapping, versioned, carry_over=False):
+        cursor = MagicMock()
+        cursor.fetchone.return_value = (1234,)
+        cursor.fetchall.return_value = []
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+        with patch.object(mapping, 'mapping_is_versioned', return_value=versioned):
+            mapping.publish_version(conn, 2, carry_over=carry_over)
+        return [c[0][0] for c in cursor.execute.call_args_list]
+
+    def test_carry_over_skips_states_without_source_tables(self):
+        """Solo se conservan los estados que siguen teniendo tablas de CPs y de AGEBs"""
+        mapping = self._import_mapping()
+        queries = self._publish(mapping, versioned=True, carry_over=True)
+
+        carry = queries[0]
+        assert 'INSERT INTO public.cp_to_ageb_mapping_status_v2' in carry
+        assert "to_regclass('inegi.ageb_urbana_' || s.estado_cve) IS NOT NULL" in carry
+        assert "to_regclass('inegi.ageb_rural_' || s.estado_cve) IS NOT NULL" in carry
+        assert "LIKE 'cp\\_' || s.estado_cve" in carry
+
+    def test_publish_indexes_then_repoints_views(self):
+        """Los índices se crean en la versión antes de apuntar las vistas"""
+        mapping = self._import_mapping()
+        queries = self._publish(mapping, versioned=True)
+
+        index_pos = max(i for i, q in enumerate(queries) if q.startswith('CREATE INDEX'))
+        view_pos = queries.index('CREATE OR REPLACE VIEW public.cp_to_ageb_mapping '
+                                 'AS SELECT * FROM public.cp_to_ageb_mapping_v2')
+        assert 'SET LOGGED' in queries[0]
+        assert index_pos < view_pos
+        assert 'CREATE INDEX idx_cp_to_ageb_cp_v2 ON public.cp_to_ageb_mapping_v2(codigo_postal)' in queries
+        assert not any(q.startswith('DROP TABLE') for q in queries)
+
+    def test_first_publish_keeps_legacy_table_as_version_zero(self):
+        """La tabla sin versionar se conserva como versión 0 para --rollback"""
+        mapping = self._import_mapping()
+        queries = self._publish(mapping, versioned=False)
+
+        assert 'ALTER TABLE public.cp_to_ageb_mapping RENAME TO cp_to_ageb_mapping_v0' in queries
+        assert 'ALTER TABLE public.cp_to_ageb_mapping_status RENAME TO cp_to_ageb_mapping_status_v0' in queries
+
+    def test_rollback_without_previous_version(self):
+        """Sin versión anterior --rollback no modifica nada"""
+        mapping = self._import_mapping()
+        cursor = MagicMock()
+        cursor.fetchone.return_value = None
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+
+        with patch.object(mapping, 'mapping_is_versioned', return_value=True):
+            assert mapping.rollback_version(conn) is None
+
+        conn.commit.assert_not_called()
+
+    def _refresh_compact(self, mapping, existe=True, estados=()):
+        cursor = MagicMock()
+        cursor.fetchone.side_effect = [(existe,), ('10 MB', '40 MB')]
+        cursor.fetchall.return_value = list(estados)
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+
+        mapping.refresh_compact_table(conn)
+        return [c[0] for c in cursor.execute.call_args_list]
+
+    def test_compact_table_built_sorted_then_indexed(self):
+        """La tabla compacta se llena ordenada por CP y se indexa después"""
+        mapping = self._import_mapping()
+        queries = [q for q, *_ in self._refresh_compact(mapping, existe=False)]
+
+        insert_pos = next(i for i, q in enumerate(queries) if 'INSERT INTO public.cp_to_ageb_mapping_compact' in q)
+        index_pos = next(i for i, q in enumerate(queries) if 'CREATE INDEX idx_cp_to_ageb_compact_cp' in q)
+        assert 'ORDER BY codigo_postal::INTEGER' in queries[insert_pos]
+        assert 'cvegeo_a_entero(clave_ageb)' in queries[insert_pos]
+        assert 'estado_cve::SMALLINT' in queries[insert_pos]
+        assert '(codigo_postal, estado_cve)' in queries[index_pos]
+        assert insert_pos < index_pos
+        assert any('CREATE VIEW public.cp_to_ageb_mapping_compact_view' in q for q in queries)
+
+    def test_compact_table_swapped_by_rename(self):
+        """La tabla compacta se construye con otro nombre y se intercambia al final sin CASCADE"""
+        mapping = self._import_mapping()
+        queries = [q for q, *_ in self._refresh_compact(mapping, existe=False)]
+
+        insert_pos = next(i for i, q in enumerate(queries) if 'INSERT INTO public.cp_to_ageb_mapping_compact_new' in q)
+        drop_pos = next(i for i, q in enumerate(queries)
+                        if 'DROP TABLE IF EXISTS public.cp_to_ageb_mapping_compact,' in q)
+        rename_pos = next(i for i, q in enumerate(queries)
+                          if 'cp_to_ageb_mapping_compact_new RENAME TO cp_to_ageb_mapping_compact' in q)
+        assert insert_pos < drop_pos < rename_pos
+        assert queries[drop_pos].endswith('RESTRICT')
+        assert 'DROP VIEW IF EXISTS public.cp_to_ageb_mapping_compact_view' in queries[drop_pos - 1]
+        assert not any('CASCADE' in q for q in queries)
+        assert any('RENAME TO cp_to_ageb_mapping_compact_status' in q for q in queries)
+        assert 'cp_to_ageb_mapping_compact_status_new' in queries[insert_pos]
+
+    def test_compact_table_updates_changed_states(self):
+        """Con la tabla compacta al día solo se reemplazan los estados cuyo mapped_at cambió"""
+        mapping = self._import_mapping()
+        llamadas = self._refresh_compact(mapping, estados=[('09', False), ('14', True)])
+        queries = [q for q, *_ in llamadas]
+
+        assert not any('_new' in q or 'RENAME' in q for q in queries)
+        deletes = [c for c in llamadas if c[0].startswith('DELETE FROM public.cp_to_ageb_mapping_compact ')]
+        assert deletes[0][1] == ([14],)
+        insert = next(c for c in llamadas if 'INSERT INTO public.cp_to_ageb_mapping_compact\n' in c[0])
+        assert insert[1] == (['14'],)
+        assert 'ORDER BY codigo_postal::INTEGER' in insert[0]
+
+    def test_compact_table_unchanged(self):
+        """Sin estados cambiados no se escribe nada"""
+        mapping = self._import_mapping()
+        queries = [q for q, *_ in self._refresh_compact(mapping, estados=[('09', False)])]
+
+        assert not any(q.startswith(('DELETE', 'INSERT', 'DROP')) for q in queries)
+
+    def test_compact_table_rebuilt_when_all_states_changed(self):
+        """Si cambiaron todos los estados (por ejemplo tras --bulk) se reconstruye completa"""
+        mapping = self._import_mapping()
+        queries = [q for q, *_ in self._refresh_compact(mapping, estados=[('09', True), ('14', True)])]
+
+        assert any('INSERT INTO public.cp_to_ageb_mapping_compact_new' in q for q in queries)
+
+    def test_fingerprint_covers_source_tables(self):
+        """La huella cambia si cambia la carga, el conteo o el SHA-256 del ZIP de una tabla"""
+        mapping = self._import_mapping()
+
+        def fingerprint(loaded_at='2024-01-01', registros=10, sha256='a'):
+            cursor = MagicMock()
+            cursor.fetchone.side_effect = [(True,), (registros,), (loaded_at, None, 'CP_Jal.zip', 'SEPOMEX'),
+                                           (True,), (4,), ('2024-01-01', None, '14_jal.zip', 'INEGI'),
+                                           (False,)]
+            conn = MagicMock()
+            conn.cursor.return_value.__enter__.return_value = cursor
+            with patch.object(mapping, 'manifest_sha256', return_value=sha256):
+                huella = mapping.state_fingerprint(conn, '14', 'cp_14_cp_jal')
+            queries = [c[0][0] for c in cursor.execute.call_args_list]
+            assert not any('ST_AsEWKB' in query or 'md5' in query for query in queries)
+            return huella
+
+        assert fingerprint() == fingerprint()
+        assert fingerprint() != fingerprint(loaded_at='2024-02-01')
+        assert fingerprint() != fingerprint(registros=11)
+        assert fingerprint() != fingerprint(sha256='b')
+        assert len(fingerprint()) == 32
+
+    def test_fingerprint_of_partition_uses_source_loads(self):
+        """La huella de cp_estado_XX usa las cargas de las tablas cp_XX_* que la llenan"""
+        mapping = self._import_mapping()
+        cursor = MagicMock()
+        cursor.fetchone.side_effect = [(True,), (10,), ('2024-01-01', None, 'CP_Jal.zip', 'SEPOMEX'),
+                                       (False,), (False,)]
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cursor
+
+        with patch.object(mapping, 'get_available_tables', return_value=['cp_14_cp_jal']), \
+                patch.object(mapping, 'manifest_sha256', return_value=''):
+            mapping.state_fingerprint(conn, '14', 'cp_estado_14')
+
+        load_params = [c[0][1] for c in cursor.execute.call_args_list
+                       if 'load_metadata' in c[0][0]]
+        assert load_params == [('cp_14_cp_jal',)]
+
+    def test_manifest_sha256(self, tmp_path):
+        """El SHA-256 sale del manifiesto del directorio de la fuente"""
+        mapping = self._import_mapping()
+        (tmp_path / 'manifest.json').write_text(json.dumps({'CP_Jal.zip': {'sha256': 'abc'}}))
+
+        with patch.dict(mapping.DOWNLOAD_DIRS, {'SEPOMEX': tmp_path}):
+            assert mapping.manifest_sha256('SEPOMEX', 'CP_Jal.zip') == 'abc'
+            assert mapping.manifest_sha256('SEPOMEX', 'otro.zip') == ''
+            assert mapping.manifest_sha256('SUBDIV', 'CP_Jal.zip') == ''
+
+    def test_fingerprint_covers_subdivided_mode(self):
+        """Con --subdivided la huella incluye el modo y la construcción de las piezas"""
+        mapping = self._import_mapping()
+
+        def fingerprint(subdivided, piezas=(20, 8)):
+            cursor = MagicMock()
+            fetches = [(True,), (10,), ('2024-01-01', None, 'CP_Jal.zip', 'SEPOMEX'),
+                       (True,), (4,), ('2024-01-01', None, '14_jal.zip', 'INEGI'),
+                       (False,)]
+            if subdivided:
+                fetches += [(True,), ('2024-01-01', piezas[0]),
+                            (True,), ('2024-01-01', piezas[1]),
+                            (False,)]
+            cursor.fetchone.side_effect = fetches
+            conn = MagicMock()
+            conn.cursor.return_value.__enter__.return_value = cursor
+            with patch.object(mapping, 'manifest_sha256', return_value=''):
+                return mapping.state_fingerprint(conn, '14', 'cp_14_cp_jal', subdivided=subdivided)
+
+        assert fingerprint(False) != fingerprint(True)
+        assert fingerprint(True) == fingerprint(True)
+        assert fingerprint(True) != fingerprint(True, piezas=(20, 9))
+
+    def test_failed_state_rolls_back(self):
+        """Un estado con error hace rollback y no detiene el proceso"""
+        mapping = self._import_mapping()
+        conn = Mock()
+
+        with patch.object(mapping, 'process_state', side_effect=Exception("boom")):
+            assert mapping.process_state_safe(conn, '14') == 0
+
+        conn.rollback.assert_called_once()
+
 
 class TestDataIntegrity:
     """Tests de integridad de datos"""